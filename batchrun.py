@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+### Shared multi-file batch support for the ddrad_scripts command-line tools.
+### Inputs are expanded from globs, per-input output names are built from a
+### template, and the inputs are processed on a process pool.
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+
+import profiling
+
+# Placeholders available in output templates, e.g. -o "{stem}.phy"
+TEMPLATE_HELP = ("with several inputs, use {stem}, {name}, {dir} or {path} "
+                "of each input in the name")
+
+
+def add_jobs_argument(group):
+    """
+    Function to add the -j/--jobs option to an argparse group.
+    Input:
+        group: argparse parser or argument group
+    Returns:
+        None
+    """
+    group.add_argument("-j", "--jobs",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="Number of input files processed in parallel; "
+                        "default=1")
+
+
+def expand_inputs(patterns):
+    """
+    Function to expand input filenames and glob patterns, keeping order and
+    dropping duplicates. Patterns that match nothing are kept as given so the
+    tool reports the missing file.
+    Input:
+        patterns: list of filenames or glob patterns (list)
+    Returns:
+        list of filenames (list)
+    """
+    files = list()
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for file in matches or [pattern]:
+            if file not in seen:
+                seen.add(file)
+                files.append(file)
+    return files
+
+
+def is_template(value):
+    """
+    Function to check whether a value contains template placeholders.
+    Input:
+        value (string or None)
+    Returns:
+        bool
+    """
+    return value is not None and "{" in value
+
+
+def format_template(template, infile):
+    """
+    Function to build a name for one input from a template.
+    Input:
+        template: e.g. "{stem}.phy" (string)
+        infile: input filename (string)
+    Returns:
+        string
+    """
+    name = os.path.basename(infile)
+    return template.format(path=infile,
+                        name=name,
+                        stem=os.path.splitext(name)[0],
+                        dir=os.path.dirname(infile) or ".")
+
+
+def per_input_arguments(arguments, input_attr, infiles, template_attrs,
+                        shared_attrs=()):
+    """
+    Function to build one argparse namespace per input file, with the input
+    attribute set to that file and every templated attribute formatted for it.
+    Input:
+        arguments: parsed argparse namespace
+        input_attr: name of the input attribute (string)
+        infiles: expanded input filenames (list)
+        template_attrs: per-input outputs; must be templates when several
+                        inputs are given (list)
+        shared_attrs: attributes that may be templates or a single value
+                        shared by every input (list)
+    Returns:
+        list of argparse.Namespace
+    Raises:
+        ValueError if several inputs would write to the same fixed name
+    """
+    if len(infiles) > 1:
+        for attr in template_attrs:
+            value = getattr(arguments, attr)
+            if value is not None and not is_template(value):
+                raise ValueError("--{} must contain a placeholder such as "
+                                "{{stem}} when several inputs are given".format(attr))
+
+    namespaces = list()
+    for infile in infiles:
+        values = vars(arguments).copy()
+        values[input_attr] = infile
+        for attr in list(template_attrs) + list(shared_attrs):
+            if is_template(values[attr]):
+                values[attr] = format_template(values[attr], infile)
+        namespaces.append(argparse.Namespace(**values))
+    return namespaces
+
+
+def run_batch(worker, namespaces, labels, jobs=1):
+    """
+    Function to run worker(namespace) for every input on a process pool and
+    print a per-file success/failure summary. A single input, or jobs=1,
+    runs in this process. Each input is profiled if its namespace sets
+    --profile or --cprofile (see profiling.py).
+    Input:
+        worker: module-level function taking a namespace and returning an
+                exit status (function)
+        namespaces: one argparse namespace per input (list)
+        labels: input names used in the summary (list)
+        jobs: number of worker processes (int)
+    Returns:
+        int: 0 if every input succeeded, 1 otherwise
+    """
+    if len(namespaces) == 1:
+        return profiling.run(worker, namespaces[0], labels[0]) or 0
+
+    results = dict()
+    if jobs <= 1:
+        for label, namespace in zip(labels, namespaces):
+            results[label] = call_worker(worker, namespace, label)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = dict((pool.submit(call_worker, worker, namespace, label), label)
+                            for label, namespace in zip(labels, namespaces))
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+
+    return print_summary(labels, results)
+
+
+def call_worker(worker, namespace, label=None):
+    """
+    Function to run one input, turning sys.exit() calls and exceptions into
+    a failed status instead of stopping the batch.
+    Input:
+        worker: function taking a namespace (function)
+        namespace: argparse namespace (argparse.Namespace)
+        label: input name used in profiles (string)
+    Returns:
+        tuple: (exit status (int), error message (string), seconds (float))
+    """
+    start = time.perf_counter()
+    try:
+        code = profiling.run(worker, namespace, label) or 0
+        message = ""
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+        message = "" if isinstance(e.code, int) else str(e.code)
+    except Exception as e:
+        code = 1
+        message = "{}: {}".format(type(e).__name__, e)
+    return code, message, time.perf_counter() - start
+
+
+def print_summary(labels, results):
+    """
+    Function to print one line per input and the overall counts.
+    Input:
+        labels: input names in the order given (list)
+        results: label -> (exit status, message, seconds) (dict)
+    Returns:
+        int: 0 if every input succeeded, 1 otherwise
+    """
+    failed = 0
+    print("\nBatch summary:")
+    for label in labels:
+        code, message, elapsed = results[label]
+        status = "OK" if code == 0 else "FAILED ({})".format(message or "exit status " + str(code))
+        if code != 0:
+            failed += 1
+        print("{}\t{}\t{:.2f}s".format(label, status, elapsed))
+    print("{} succeeded, {} failed\n".format(len(labels) - failed, failed))
+    sys.stdout.flush()
+
+    if failed:
+        return 1
+    return 0
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+### Benchmark harness for the ddrad_scripts tools. Simulates pyRAD datasets
+### at several scales with simpyrad.py, runs each tool's main path as a
+### separate process and records wall time, peak RSS and throughput as JSON,
+### so results from different commits can be compared offline.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Scale name -> (samples, SNPs, loci)
+SCALES = {"tiny": (100, 10000, 2000),
+        "small": (500, 100000, 20000),
+        "medium": (1000, 500000, 100000),
+        "large": (5000, 2000000, 400000)}
+
+DEFAULT_SCALES = "tiny,small"
+
+# SNPs per locus for scales given as SAMPLESxSNPS
+SNPS_PER_LOCUS = 5
+
+# Benchmark name -> (script, arguments, input measured for throughput).
+# {snps}, {stats}, ... are the simulated files; {out} is a scratch directory.
+CASES = [("snps2phylip", "snps2phylip.py", ["-f", "{snps}", "-o", "{out}/out.phy"], "{snps}"),
+        ("snps2phylip-stream", "snps2phylip.py", ["-f", "{snps}", "-o", "{out}/stream.phy", "-m"], "{snps}"),
+        ("snps2phylip-parallel", "snps2phylip.py", ["-f", "{snps}", "-o", "{out}/parallel.phy", "-p", "4"], "{snps}"),
+        ("genomatrix", "genomatrix.py", ["-f", "{snps}", "-o", "{out}/matrix"], "{snps}"),
+        ("getbadpyrad", "getbadpyrad.py", ["-s", "{stats}", "-o", "{out}/bad.csv", "-p", "0.5"], "{stats}"),
+        ("samplePicker-stats", "samplePicker.py", ["-k", "2", "-S", "-f", "{stats}", "-o", "{out}/pick"], "{stats}"),
+        ("samplePicker-phylip", "samplePicker.py", ["-k", "2", "-p", "-f", "{out}/pick.phy", "-o", "{out}/pickp"], "{out}/pick.phy"),
+        ("filterUninformative", "filterUninformative.py", ["-l", "{log}", "-d", "{loci_dir}", "-i", "{out}/include.txt"], "{log}"),
+        ("splitLoci", "splitLoci.py", ["-f", "{loci}", "-o", "{out}/split", "-F", "phylip"], "{loci}"),
+        ("popmap2exDFOIL", "popmap2exDFOIL.py", ["-p", "{popmap}", "-S", "{species}", "-o", "{out}/info.txt"], "{popmap}")]
+
+# Benchmark name -> (script, arguments) commands run once, untimed, before
+# the benchmark to make inputs that are not simulated, so every benchmark can
+# run alone or in any order with -t.
+SETUP = {"samplePicker-phylip": [("snps2phylip.py", ["-f", "{snps}", "-o", "{out}/pick.phy"])]}
+
+
+def main():
+
+    args = Get_Arguments()
+
+    tools = None if args.tools is None else set(args.tools.split(","))
+    results = {"commit": git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "repeat": args.repeat,
+                "scales": list()}
+
+    print("{:<10}{:<24}{:>10}{:>12}{:>10}  {}".format("scale", "benchmark", "wall_s",
+                                                    "peak_rss_mb", "mb_per_s", "status"))
+
+    for scale in args.scales.split(","):
+        samples, snps, loci = parse_scale(scale)
+        files, generate_s = dataset(args.workdir, scale, samples, snps, loci,
+                                    args.seed, args.regenerate)
+        record = {"scale": scale, "samples": samples, "snps": snps, "loci": loci,
+                "generate_s": round(generate_s, 3), "results": list()}
+
+        out = os.path.join(args.workdir, scale, "out")
+        shutil.rmtree(out, ignore_errors=True)
+        os.makedirs(out)
+        files["out"] = out
+
+        for name, script, arguments, measured in CASES:
+            if tools is not None and name not in tools:
+                continue
+            result = run_case(name, script, arguments, measured, files, args.repeat,
+                            SETUP.get(name, ()))
+            record["results"].append(result)
+            print("{:<10}{:<24}{:>10}{:>12}{:>10}  {}".format(scale, name,
+                    result["wall_s"], result["peak_rss_mb"], result["mb_per_s"], result["status"]))
+
+        results["scales"].append(record)
+
+    outfile = args.out or os.path.join(BENCH_DIR, "results", results["commit"] + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+    with open(outfile, "w") as fout:
+        json.dump(results, fout, indent=1)
+    print("\nResults written to " + outfile)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as fin:
+            baseline = json.load(fin)
+        regressions = compare(baseline, results, args.tolerance)
+        return 1 if regressions else 0
+
+    return 0
+
+
+def parse_scale(scale):
+    """
+    Function to get the dimensions of a named scale or a SAMPLESxSNPS string.
+    Input:
+        scale (string)
+    Returns:
+        tuple: (samples, SNPs, loci)
+    """
+    if scale in SCALES:
+        return SCALES[scale]
+    try:
+        samples, snps = (int(value) for value in scale.lower().split("x"))
+    except ValueError:
+        raise SystemExit("Error: Unknown scale '{}'; use one of {} or SAMPLESxSNPS".format(
+                        scale, ", ".join(SCALES)))
+    return samples, snps, max(1, snps // SNPS_PER_LOCUS)
+
+
+def dataset(workdir, scale, samples, snps, loci, seed, regenerate=False):
+    """
+    Function to simulate a dataset once per scale and reuse it afterwards.
+    Input:
+        workdir: directory holding one subdirectory per scale (string)
+        scale: scale name (string)
+        samples, snps, loci: dimensions (int)
+        seed: random seed (int)
+        regenerate: simulate again even if the files exist (bool)
+    Returns:
+        tuple: (dict of file type -> path, seconds spent simulating)
+    """
+    prefix = os.path.join(workdir, scale, "sim")
+    index = prefix + ".files.json"
+    key = [samples, snps, loci, seed]
+
+    if not regenerate and os.path.isfile(index):
+        with open(index, "r") as fin:
+            saved = json.load(fin)
+        if saved["key"] == key and all(os.path.exists(path) for path in saved["files"].values()):
+            return saved["files"], 0.0
+
+    # Simulated in a child process, so this process stays small: on Linux a
+    # child's peak RSS can include the memory of the parent it was forked from.
+    shutil.rmtree(os.path.join(workdir, scale), ignore_errors=True)
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, os.path.join(BENCH_DIR, "simpyrad.py"),
+                                    "-o", prefix, "-n", str(samples), "-s", str(snps),
+                                    "-l", str(loci), "--seed", str(seed)])
+    elapsed = time.perf_counter() - start
+    files = dict(line.split("\t", 1) for line in output.decode().splitlines())
+
+    with open(index, "w") as fout:
+        json.dump({"key": key, "files": files}, fout)
+    return files, elapsed
+
+
+def run_case(name, script, arguments, measured, files, repeat, setup=()):
+    """
+    Function to run one benchmark repeat times in a child process.
+    Input:
+        name: benchmark name (string)
+        script: script in the repository root (string)
+        arguments: argument templates (list)
+        measured: template of the input used for throughput (string)
+        files: file type -> path, including "out" (dict)
+        repeat: number of runs; the fastest wall time and the largest
+                peak RSS are kept (int)
+        setup: (script, arguments) commands run once beforehand (list)
+    Returns:
+        dict: benchmark result
+    """
+    result = {"benchmark": name, "command": None, "input_bytes": None,
+            "wall_s": None, "peak_rss_mb": None, "mb_per_s": None, "status": "ok"}
+
+    try:
+        command = [sys.executable, os.path.join(REPO_DIR, script)] + \
+                [argument.format(**files) for argument in arguments]
+        measured = measured.format(**files)
+        prepare = [[sys.executable, os.path.join(REPO_DIR, setup_script)] +
+                    [argument.format(**files) for argument in setup_arguments]
+                    for setup_script, setup_arguments in setup]
+    except KeyError as e:
+        result["status"] = "skipped: no {} file".format(e)
+        return result
+
+    result["command"] = " ".join(command)
+    for setup_command in prepare:
+        returncode = subprocess.call(setup_command, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+        if returncode != 0:
+            result["status"] = "setup exit status {}".format(returncode)
+            return result
+    if not os.path.exists(measured):
+        result["status"] = "skipped: {} missing".format(measured)
+        return result
+    result["input_bytes"] = os.path.getsize(measured)
+
+    walls = list()
+    peaks = list()
+    for i in range(repeat):
+        wall, peak, returncode = measure(command)
+        if returncode != 0:
+            result["status"] = "exit status {}".format(returncode)
+            return result
+        walls.append(wall)
+        peaks.append(peak)
+
+    result["wall_s"] = round(min(walls), 4)
+    result["peak_rss_mb"] = round(max(peaks), 1)
+    result["mb_per_s"] = round(result["input_bytes"] / 1e6 / max(min(walls), 1e-9), 2)
+    return result
+
+
+def measure(command):
+    """
+    Function to run a command and measure it with wait4(), so peak RSS is
+    that of this child alone.
+    Input:
+        command (list)
+    Returns:
+        tuple: (wall seconds (float), peak RSS in MB (float), exit status (int))
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return wall, usage.ru_maxrss / scale, proc.returncode
+
+
+def compare(baseline, results, tolerance):
+    """
+    Function to print wall time and peak RSS relative to a baseline run and
+    flag benchmarks that got slower or larger by more than tolerance.
+    Input:
+        baseline, results: parsed result files (dict)
+        tolerance: allowed relative increase (float)
+    Returns:
+        list of (scale, benchmark, metric) regressions
+    """
+    before = {(scale["scale"], result["benchmark"]): result
+            for scale in baseline["scales"] for result in scale["results"]}
+    regressions = list()
+
+    print("\nCompared with {} ({}):".format(baseline.get("commit"), baseline.get("timestamp")))
+    print("{:<10}{:<24}{:>10}{:>12}".format("scale", "benchmark", "wall", "peak_rss"))
+
+    for scale in results["scales"]:
+        for result in scale["results"]:
+            old = before.get((scale["scale"], result["benchmark"]))
+            if old is None or old["wall_s"] is None or result["wall_s"] is None:
+                continue
+            ratios = list()
+            for metric in ("wall_s", "peak_rss_mb"):
+                ratio = result[metric] / max(old[metric], 1e-9)
+                ratios.append("{:.2f}x".format(ratio))
+                if ratio > 1 + tolerance:
+                    regressions.append((scale["scale"], result["benchmark"], metric))
+            print("{:<10}{:<24}{:>10}{:>12}".format(scale["scale"], result["benchmark"], *ratios))
+
+    for scale, name, metric in regressions:
+        print("Regression: {} {} {}".format(scale, name, metric))
+    return regressions
+
+
+def git_commit():
+    """
+    Function to get the short hash of the checked-out commit.
+    Returns:
+        string ("unknown" outside a git checkout)
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                        cwd=REPO_DIR, stderr=subprocess.DEVNULL)
+        return commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def Get_Arguments():
+    """
+    Parse command-line arguments. Imported with argparse.
+    Returns: object of command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Times and memory-profiles the "
+                                    "ddrad_scripts tools on simulated pyRAD data",
+                                    add_help=False)
+
+    optional_args = parser.add_argument_group("Optional Arguments")
+
+    optional_args.add_argument("-s", "--scales",
+                                type=str,
+                                default=DEFAULT_SCALES,
+                                help="Comma-separated scales: " + ", ".join(
+                                "{} ({}x{})".format(name, dims[0], dims[1])
+                                for name, dims in SCALES.items()) +
+                                ", or SAMPLESxSNPS; default = " + DEFAULT_SCALES)
+    optional_args.add_argument("-t", "--tools",
+                                type=str,
+                                default=None,
+                                help="Comma-separated benchmarks to run; default = all (" +
+                                ",".join(case[0] for case in CASES) + ")")
+    optional_args.add_argument("-r", "--repeat",
+                                type=int,
+                                default=3,
+                                help="Runs per benchmark; default = 3")
+    optional_args.add_argument("-w", "--workdir",
+                                type=str,
+                                default=os.path.join(BENCH_DIR, "data"),
+                                help="Directory for simulated data, reused between "
+                                "runs; default = benchmarks/data")
+    optional_args.add_argument("-o", "--out",
+                                type=str,
+                                default=None,
+                                help="Result file; default = benchmarks/results/COMMIT.json")
+    optional_args.add_argument("-c", "--compare",
+                                type=str,
+                                default=None,
+                                help="Earlier result file to compare against; exit "
+                                "status is 1 if any benchmark regressed")
+    optional_args.add_argument("--tolerance",
+                                type=float,
+                                default=0.1,
+                                help="Relative increase in wall time or peak RSS "
+                                "reported as a regression; default = 0.1")
+    optional_args.add_argument("--regenerate",
+                                action="store_true",
+                                default=False,
+                                help="Simulate the datasets again")
+    optional_args.add_argument("--seed",
+                                type=int,
+                                default=1,
+                                help="Random seed for the simulated data; default = 1")
+    optional_args.add_argument("-h", "--help",
+                                action="help",
+                                help="Displays this help menu")
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+
+    rtrn_code = main()
+    sys.exit(rtrn_code)
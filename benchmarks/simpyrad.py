@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+### Synthetic pyRAD dataset generator for the ddrad_scripts benchmarks.
+### Writes a .snps file, a .stats file, a .loci file, a directory of
+### per-locus NEXUS files with a matching IQ-TREE log, a popmap and a
+### species map, all drawn from the same simulated genotypes.
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import genomatrix
+import splitLoci
+
+# Genotypes simulated per vectorized step; bounds the temporary random arrays
+CHUNK_CELLS = 8 * 1024 * 1024
+
+# Index -> base, and the IUPAC code for each pair of distinct bases
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+HETEROZYGOTES = np.frombuffer(b"AMRW"
+                            b"MCSY"
+                            b"RSGK"
+                            b"WYKT", dtype=np.uint8).reshape(4, 4)
+
+# Width of the sample name column in .snps and .loci files
+NAME_WIDTH = 16
+
+FILE_TYPES = ("snps", "stats", "loci", "log", "popmap")
+
+
+def main():
+
+    args = Get_Arguments()
+
+    files = simulate(args.out, args.samples, args.sites, args.loci,
+                    missing=args.missing, populations=args.populations,
+                    locus_length=args.locus_length, loci_records=args.loci_records,
+                    heterozygosity=args.heterozygosity, uninformative=args.uninformative,
+                    seed=args.seed,
+                    types=args.types.split(","))
+
+    for kind, path in sorted(files.items()):
+        print("{}\t{}".format(kind, path))
+
+    return 0
+
+
+class SimulatedData(object):
+    """
+    Shape and per-site parameters of a simulated dataset.
+    Attributes:
+        names: sample names, in row order (list)
+        populations: population of each sample (list)
+        offsets: locus start offsets plus the final end offset (np.ndarray)
+        ref, alt: reference and alternate base index per site (np.ndarray)
+        freq: alternate allele frequency per site (np.ndarray)
+        sample_missing: probability that a sample lacks a locus (np.ndarray)
+    """
+
+    def __init__(self, nsamples, nsites, nloci, missing, npops, heterozygosity,
+                uninformative, rng):
+        nloci = max(1, min(nloci, nsites))
+        # Every locus has at least one SNP; the rest are spread at random
+        lengths = 1 + rng.multinomial(nsites - nloci, np.full(nloci, 1.0 / nloci))
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+        self.populations = ["P{:03d}".format(i % npops + 1) for i in range(nsamples)]
+        self.names = ["{}_{:06d}".format(pop, i + 1) for i, pop in enumerate(self.populations)]
+
+        self.ref = rng.integers(0, 4, nsites)
+        self.alt = (self.ref + rng.integers(1, 4, nsites)) % 4
+        self.freq = rng.uniform(0.02, 0.5, nsites)
+        # Invariant loci, so IQ-TREE logs and --native have loci to blacklist
+        invariant = rng.random(nloci) < uninformative
+        self.freq[np.repeat(invariant, lengths)] = 0
+        self.sample_missing = np.clip(rng.uniform(0, 2 * missing, nsamples), 0, 0.95)
+        self.heterozygosity = heterozygosity
+
+    @property
+    def nsamples(self):
+        return len(self.names)
+
+    @property
+    def nsites(self):
+        return int(self.offsets[-1])
+
+    @property
+    def nloci(self):
+        return len(self.offsets) - 1
+
+    def genotypes(self, start, stop, rng):
+        """
+        Function to simulate a block of sample rows.
+        Input:
+            start, stop: sample row range (int)
+            rng: np.random.Generator
+        Returns:
+            tuple: (2D uint8 array of bases (sample x site),
+                    2D bool array of missing loci (sample x locus))
+        """
+        nrows = stop - start
+        alt = rng.random((nrows, self.nsites)) < self.freq
+        block = BASES[np.where(alt, self.alt, self.ref)]
+
+        het = rng.random((nrows, self.nsites)) < self.heterozygosity * self.freq
+        block[het] = np.broadcast_to(HETEROZYGOTES[self.ref, self.alt], block.shape)[het]
+
+        lacking = rng.random((nrows, self.nloci)) < self.sample_missing[start:stop, None]
+        block[np.repeat(lacking, np.diff(self.offsets), axis=1)] = ord("N")
+        return block, lacking
+
+
+def simulate(prefix, nsamples, nsites, nloci, missing=0.2, populations=10,
+            locus_length=64, loci_records=10000, heterozygosity=0.05,
+            uninformative=0.1, seed=None, types=FILE_TYPES):
+    """
+    Function to write a synthetic pyRAD dataset.
+    Input:
+        prefix: output prefix (string)
+        nsamples, nsites, nloci: dataset dimensions (int)
+        missing: mean proportion of loci missing per sample (float)
+        populations: number of populations (int)
+        locus_length: sequence length of each locus in the .loci output (int)
+        loci_records: loci written to the .loci file, the loci directory and
+                      the IQ-TREE log, which are one record per locus (int)
+        heterozygosity: scales the rate of IUPAC heterozygote calls (float)
+        uninformative: proportion of loci simulated without variation (float)
+        seed: random seed (int or None)
+        types: any of "snps", "stats", "loci", "log", "popmap" (list)
+    Returns:
+        dict: file type -> path
+    """
+    rng = np.random.default_rng(seed)
+    data = SimulatedData(nsamples, nsites, nloci, missing, populations, heterozygosity,
+                        uninformative, rng)
+    directory = os.path.dirname(os.path.abspath(prefix))
+    os.makedirs(directory, exist_ok=True)
+
+    files = dict()
+    records = min(loci_records, data.nloci)
+    kept_sites = int(data.offsets[records])
+    kept = np.empty((data.nsamples, kept_sites), dtype=np.uint8) if \
+            ("loci" in types or "log" in types) else None
+    loci_counts = np.empty(data.nsamples, dtype=np.int64)
+
+    fout = open(prefix + ".snps", "wb") if "snps" in types else None
+    if fout is not None:
+        files["snps"] = prefix + ".snps"
+        fout.write("## {} taxa, {} loci, {} snps\n".format(
+                    data.nsamples, data.nloci, data.nsites).encode())
+        # Row layout with ' _ ' between loci
+        site_cols = np.arange(data.nsites) + 3 * np.repeat(np.arange(data.nloci),
+                                                        np.diff(data.offsets))
+        separators = data.offsets[1:-1] + 3 * np.arange(data.nloci - 1) + 1
+        width = data.nsites + 3 * (data.nloci - 1)
+
+    chunk_rows = max(1, CHUNK_CELLS // data.nsites)
+    for start in range(0, data.nsamples, chunk_rows):
+        stop = min(start + chunk_rows, data.nsamples)
+        block, lacking = data.genotypes(start, stop, rng)
+        loci_counts[start:stop] = data.nloci - lacking.sum(axis=1)
+        if kept is not None:
+            kept[start:stop] = block[:, :kept_sites]
+        if fout is not None:
+            rows = np.full((stop - start, width), ord(" "), dtype=np.uint8)
+            rows[:, site_cols] = block
+            rows[:, separators] = ord("_")
+            for name, row in zip(data.names[start:stop], rows):
+                fout.write(name.ljust(NAME_WIDTH).encode())
+                fout.write(row.tobytes())
+                fout.write(b"\n")
+
+    if fout is not None:
+        fout.close()
+
+    if "stats" in types:
+        files["stats"] = write_stats(prefix + ".stats", data, loci_counts)
+
+    if "popmap" in types:
+        files["popmap"] = prefix + ".popmap"
+        files["species"] = prefix + ".species.txt"
+        with open(files["popmap"], "w") as pout, open(files["species"], "w") as sout:
+            for name, pop in zip(data.names, data.populations):
+                pout.write(name + "\t" + pop + "\n")
+                sout.write(name + "\tsp" + str(int(pop[1:]) % 2 + 1) + "\n")
+
+    if kept is not None:
+        files.update(write_loci(prefix, data, kept, records, locus_length, rng, types))
+
+    return files
+
+
+def write_stats(filename, data, loci_counts):
+    """
+    Function to write a pyRAD-style .stats file with per-sample locus counts.
+    Input:
+        filename (string)
+        data: SimulatedData
+        loci_counts: loci recovered per sample (np.ndarray)
+    Returns:
+        filename (string)
+    """
+    with open(filename, "w") as fout:
+        for label in ("", " & paralogs removed", " & paralogs removed & final filtering"):
+            fout.write("{:<10}## loci with > minsp containing data{}\n".format(data.nloci, label))
+        fout.write("\n## number of loci recovered in final data set for each taxon.\n")
+        fout.write("taxon\tnloci\n")
+        for name, count in zip(data.names, loci_counts):
+            fout.write("{}\t{}\n".format(name, count))
+        fout.write("\n\n")
+        fout.write("total var= {}\n".format(data.nsites))
+        fout.write("sampled unlinked SNPs= {}\n".format(data.nloci))
+    return filename
+
+
+def write_loci(prefix, data, kept, records, locus_length, rng, types):
+    """
+    Function to write the first records loci as a .loci file, as NEXUS files
+    in PREFIX_loci/ and as an IQ-TREE log warning about every locus without
+    parsimony-informative sites.
+    Input:
+        prefix (string)
+        data: SimulatedData
+        kept: bases of the first records loci (2D uint8 array)
+        records: number of loci written (int)
+        locus_length: sequence length of each locus (int)
+        rng: np.random.Generator
+        types: requested file types (list)
+    Returns:
+        dict: file type -> path
+    """
+    files = dict()
+    loci_dir = prefix + "_loci"
+    if "log" in types:
+        os.makedirs(loci_dir, exist_ok=True)
+        files["loci_dir"] = loci_dir
+        files["log"] = prefix + ".log"
+        log = open(files["log"], "w")
+        log.write("IQ-TREE multicore version 1.6.12 (simulated log)\n")
+        log.write("Reading partition model file {} ...\n".format(loci_dir))
+    if "loci" in types:
+        files["loci"] = prefix + ".loci"
+        lout = open(files["loci"], "wb")
+
+    names = [name.encode() for name in data.names]
+    for j in range(records):
+        start, stop = data.offsets[j], data.offsets[j + 1]
+        present = np.flatnonzero(kept[:, start] != ord("N"))
+        if not len(present):
+            continue
+        nsnps = stop - start
+        length = max(locus_length, nsnps)
+        block = np.tile(BASES[rng.integers(0, 4, length)], (len(present), 1))
+        block[:, np.sort(rng.choice(length, nsnps, replace=False))] = kept[present, start:stop]
+        locus_names = [names[i] for i in present]
+
+        if "loci" in types:
+            for name, row in zip(locus_names, block):
+                lout.write(b">" + name.ljust(NAME_WIDTH) + row.tobytes() + b"\n")
+            lout.write(b"//" + b" " * (NAME_WIDTH + length - 1) + "|{}|\n".format(j).encode())
+
+        if "log" in types:
+            locus = "locus{}".format(j)
+            with open(os.path.join(loci_dir, locus + ".nex"), "wb") as nout:
+                nout.write(splitLoci.render_nexus([name.decode() for name in locus_names], block))
+            variable, informative = genomatrix.count_informative_sites(block)
+            log.write("Subset\t{}\t{} sequences\t{} sites\n".format(locus, len(present), length))
+            if not informative:
+                log.write("WARNING: No parsimony-informative sites in partition {}\n".format(locus))
+
+    if "loci" in types:
+        lout.close()
+    if "log" in types:
+        log.write("Date and Time: Thu Jan  1 00:00:00 2026\n")
+        log.close()
+    return files
+
+
+def Get_Arguments():
+    """
+    Parse command-line arguments. Imported with argparse.
+    Returns: object of command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Writes a synthetic pyRAD dataset "
+                                    "(.snps, .stats, .loci, IQ-TREE log and loci "
+                                    "directory, popmap) for benchmarking",
+                                    add_help=False)
+
+    required_args = parser.add_argument_group("Required Arguments")
+    optional_args = parser.add_argument_group("Optional Arguments")
+
+    required_args.add_argument("-o", "--out",
+                                type=str,
+                                required=True,
+                                help="Output prefix")
+    optional_args.add_argument("-n", "--samples",
+                                type=int,
+                                default=100,
+                                help="Number of samples; default = 100")
+    optional_args.add_argument("-s", "--sites",
+                                type=int,
+                                default=10000,
+                                help="Number of SNPs; default = 10000")
+    optional_args.add_argument("-l", "--loci",
+                                type=int,
+                                default=2000,
+                                help="Number of loci; default = 2000")
+    optional_args.add_argument("-m", "--missing",
+                                type=float,
+                                default=0.2,
+                                help="Mean proportion of loci missing per sample; "
+                                "default = 0.2")
+    optional_args.add_argument("-p", "--populations",
+                                type=int,
+                                default=10,
+                                help="Number of populations; default = 10")
+    optional_args.add_argument("-L", "--locus_length",
+                                type=int,
+                                default=64,
+                                help="Sequence length per locus in the .loci file; "
+                                "default = 64")
+    optional_args.add_argument("-r", "--loci_records",
+                                type=int,
+                                default=10000,
+                                help="Loci written to the .loci file, loci directory "
+                                "and IQ-TREE log; default = 10000")
+    optional_args.add_argument("-z", "--heterozygosity",
+                                type=float,
+                                default=0.05,
+                                help="Scales the rate of heterozygous (IUPAC) calls; "
+                                "default = 0.05")
+    optional_args.add_argument("-u", "--uninformative",
+                                type=float,
+                                default=0.1,
+                                help="Proportion of loci without variation; default = 0.1")
+    optional_args.add_argument("-t", "--types",
+                                type=str,
+                                default=",".join(FILE_TYPES),
+                                help="Comma-separated files to write; default = " +
+                                ",".join(FILE_TYPES))
+    optional_args.add_argument("--seed",
+                                type=int,
+                                default=None,
+                                help="Random seed; default = None")
+    optional_args.add_argument("-h", "--help",
+                                action="help",
+                                help="Displays this help menu")
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+
+    rtrn_code = main()
+    sys.exit(rtrn_code)
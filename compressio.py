@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+
+### Transparent compressed input and output for the ddrad_scripts tools.
+### Inputs are detected from their magic bytes, so plain, gzip, bgzip and
+### zstd files are read the same way; outputs are compressed when their name
+### ends in .gz, .bgz or .zst. Where pigz, bgzip or zstd are installed, the
+### (de)compression runs in a separate multi-threaded process, so it overlaps
+### with parsing; otherwise the Python gzip module (or python-isal, or the
+### zstandard package) is used in-process. Outputs are written to a
+### temporary file next to the output, fsync'ed and renamed into place when
+### closed, so a killed job never leaves a truncated output behind; with
+### --checksum each output also gets a FILE.sum sidecar (see write_sidecar).
+
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Output extension -> codec
+EXTENSIONS = {".gz": "gzip", ".bgz": "bgzip", ".zst": "zstd"}
+
+# Threads given to pigz, bgzip and zstd; inherited by batch worker processes
+THREADS_ENV = "DDRAD_IO_THREADS"
+
+# gzip level used when compressing outputs (the gzip command-line default)
+GZIP_LEVEL = 6
+
+# Read/write buffer for compressed streams
+BUFFER_SIZE = 1024 * 1024
+
+# Set to write a checksum sidecar next to every output; inherited by batch
+# worker processes
+CHECKSUM_ENV = "DDRAD_CHECKSUM"
+SIDECAR_EXT = ".sum"
+
+# Chunk size when hashing outputs
+HASH_CHUNK = 4 * 1024 * 1024
+
+# Numbers the temporary files of this process
+_temp_ids = itertools.count()
+
+
+def get_threads():
+    """
+    Function to get the number of compression threads (see set_threads).
+    Returns:
+        int
+    """
+    try:
+        return max(1, int(os.environ.get(THREADS_ENV, 1)))
+    except ValueError:
+        return 1
+
+
+def set_threads(threads):
+    """
+    Function to set the number of compression threads. The value is kept in
+    the environment, so batch worker processes inherit it.
+    Input:
+        threads (int)
+    Returns:
+        None
+    """
+    os.environ[THREADS_ENV] = str(max(1, threads))
+
+
+def add_threads_argument(group):
+    """
+    Function to add the shared --io_threads option to an argparse parser or
+    argument group.
+    Input:
+        group: argparse parser or argument group
+    Returns:
+        None
+    """
+    group.add_argument("--io_threads",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="Threads for pigz, bgzip or zstd when reading or "
+                        "writing compressed files (.gz, .bgz, .zst); default = 1")
+
+
+def checksums_enabled():
+    """
+    Function to check whether outputs get checksum sidecars (see set_checksum).
+    Returns:
+        bool
+    """
+    return os.environ.get(CHECKSUM_ENV, "") not in ("", "0")
+
+
+def set_checksum(enabled):
+    """
+    Function to turn checksum sidecars on or off. The value is kept in the
+    environment, so batch worker processes inherit it.
+    Input:
+        enabled (bool)
+    Returns:
+        None
+    """
+    os.environ[CHECKSUM_ENV] = "1" if enabled else "0"
+
+
+def add_checksum_argument(group):
+    """
+    Function to add the shared --checksum option to an argparse parser or
+    argument group.
+    Input:
+        group: argparse parser or argument group
+    Returns:
+        None
+    """
+    group.add_argument("--checksum",
+                        action="store_true",
+                        default=False,
+                        help="Write FILE" + SIDECAR_EXT + " next to every output with its "
+                        "size, record count and checksum (xxhash if installed, otherwise "
+                        "BLAKE2); check outputs with: compressio.py FILE...")
+
+
+def detect(filename):
+    """
+    Function to detect the compression of a file from its magic bytes.
+    Input:
+        filename (string)
+    Returns:
+        "gzip", "bgzip", "zstd" or None for uncompressed files (string)
+    """
+    with open(filename, "rb") as fin:
+        head = fin.read(18)
+
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.startswith(GZIP_MAGIC):
+        # BGZF: gzip with the FEXTRA flag and a "BC" extra subfield
+        if len(head) >= 14 and head[3] & 4 and head[12:14] == b"BC":
+            return "bgzip"
+        return "gzip"
+    return None
+
+
+def is_compressed(filename):
+    """
+    Function to check whether an existing file is compressed.
+    Input:
+        filename (string)
+    Returns:
+        bool
+    """
+    return detect(filename) is not None
+
+
+def output_codec(filename):
+    """
+    Function to get the codec implied by an output filename's extension.
+    Input:
+        filename (string)
+    Returns:
+        "gzip", "bgzip", "zstd" or None (string)
+    """
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def split_extension(filename):
+    """
+    Function to split a compression extension off a filename, so derived
+    names keep it last: split_extension("out.csv.gz") -> ("out.csv", ".gz").
+    Input:
+        filename (string)
+    Returns:
+        tuple: (filename without compression extension, extension or "")
+    """
+    root, ext = os.path.splitext(filename)
+    if ext.lower() in EXTENSIONS:
+        return root, ext
+    return filename, ""
+
+
+def open_file(filename, mode="rb", threads=None, encoding=None, newline=None,
+                buffering=-1, sync=True, sync_dir=True):
+    """
+    Function to open a plain or compressed file like open(). Reading detects
+    the codec from the file's magic bytes; writing uses the extension and is
+    atomic (see AtomicWriter): the output only appears once the file is
+    closed without an error.
+    Input:
+        filename (string)
+        mode: "r", "rb", "rt", "w", "wb" or "wt" (string)
+        threads: compression threads, or None for get_threads() (int)
+        encoding, newline: as for open() in text mode
+        buffering: buffer size for uncompressed outputs, as for open() (int)
+        sync: fsync outputs before renaming them into place (bool)
+        sync_dir: also fsync the directory after the rename; callers writing
+                many files to one directory can fsync it once instead (bool)
+    Returns:
+        file object
+    """
+    if threads is None:
+        threads = get_threads()
+
+    text = "b" not in mode
+    if "r" in mode:
+        codec = detect(filename)
+        if codec is None:
+            return open(filename, mode, encoding=encoding, newline=newline)
+        stream = open_reader(filename, codec, threads)
+        if text:
+            return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+        return stream
+
+    codec = output_codec(filename)
+    if codec is None:
+        stream = open_atomic(filename, buffering, sync, sync_dir)
+    else:
+        temp = temp_name(filename)
+        stream = AtomicWriter(open_writer(temp, codec, threads, filename), temp, filename,
+                            sync, sync_dir)
+
+    if text:
+        return AtomicTextWriter(stream, encoding=encoding, newline=newline)
+    return stream
+
+
+def open_atomic(filename, buffering=-1, sync=True, sync_dir=True):
+    """
+    Function to open an uncompressed binary output atomically (see AtomicWriter).
+    Input:
+        filename (string)
+        buffering: buffer size, as for open() (int)
+        sync, sync_dir: as for open_file (bool)
+    Returns:
+        AtomicWriter
+    """
+    temp = temp_name(filename)
+    return AtomicWriter(open(temp, "wb", buffering=buffering), temp, filename, sync, sync_dir)
+
+
+def temp_name(filename):
+    """
+    Function to name the temporary file an output is written to: a hidden
+    .NAME.PID.N.tmp next to it, so it stays on the same file system for the
+    final rename.
+    Input:
+        filename (string)
+    Returns:
+        string
+    """
+    head, tail = os.path.split(filename)
+    return os.path.join(head, ".{}.{}.{}.tmp".format(tail, os.getpid(), next(_temp_ids)))
+
+
+def remove_temp(temp):
+    """
+    Function to remove a temporary file if it is still there (see temp_name).
+    Input:
+        temp (string)
+    Returns:
+        None
+    """
+    try:
+        os.remove(temp)
+    except FileNotFoundError:
+        pass
+
+
+def open_reader(filename, codec, threads):
+    """
+    Function to open a binary decompressing stream.
+    Input:
+        filename (string)
+        codec: "gzip", "bgzip" or "zstd" (string)
+        threads (int)
+    Returns:
+        binary file object
+    """
+    if codec == "bgzip" and shutil.which("bgzip"):
+        return PipeReader(["bgzip", "-dc", "-@", str(threads), filename])
+
+    if codec in ("gzip", "bgzip"):
+        if shutil.which("pigz"):
+            return PipeReader(["pigz", "-dc", "-p", str(threads), filename])
+        try:
+            from isal import igzip
+            return igzip.open(filename, "rb")
+        except ImportError:
+            return gzip.open(filename, "rb")
+
+    try:
+        import zstandard
+        fin = open(filename, "rb")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+                                fin, read_across_frames=True, closefd=True), BUFFER_SIZE)
+    except ImportError:
+        pass
+
+    if shutil.which("zstd"):
+        return PipeReader(["zstd", "-dcq", filename])
+
+    raise ImportError("Reading " + filename + " requires the zstandard package "
+                    "or the zstd command")
+
+
+def open_writer(filename, codec, threads, name=None):
+    """
+    Function to open a binary compressing stream.
+    Input:
+        filename (string)
+        codec: "gzip", "bgzip" or "zstd" (string)
+        threads (int)
+        name: output name recorded in a gzip header written in-process, when
+                filename is a temporary file (string or None)
+    Returns:
+        binary file object
+    """
+    if codec == "bgzip":
+        if not shutil.which("bgzip"):
+            raise OSError("Writing " + filename + " requires the bgzip command; "
+                        "use .gz for plain gzip output")
+        return PipeWriter(["bgzip", "-c", "-@", str(threads)], filename)
+
+    if codec == "gzip":
+        if shutil.which("pigz"):
+            return PipeWriter(["pigz", "-c", "-" + str(GZIP_LEVEL), "-p", str(threads)], filename)
+        fout = open(filename, "wb")
+        try:
+            from isal import igzip
+            stream = igzip.IGzipFile(name or filename, "wb", fileobj=fout)
+        except ImportError:
+            stream = gzip.GzipFile(name or filename, "wb", GZIP_LEVEL, fout)
+        # Closed with the stream, as by gzip.open()
+        stream.myfileobj = fout
+        return stream
+
+    try:
+        import zstandard
+        fout = open(filename, "wb")
+        compressor = zstandard.ZstdCompressor(threads=threads if threads > 1 else 0)
+        return io.BufferedWriter(compressor.stream_writer(fout, closefd=True), BUFFER_SIZE)
+    except ImportError:
+        pass
+
+    if shutil.which("zstd"):
+        return PipeWriter(["zstd", "-cq", "-T" + str(threads)], filename)
+
+    raise ImportError("Writing " + filename + " requires the zstandard package "
+                    "or the zstd command")
+
+
+class AtomicWriter(io.BufferedIOBase):
+    """
+    Binary output written to a temporary file. close() flushes and fsyncs
+    it, renames it over the output name and, with --checksum, writes the
+    sidecar. Leaving a with block on an exception, or discard(), removes the
+    temporary file instead, as does garbage collection of an unclosed writer.
+    Attributes:
+        name: output filename (string)
+        temp: temporary filename being written (string)
+        records: lines written, unless set by the caller (int)
+    """
+
+    def __init__(self, stream, temp, filename, sync=True, sync_dir=True):
+        io.BufferedIOBase.__init__(self)
+        self.stream = stream
+        self.temp = temp
+        self.name = filename
+        self.sync = sync
+        self.sync_dir = sync and sync_dir
+        self.records = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return self.stream.seekable()
+
+    def write(self, data):
+        self.records += data.count(b"\n")
+        return self.stream.write(data)
+
+    def flush(self):
+        if not self.stream.closed:
+            self.stream.flush()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.stream.close()
+            if self.sync:
+                fsync_path(self.temp)
+            # A sidecar from an earlier run must not vouch for the new file
+            remove_sidecar(self.name)
+            os.replace(self.temp, self.name)
+            remove_temp(self.temp)
+        except BaseException:
+            self.discard()
+            raise
+        io.BufferedIOBase.close(self)
+        if self.sync_dir:
+            fsync_path(os.path.dirname(os.path.abspath(self.name)))
+        if checksums_enabled():
+            write_sidecar(self.name, self.records)
+
+    def discard(self):
+        """
+        Function to close the writer without publishing the output.
+        Returns:
+            None
+        """
+        if self.closed:
+            return
+        try:
+            self.stream.close()
+        except (OSError, ValueError):
+            pass
+        remove_temp(self.temp)
+        io.BufferedIOBase.close(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+        return False
+
+    def __del__(self):
+        self.discard()
+
+
+class AtomicTextWriter(io.TextIOWrapper):
+    """
+    Text wrapper over an AtomicWriter that discards the output when its with
+    block exits on an exception or it is garbage collected unclosed.
+    """
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.buffer.discard()
+        else:
+            self.close()
+        return False
+
+    def __del__(self):
+        try:
+            self.buffer.discard()
+        except (AttributeError, ValueError):
+            pass
+
+
+def fsync_path(path):
+    """
+    Function to flush a file or directory to disk. Directories cannot be
+    opened on some platforms; those are skipped.
+    Input:
+        path (string)
+    Returns:
+        None
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def new_hash():
+    """
+    Function to get the fastest available checksum: xxhash's XXH3 (128 bit)
+    if the xxhash package is installed, otherwise BLAKE2b from hashlib.
+    Returns:
+        tuple: (algorithm name (string), hash object)
+    """
+    try:
+        import xxhash
+        return "xxh3_128", xxhash.xxh3_128()
+    except (ImportError, AttributeError):
+        return "blake2b", hashlib.blake2b(digest_size=16)
+
+
+def file_checksum(filename, algorithm=None):
+    """
+    Function to hash a file's bytes as stored (compressed outputs are not
+    decompressed).
+    Input:
+        filename (string)
+        algorithm: "xxh3_128", "blake2b" or None for the fastest available
+    Returns:
+        tuple: (algorithm name (string), hex digest (string))
+    """
+    if algorithm == "blake2b":
+        digest = hashlib.blake2b(digest_size=16)
+    elif algorithm == "xxh3_128":
+        import xxhash
+        digest = xxhash.xxh3_128()
+    else:
+        algorithm, digest = new_hash()
+
+    with open(filename, "rb") as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return algorithm, digest.hexdigest()
+
+
+def sidecar_name(filename):
+    """
+    Function to name the checksum sidecar of an output.
+    Input:
+        filename (string)
+    Returns:
+        string
+    """
+    return filename + SIDECAR_EXT
+
+
+def remove_sidecar(filename):
+    """
+    Function to remove the sidecar of an output that is about to be replaced,
+    so is_complete() never checks the new file against the old sidecar.
+    Input:
+        filename: output filename (string)
+    Returns:
+        None
+    """
+    try:
+        os.remove(sidecar_name(filename))
+    except FileNotFoundError:
+        pass
+
+
+def write_sidecar(filename, records=None):
+    """
+    Function to write FILE.sum: a JSON object with the output's name, size,
+    record count (lines, or rows for binary alignments) and checksum. It is
+    written after the output is in place, so an output with a matching
+    sidecar is complete.
+    Input:
+        filename: output filename (string)
+        records (int or None)
+    Returns:
+        None
+    """
+    algorithm, checksum = file_checksum(filename)
+    save_sidecar(filename, {"size": os.path.getsize(filename),
+                            "records": records,
+                            "algorithm": algorithm,
+                            "checksum": checksum})
+
+
+def save_sidecar(filename, record):
+    """
+    Function to write the sidecar of an output atomically, naming the output
+    in its "file" field (see write_sidecar). Sidecars get no sidecar of their own.
+    Input:
+        filename: output filename (string)
+        record: size, records, algorithm and checksum (dict)
+    Returns:
+        None
+    """
+    fields = [(key, value) for key, value in record.items() if key != "file"]
+    record = dict([("file", os.path.basename(filename))] + fields)
+    temp = temp_name(sidecar_name(filename))
+    try:
+        with open(temp, "w") as fout:
+            json.dump(record, fout)
+        os.replace(temp, sidecar_name(filename))
+    finally:
+        remove_temp(temp)
+
+
+def is_complete(filename, verify=False):
+    """
+    Function to check an output against its sidecar: with one stat and one
+    small read by default, or by rehashing the file with verify=True.
+    Input:
+        filename (string)
+        verify: also compare the checksum (bool)
+    Returns:
+        bool
+    """
+    try:
+        with open(sidecar_name(filename), "r") as fin:
+            record = json.load(fin)
+        if os.path.getsize(filename) != record["size"]:
+            return False
+        if verify:
+            return file_checksum(filename, record["algorithm"])[1] == record["checksum"]
+        return True
+    except (OSError, ValueError, KeyError, ImportError):
+        return False
+
+
+class PipeReader(io.BufferedReader):
+    """
+    Buffered reader over the stdout of a decompression command. Closing the
+    reader before the end of the stream stops the command.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        io.BufferedReader.__init__(self, self.proc.stdout.detach(), BUFFER_SIZE)
+
+    def close(self):
+        if self.closed:
+            return
+        io.BufferedReader.close(self)
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        elif self.proc.returncode != 0:
+            raise OSError("{} failed: {}".format(" ".join(self.command),
+                        self.proc.stderr.read().decode().strip()))
+        self.proc.stderr.close()
+
+
+class PipeWriter(io.BufferedWriter):
+    """
+    Buffered writer into the stdin of a compression command whose stdout is
+    the output file.
+    """
+
+    def __init__(self, command, filename):
+        self.command = command
+        self.fout = open(filename, "wb")
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.fout,
+                                    stderr=subprocess.PIPE)
+        io.BufferedWriter.__init__(self, self.proc.stdin.detach(), BUFFER_SIZE)
+
+    def close(self):
+        if self.closed:
+            return
+        io.BufferedWriter.close(self)
+        self.proc.wait()
+        self.fout.close()
+        if self.proc.returncode != 0:
+            raise OSError("{} failed: {}".format(" ".join(self.command),
+                        self.proc.stderr.read().decode().strip()))
+        self.proc.stderr.close()
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Checks outputs against their "
+                                    "FILE" + SIDECAR_EXT + " checksum sidecars; exits with "
+                                    "status 1 if any output is missing, incomplete or changed")
+    parser.add_argument("files", nargs="+", help="Output files")
+    parser.add_argument("-v", "--verify", action="store_true", default=False,
+                        help="Rehash every file instead of comparing sizes only")
+    args = parser.parse_args()
+
+    bad = 0
+    for filename in args.files:
+        ok = is_complete(filename, args.verify)
+        bad += not ok
+        print("{}\t{}".format(filename, "OK" if ok else "FAILED"))
+    sys.exit(1 if bad else 0)
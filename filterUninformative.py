@@ -1,39 +1,212 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import errno
+import functools
+import json
 import os
+import re
 import shutil
 import sys
+import time
+
+import batchrun
+import compressio
+import genomatrix
+import profiling
+
+# Files handed to a mover thread at a time
+MOVE_BATCH_SIZE = 256
+
+# Alignment extensions stripped when matching IQ-TREE partition names to files
+LOCUS_EXTS = (".nex", ".nexus", ".nxs", ".phy", ".phylip", ".fa", ".fas", ".fasta")
+
+# Number of unmatched names listed before moving anything
+MAX_MISSING_REPORTED = 10
+
+# Loci files handed to a --native worker process at a time
+SITE_COUNT_CHUNK = 64
+
+# Bytes read from the IQ-TREE log per bulk regex scan
+LOG_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Last whitespace-delimited token of every "WARNING: No " line
+WARNING_RE = re.compile(rb"^WARNING: No (?:[^\n]*[ \t])?(\S+)[ \t\r]*$", re.M)
+
+# Final line IQ-TREE writes to its log; ends --follow
+IQTREE_END_RE = re.compile(rb"^Date and Time:", re.M)
 
 
 def main():
 
 	arguments = Get_Arguments()
+	compressio.set_threads(arguments.io_threads)
+	compressio.set_checksum(arguments.checksum)
+
+	if arguments.log is not None:
+		input_attr = "log"
+		logs = batchrun.expand_inputs(arguments.log)
+	elif arguments.native or arguments.rollback:
+		# Without a log, --native and --rollback run once on the loci directory.
+		input_attr = "dir"
+		logs = [arguments.dir]
+	else:
+		print("\nError: -l/--log is required unless --native or --rollback is given\n")
+		return 1
 
-	locidir = arguments.dir
+	# Every per-log output must be templated when several logs are given.
+	template_attrs = ["view_dir", "include_list", "partition_file", "checkpoint"]
+	if not (arguments.view_dir or arguments.include_list or arguments.partition_file):
+		template_attrs.append("blacklist_dir")
+
+	try:
+		namespaces = batchrun.per_input_arguments(arguments, input_attr, logs,
+													template_attrs, ["dir"])
+	except ValueError as e:
+		print("\nError: " + str(e) + "\n")
+		return 1
+
+	return batchrun.run_batch(filter_log, namespaces, logs, arguments.jobs)
+
+def filter_log(arguments):
+# Blacklists the loci reported in one IQ-TREE log.
+# Arguments:
+#       argparse namespace holding a single log file and its directories
+# Returns:
+#       int: 0 if no errors, 1 if error occurred.
+
+	try:
+		locidir = dir_path(arguments.dir)
+	except NotADirectoryError:
+		print("\nError: The loci directory " + arguments.dir + " does not exist.\n")
+		return 1
 	blacklist_dir = arguments.blacklist_dir
 
+	if arguments.rollback:
+		return rollback_blacklisted(locidir, blacklist_dir, arguments.threads)
+
 	# Validate that input file exists.
-	check_code = check_if_file_exists(arguments.log)
-	if check_code == 1:
-		return 1 # Die if input file doesn't exist.
+	if not arguments.native:
+		check_code = check_if_file_exists(arguments.log)
+		if check_code == 1:
+			return 1 # Die if input file doesn't exist.
+
+	virtual = arguments.view_dir or arguments.include_list or arguments.partition_file
+	resume = arguments.resume
+
+	# Index the loci directory before following the log, so loci moved while
+	# following are still counted.
+	with profiling.stage("index"):
+		index = index_loci_dir(locidir)
+	file_count = sum(len(files) for files in index.values())
+	profiling.count("index", file_count)
 
 	# Get filenames for bad loci from IQ-TREE log file.
 	blacklist = list()
-	blacklist = get_bad_files(arguments.log)
+	if arguments.native:
+		# Compute the blacklist from the loci themselves instead of a log.
+		with profiling.stage("scan"):
+			blacklist = get_uninformative_loci(locidir, index, arguments.min_pis,
+												arguments.processes)
+		profiling.count("scan", file_count)
+	elif arguments.follow:
+		if compressio.is_compressed(arguments.log):
+			print("\nError: --follow cannot be used with a compressed log\n")
+			return 1
+		callback = None
+		if not virtual:
+			# Move loci as IQ-TREE reports them; the final pass below resumes
+			# from the manifest to catch anything left.
+			if make_blacklist_dir(blacklist_dir, resume) == 1:
+				return 1
+			resume = True
+			callback = functools.partial(move_new_names, index=index, moved=set(),
+										dir=locidir, b_dir=blacklist_dir,
+										threads=arguments.threads)
+		with profiling.stage("scan"):
+			blacklist = follow_log(arguments.log, arguments.checkpoint,
+									arguments.interval, arguments.follow_timeout, callback)
+		profiling.count_files("scan", [arguments.log], len(blacklist))
+	else:
+		with profiling.stage("scan"):
+			blacklist = get_bad_files(arguments.log, arguments.checkpoint)
+		profiling.count_files("scan", [arguments.log], len(blacklist))
 
 	# Abort if there were no uninformative/invariant sites.
 	if not blacklist:
 		print("No blacklisted loci were found in log file. Aborting program.")
 		return 1
 
-	print("\n\nSearching for log file in parent directory: " + \
-			os.path.abspath(os.path.join(locidir, os.pardir)) + "\n")
+	if not arguments.native:
+		print("\n\nSearching for log file in parent directory: " + \
+				os.path.abspath(os.path.join(locidir, os.pardir)) + "\n")
 
 	print("Directory containing loci files (must be located within parent "
 			"directory): " + locidir  + "\n")
 
-	check_code = move_blacklisted(blacklist, locidir, blacklist_dir)
+	# Resolve the blacklist against one scan of the loci directory.
+	with profiling.stage("resolve"):
+		matched, missing, duplicates = resolve_blacklist(blacklist, index)
+	profiling.count("resolve", len(blacklist))
+
+	# On --resume, loci moved by an earlier run are recorded in the manifest
+	# rather than found in the loci directory.
+	already_moved = list()
+	if resume and not virtual:
+		recorded = read_manifest(manifest_path(os.path.join(os.getcwd(), blacklist_dir)))
+		moved_keys = set(locus_key(src) for src, dst in recorded)
+		already_moved = [name for name in missing if locus_key(name) in moved_keys]
+		missing = [name for name in missing if locus_key(name) not in moved_keys]
+
+	print("{} blacklisted names ({} duplicates); {} match loci "
+			"files, {} not found in {}\n".format(len(blacklist), duplicates,
+			len(matched), len(missing), locidir))
+	if already_moved:
+		print("{} were already moved by an earlier run\n".format(len(already_moved)))
+	for name in missing[:MAX_MISSING_REPORTED]:
+		print("\tNot found: {}".format(name))
+	if len(missing) > MAX_MISSING_REPORTED:
+		print("\t...and {} more".format(len(missing) - MAX_MISSING_REPORTED))
+
+	if not matched:
+		if already_moved:
+			# Resuming a finished run is a no-op, so a retried step succeeds.
+			print("All blacklisted loci were already moved to {}; nothing to "
+					"resume.\n".format(blacklist_dir))
+			return 0
+		print("No blacklisted loci were found in {}. Aborting program.".format(locidir))
+		return 1
+
+	# Virtual blacklist: leave the loci directory untouched and only
+	# build a view and/or include lists of the informative loci.
+	if virtual:
+		blacklisted = set(matched)
+		# Only alignments go into the view and lists, not READMEs or logs
+		keepers = sorted(file for files in index.values() for file in files
+						if file not in blacklisted
+						and os.path.splitext(file)[1].lower() in LOCUS_EXTS)
+		print("{} informative loci retained\n".format(len(keepers)))
+
+		if arguments.include_list or arguments.partition_file:
+			with profiling.stage("write"):
+				write_include_list(keepers, locidir, arguments.include_list,
+									arguments.partition_file)
+			profiling.count_files("write", [arguments.include_list,
+									arguments.partition_file], len(keepers))
+
+		if arguments.view_dir:
+			with profiling.stage("link"):
+				check_code = build_view(keepers, locidir, arguments.view_dir,
+										arguments.link_type, arguments.threads)
+			profiling.count("link", len(keepers))
+			return check_code
+		return 0
+
+	with profiling.stage("move"):
+		check_code = move_blacklisted(matched, locidir, blacklist_dir,
+										arguments.threads, resume, file_count)
+	profiling.count("move", len(matched))
 	if check_code == 1:
 		return 1
 
@@ -50,69 +223,624 @@ def dir_path(string):
 	else:
 		raise NotADirectoryError(string)
 
-def move_blacklisted(list_of_files, dir, b_dir):
-# Creates blacklist directory and moves blacklisted files to it.
+def move_blacklisted(list_of_files, dir, b_dir, threads=8, resume=False,
+						file_count=None):
+# Creates blacklist directory and moves blacklisted files to it in parallel.
+# Each completed move is appended to a manifest (see manifest_path) so an
+# interrupted run can be resumed with --resume or undone with --rollback.
 # Arguments:
 #       list of blacklisted filenames
-#       parent directory path
+#       loci directory path
 #       blacklist directory name; goes in parent directory
+#       number of mover threads
+#       bool: continue a previous run recorded in the manifest
+#       number of files in the loci directory before moving; rescanned if None
 # Returns:
 #       int: 0 if no errors, 1 if error occurred.
 
 	parent_dir = os.getcwd() # Get path to parent directory
+	blist_dir = os.path.join(parent_dir, b_dir)
+	manifest = manifest_path(blist_dir)
+
+	if make_blacklist_dir(b_dir, resume) == 1:
+		return 1
+
+	already_moved = set()
+	if resume:
+		already_moved = set(os.path.basename(src) for src, dst in read_manifest(manifest))
+		print("Resuming: {} loci files already recorded in {}\n".format(
+				len(already_moved), manifest))
+
+	pending = [file for file in list_of_files if file not in already_moved]
+
+	# Same filesystem: a rename is a metadata-only operation.
+	same_fs = os.stat(dir).st_dev == os.stat(blist_dir).st_dev
+
+	print("Moving blacklisted loci files to " + blist_dir, end="...\n")
+
+	moved, failed, elapsed = run_moves(pending, os.path.abspath(dir), blist_dir,
+										manifest, same_fs, threads)
+
+	print("DONE!!!\n")
+	print("Moved {} loci files to {} directory ({:.1f} files/s)\n".format(
+			moved, b_dir, moved / elapsed if elapsed > 0 else float(moved)))
+	if failed:
+		print("Failed to move {} loci files; rerun with --resume to retry or "
+				"--rollback to undo\n".format(failed))
+	print("Manifest of moved files written to {}\n".format(manifest))
+	if file_count is None:
+		remaining_file_count = len([name for name in os.listdir(dir)
+									if os.path.isfile(os.path.join(dir, name))])
+	else:
+		# Files skipped on resume were moved after the directory was indexed.
+		remaining_file_count = file_count - moved - (len(list_of_files) - len(pending))
+	print("{} loci files remain in {}\n".format(remaining_file_count, dir))
 
-	# Creates blacklist DIR; Aborts if blacklist directory already exists
+	if failed:
+		return 1
+	return 0
+
+def make_blacklist_dir(b_dir, resume=False):
+# Creates blacklist DIR; Aborts if blacklist directory already exists
+# unless resuming a previous run.
+# Arguments:
+#       blacklist directory name
+#       bool: allow an existing directory
+# Returns:
+#       int: 0 if no errors, 1 if error occurred.
 	if not os.path.exists(b_dir):
 		try:
 			os.mkdir(b_dir)
 		except OSError:
 			print("Creation of the directory '%s' failed." % b_dir)
+			return 1
 		else:
 			print("Successfully created the blacklist directory\n")
-	else:
+	elif not resume:
 		print("Error: Blacklist directory '%s' already exists." % b_dir)
 		return 1
+	return 0
+
+def move_new_names(names, index, moved, dir, b_dir, threads):
+# Moves loci for partition names reported since the last poll of the log.
+# Arguments:
+#       list of new partition names
+#       index from index_loci_dir()
+#       set of locus keys already handled; updated in place
+#       loci directory path
+#       blacklist directory name; in parent directory
+#       number of mover threads
+	new_names = [name for name in names if locus_key(name) not in moved]
+	moved.update(locus_key(name) for name in new_names)
+	matched, missing, duplicates = resolve_blacklist(new_names, index)
+	if not matched:
+		return
+
+	blist_dir = os.path.join(os.getcwd(), b_dir)
+	same_fs = os.stat(dir).st_dev == os.stat(blist_dir).st_dev
+	count, failed, elapsed = run_moves(matched, os.path.abspath(dir), blist_dir,
+										manifest_path(blist_dir), same_fs, threads)
+	print("Blacklisted {} loci as IQ-TREE reported them ({} failed)".format(count, failed))
+
+def rollback_blacklisted(dir, b_dir, threads=8):
+# Moves every file recorded in the blacklist manifest back to the loci directory.
+# Arguments:
+#       loci directory path
+#       blacklist directory name; in parent directory
+#       number of mover threads
+# Returns:
+#       int: 0 if no errors, 1 if error occurred.
+
+	blist_dir = os.path.join(os.getcwd(), b_dir)
+	manifest = manifest_path(blist_dir)
+
+	if not os.path.isfile(manifest):
+		print("Error: No manifest found at {}".format(manifest))
+		return 1
 
-	print("Changing into loci directory", end="...")
-	os.chdir(dir) # Changes directory to argument passed for '--dir'
-	print("DONE!\n")
+	names = [os.path.basename(dst) for src, dst in read_manifest(manifest)]
+	same_fs = os.stat(dir).st_dev == os.stat(blist_dir).st_dev
+	rollback_manifest = manifest + ".rollback"
 
-	blist_dir = parent_dir + "/" + b_dir + "/"
+	print("Moving {} loci files back to {}".format(len(names), dir), end="...\n")
 
-	print("Moving blacklisted loci files to " + parent_dir + "/" + b_dir, end="...\n")
+	moved, failed, elapsed = run_moves(names, blist_dir, os.path.abspath(dir),
+										rollback_manifest, same_fs, threads)
 
-	# Moves the files in list_of_files to blacklist DIR
-	for file in list_of_files:
+	print("Restored {} loci files to {} ({:.1f} files/s)\n".format(
+			moved, dir, moved / elapsed if elapsed > 0 else float(moved)))
+
+	if failed:
+		print("Failed to restore {} loci files; see {}\n".format(failed, rollback_manifest))
+		return 1
+
+	os.remove(manifest)
+	os.remove(rollback_manifest)
+
+	# Remove the blacklist directory if the rollback emptied it.
+	try:
+		os.rmdir(blist_dir)
+	except OSError:
+		pass
+
+	return 0
+
+def run_moves(names, src_dir, dst_dir, manifest, same_fs, threads):
+# Moves files in batches on a thread pool; completed moves are appended to
+# the manifest as each batch finishes.
+# Arguments:
+#       list of filenames
+#       source directory path
+#       destination directory path
+#       manifest filename
+#       bool: source and destination share a filesystem
+#       number of mover threads
+# Returns:
+#       tuple: (moved count, failed count, elapsed seconds)
+
+	batches = [names[i:i + MOVE_BATCH_SIZE] for i in range(0, len(names), MOVE_BATCH_SIZE)]
+	moved = 0
+	failed = 0
+	start = time.perf_counter()
+
+	with open(manifest, "a") as mout, \
+			concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+		futures = [pool.submit(move_batch, batch, src_dir, dst_dir, same_fs)
+					for batch in batches]
+		for future in concurrent.futures.as_completed(futures):
+			for file, error in future.result():
+				if error is None:
+					moved += 1
+					mout.write("{}\t{}\n".format(os.path.join(src_dir, file),
+												os.path.join(dst_dir, file)))
+				else:
+					failed += 1
+					print("Error moving {} to {}: {}".format(file, dst_dir, error))
+			mout.flush()
+
+	return moved, failed, time.perf_counter() - start
+
+def move_batch(batch, src_dir, dst_dir, same_fs):
+# Moves one batch of files, collecting errors instead of aborting.
+# Arguments:
+#       list of filenames
+#       source directory path
+#       destination directory path
+#       bool: use os.rename (same filesystem) or copy + unlink
+# Returns:
+#       list of tuples: (filename, None or the error raised)
+	results = list()
+	for file in batch:
+		src = os.path.join(src_dir, file)
+		dst = os.path.join(dst_dir, file)
+		if os.path.exists(dst):
+			if os.path.exists(src):
+				# Never overwrite a different file of the same name.
+				results.append((file, OSError(errno.EEXIST, "Destination already exists", dst)))
+			else:
+				# Already moved by an earlier, interrupted run.
+				results.append((file, None))
+			continue
 		try:
-			shutil.move(file, blist_dir)
+			if same_fs:
+				os.rename(src, dst)
+			else:
+				shutil.copy2(src, dst)
+				os.unlink(src)
 		except (OSError, IOError) as e:
-			print("Error moving {} to {}: {}".format(file, blist_dir, e))
-			return 1
+			# Already moved by an earlier, interrupted run.
+			if not os.path.exists(src) and os.path.exists(dst):
+				results.append((file, None))
+			else:
+				results.append((file, e))
+		else:
+			results.append((file, None))
+	return results
 
-	print("DONE!!!\n")
-	print("Moved {} loci files to {} directory\n".format(str(len(list_of_files)), b_dir))
-	remaining_file_count = len([name for name in os.listdir('.') if os.path.isfile(name)])
-	print("{} loci files remain in {}\n".format(remaining_file_count, dir))
+def build_view(list_of_files, dir, view_dir, link_type="hard", threads=8):
+# Creates a view directory of hard or symbolic links to the given loci files.
+# Hard links fall back to symbolic links across filesystems.
+# Arguments:
+#       list of filenames to link
+#       loci directory path
+#       view directory path; must not exist yet
+#       "hard" or "symbolic"
+#       number of threads
+# Returns:
+#       int: 0 if no errors, 1 if error occurred.
+	if os.path.exists(view_dir):
+		print("Error: View directory '%s' already exists." % view_dir)
+		return 1
+
+	try:
+		os.makedirs(view_dir)
+	except OSError:
+		print("Creation of the directory '%s' failed." % view_dir)
+		return 1
+
+	if link_type == "hard" and os.stat(dir).st_dev != os.stat(view_dir).st_dev:
+		print("Loci and view directories are on different filesystems; "
+				"using symbolic links\n")
+		link_type = "symbolic"
+
+	batches = [list_of_files[i:i + MOVE_BATCH_SIZE]
+				for i in range(0, len(list_of_files), MOVE_BATCH_SIZE)]
+	linked = 0
+	failed = 0
+	start = time.perf_counter()
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+		futures = [pool.submit(link_batch, batch, dir, view_dir, link_type)
+					for batch in batches]
+		for future in concurrent.futures.as_completed(futures):
+			for file, error in future.result():
+				if error is None:
+					linked += 1
+				else:
+					failed += 1
+					print("Error linking {} into {}: {}".format(file, view_dir, error))
+
+	elapsed = time.perf_counter() - start
+	print("Linked {} loci files into {} ({} links, {:.1f} files/s)\n".format(
+			linked, view_dir, link_type, linked / elapsed if elapsed > 0 else float(linked)))
+
+	if failed:
+		return 1
 	return 0
 
-def get_bad_files(file):
+def link_batch(batch, src_dir, dst_dir, link_type):
+# Links one batch of files, collecting errors instead of aborting.
+# Symbolic links are relative so the view survives moving the parent directory.
+# Arguments:
+#       list of filenames
+#       loci directory path
+#       view directory path
+#       "hard" or "symbolic"
+# Returns:
+#       list of tuples: (filename, None or the error raised)
+	results = list()
+	rel_dir = os.path.relpath(src_dir, dst_dir)
+	for file in batch:
+		dst = os.path.join(dst_dir, file)
+		try:
+			if link_type == "hard":
+				os.link(os.path.join(src_dir, file), dst)
+			else:
+				os.symlink(os.path.join(rel_dir, file), dst)
+		except (OSError, IOError) as e:
+			results.append((file, e))
+		else:
+			results.append((file, None))
+	return results
+
+def write_include_list(list_of_files, dir, include_list=None, partition_file=None):
+# Writes the informative loci as a plain list of paths (one per line) and/or
+# as a NEXUS partition file that IQ-TREE reads with -p.
+# Arguments:
+#       list of filenames
+#       loci directory path
+#       include list filename or None
+#       NEXUS partition filename or None
+	if include_list:
+		with compressio.open_file(include_list, "wt") as fout:
+			for file in list_of_files:
+				fout.write(os.path.join(dir, file) + "\n")
+		print("Include list written to {}\n".format(include_list))
+
+	if partition_file:
+		with compressio.open_file(partition_file, "wt") as fout:
+			fout.write("#nexus\nbegin sets;\n")
+			for file, name in zip(list_of_files, charset_names(list_of_files)):
+				fout.write("\tcharset {} = {}: *;\n".format(name, os.path.join(dir, file)))
+			fout.write("end;\n")
+		print("IQ-TREE partition file written to {}\n".format(partition_file))
+
+def charset_names(list_of_files):
+# Names one partition per file after its locus key. Files sharing a key
+# (e.g. locus1.nex and locus1.phy) are named key_ext instead, since IQ-TREE
+# rejects duplicate charset names.
+# Arguments:
+#       list of filenames
+# Returns:
+#       list of charset names, in the same order
+	keys = [locus_key(file) for file in list_of_files]
+	counts = dict()
+	for key in keys:
+		counts[key] = counts.get(key, 0) + 1
+	names = list()
+	for file, key in zip(list_of_files, keys):
+		if counts[key] > 1:
+			key = key + "_" + os.path.splitext(file)[1].lstrip(".")
+		names.append(key)
+	return names
+
+def manifest_path(blist_dir):
+# Arguments:
+#       blacklist directory path
+# Returns:
+#       str: manifest filename, stored next to the blacklist directory
+	return os.path.normpath(blist_dir) + ".manifest.tsv"
+
+def read_manifest(manifest):
+# Reads (source, destination) pairs from a move manifest.
+# Arguments:
+#       manifest filename
+# Returns:
+#       list of tuples: (source path, destination path)
+	pairs = list()
+	if not os.path.isfile(manifest):
+		return pairs
+	with open(manifest, "r") as fin:
+		for line in fin:
+			line = line.rstrip("\n")
+			if line:
+				src, dst = line.split("\t")
+				pairs.append((src, dst))
+	return pairs
+
+def get_bad_files(file, checkpoint=None):
 # Get bad loci from IQ-TREE log file.
-# The bad filenames are the last element of the split method when the
-# line starts with "WARNING: No ")
+# The bad partition names are the last word of lines starting with
+# "WARNING: No ". Names are returned as written in the log;
+# resolve_blacklist() matches them to files. With a checkpoint, only the
+# part of the log written since the previous run is scanned.
 # Arguments:
 #       filename of IQ-TREE log file.
+#       checkpoint filename or None
 # Returns:
-#       list: list of blacklisted file names.
-	result_list = list()
-	with open(file, "r") as fin:
-		for line in fin:
-			if line.startswith("WARNING: No "):
-				line = line.rstrip()
-				result = line.split()[-1]
-				if not result.endswith(".nex"):
-					result = "{}.nex".format(result)
-				result_list.append(result)
-	return result_list
+#       list: list of blacklisted partition names.
+	if compressio.is_compressed(file):
+		# Offsets into a compressed log cannot be resumed cheaply; scan it all.
+		checkpoint = None
+	names, offset = load_checkpoint(checkpoint, file)
+	new_names, offset, finished = scan_log(file, offset, final=True)
+	names.extend(new_names)
+	save_checkpoint(checkpoint, file, names, offset)
+	return names
+
+def follow_log(file, checkpoint, interval, timeout, callback=None):
+# Follows an IQ-TREE log as it is written, until IQ-TREE writes its final
+# "Date and Time:" line or the log stops growing for timeout seconds.
+# Arguments:
+#       filename of IQ-TREE log file.
+#       checkpoint filename or None
+#       seconds between polls
+#       seconds without new data before giving up
+#       function called with each list of newly reported names, or None
+# Returns:
+#       list: list of blacklisted partition names.
+	names, offset = load_checkpoint(checkpoint, file)
+	last_change = time.monotonic()
+
+	print("Following {} for blacklisted loci".format(file), end="...\n")
+
+	while True:
+		new_names, new_offset, finished = scan_log(file, offset)
+		if new_names:
+			names.extend(new_names)
+			if callback is not None:
+				callback(new_names)
+		if new_offset != offset:
+			offset = new_offset
+			last_change = time.monotonic()
+			save_checkpoint(checkpoint, file, names, offset)
+		if finished:
+			print("IQ-TREE finished writing {}\n".format(file))
+			break
+		if time.monotonic() - last_change > timeout:
+			print("No new output in {} for {} seconds; stopped following\n".format(
+					file, timeout))
+			break
+		time.sleep(interval)
+
+	return names
+
+def scan_log(file, offset=0, final=False):
+# Scans an IQ-TREE log from a byte offset with bulk reads and a compiled regex.
+# Only complete lines are consumed unless final is True, so a line IQ-TREE
+# is still writing is picked up on the next scan.
+# Arguments:
+#       filename of IQ-TREE log file.
+#       byte offset to start from
+#       bool: also consume a trailing line without a newline
+# Returns:
+#       tuple: (list of partition names, offset after the last consumed line,
+#               bool: IQ-TREE's final line was seen)
+	names = list()
+	finished = False
+	carry = b""
+	with compressio.open_file(file, "rb") as fin:
+		if offset:
+			fin.seek(offset)
+		while True:
+			chunk = fin.read(LOG_CHUNK_SIZE)
+			if not chunk:
+				break
+			data = carry + chunk
+			cut = data.rfind(b"\n") + 1
+			block, carry = data[:cut], data[cut:]
+			names.extend(match.decode() for match in WARNING_RE.findall(block))
+			finished = finished or IQTREE_END_RE.search(block) is not None
+			offset += cut
+
+	if final and carry:
+		names.extend(match.decode() for match in WARNING_RE.findall(carry))
+		finished = finished or IQTREE_END_RE.search(carry) is not None
+		offset += len(carry)
+
+	return names, offset, finished
+
+def load_checkpoint(checkpoint, file):
+# Loads names and byte offset saved for a log file. The log is rescanned
+# from the start if it was replaced or truncated since the checkpoint.
+# Arguments:
+#       checkpoint filename or None
+#       filename of IQ-TREE log file.
+# Returns:
+#       tuple: (list of partition names, byte offset)
+	if checkpoint is None or not os.path.isfile(checkpoint):
+		return list(), 0
+
+	with open(checkpoint, "r") as fin:
+		state = json.load(fin)
+
+	stat = os.stat(file)
+	if state["inode"] != stat.st_ino or state["offset"] > stat.st_size:
+		print("Log file {} changed since checkpoint; rescanning\n".format(file))
+		return list(), 0
+
+	return state["names"], state["offset"]
+
+def save_checkpoint(checkpoint, file, names, offset):
+# Saves names and byte offset for a log file.
+# Arguments:
+#       checkpoint filename or None
+#       filename of IQ-TREE log file.
+#       list of partition names
+#       byte offset after the last scanned line
+	if checkpoint is None:
+		return
+
+	state = {"log": os.path.abspath(file),
+			"inode": os.stat(file).st_ino,
+			"offset": offset,
+			"names": names}
+
+	tmp = checkpoint + ".tmp"
+	with open(tmp, "w") as fout:
+		json.dump(state, fout)
+	os.replace(tmp, checkpoint)
+
+def get_uninformative_loci(dir, index, min_pis=1, processes=None):
+# Counts variable and parsimony-informative sites in every loci file without
+# IQ-TREE, on a process pool. Counts are cached per file on modification time
+# and size (see site_cache_path), so only new or changed loci are rescanned.
+# Arguments:
+#       loci directory path
+#       index from index_loci_dir()
+#       minimum parsimony-informative sites for a locus to be kept
+#       number of worker processes; None uses every core
+# Returns:
+#       list: filenames of loci with fewer than min_pis informative sites.
+	cache_file = site_cache_path(dir)
+	cache = dict()
+	if os.path.isfile(cache_file):
+		with open(cache_file, "r") as fin:
+			cache = json.load(fin)
+
+	files = [file for files in index.values() for file in files
+			if os.path.splitext(file)[1].lower() in LOCUS_EXTS]
+
+	counts = dict()
+	stale = list()
+	for file in files:
+		stat = os.stat(os.path.join(dir, file))
+		entry = cache.get(file)
+		if entry is not None and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+			counts[file] = entry[2:]
+		else:
+			stale.append((file, [stat.st_mtime_ns, stat.st_size]))
+
+	print("Counting informative sites in {} loci files ({} cached)".format(
+			len(files), len(files) - len(stale)), end="...\n")
+
+	failed = 0
+	paths = [os.path.join(dir, file) for file, key in stale]
+	with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+		results = pool.map(locus_site_counts, paths, chunksize=SITE_COUNT_CHUNK)
+		for (file, key), result in zip(stale, results):
+			if result is None:
+				failed += 1
+				print("Error: Could not read alignment {}".format(file))
+				continue
+			counts[file] = result
+			cache[file] = key + result
+
+	# Drop entries for files that are no longer in the directory.
+	cache = dict((file, cache[file]) for file in counts)
+	tmp = cache_file + ".tmp"
+	with open(tmp, "w") as fout:
+		json.dump(cache, fout)
+	os.replace(tmp, cache_file)
+
+	blacklist = sorted(file for file, (variable, informative) in counts.items()
+						if informative < min_pis)
+	invariant = sum(1 for file in blacklist if counts[file][0] == 0)
+
+	print("{} loci have fewer than {} parsimony-informative sites ({} invariant); "
+			"{} could not be read\n".format(len(blacklist), min_pis, invariant, failed))
+	return blacklist
+
+def locus_site_counts(path):
+# Arguments:
+#       path to one loci file
+# Returns:
+#       list: [variable sites, parsimony-informative sites], or None if the
+#       file could not be read as an alignment.
+	try:
+		names, block = genomatrix.read_alignment(path)
+	except (ValueError, OSError):
+		return None
+	return list(genomatrix.count_informative_sites(block))
+
+def site_cache_path(dir):
+# Arguments:
+#       loci directory path
+# Returns:
+#       str: site count cache filename, stored next to the loci directory
+	return os.path.normpath(os.path.abspath(dir)) + ".sites_cache.json"
+
+def locus_key(name):
+# Normalizes a partition or file name so IQ-TREE names match loci files:
+# the directory part and any alignment extension in LOCUS_EXTS are removed.
+# Arguments:
+#       partition name or filename
+# Returns:
+#       str: locus key
+	name = os.path.basename(name)
+	root, ext = os.path.splitext(name)
+	if ext.lower() in LOCUS_EXTS:
+		return root
+	return name
+
+def index_loci_dir(dir):
+# Builds an index of the loci directory with a single os.scandir pass.
+# Arguments:
+#       loci directory path
+# Returns:
+#       dict: locus key -> list of filenames with that key
+	index = dict()
+	with os.scandir(dir) as entries:
+		for entry in entries:
+			# Checksum sidecars (see compressio.write_sidecar) are not loci
+			if entry.is_file() and not entry.name.endswith(compressio.SIDECAR_EXT):
+				index.setdefault(locus_key(entry.name), list()).append(entry.name)
+	return index
+
+def resolve_blacklist(names, index):
+# Resolves blacklisted partition names against the loci directory index.
+# Arguments:
+#       list of partition names from the log file
+#       index from index_loci_dir()
+# Returns:
+#       tuple: (sorted list of matched filenames,
+#               sorted list of names with no matching file,
+#               number of duplicate names)
+	keys = set()
+	missing = set()
+	matched = list()
+	duplicates = 0
+	for name in names:
+		key = locus_key(name)
+		if key in keys:
+			duplicates += 1
+			continue
+		keys.add(key)
+		if key in index:
+			matched.extend(index[key])
+		else:
+			missing.add(name)
+	return sorted(matched), sorted(missing), duplicates
 
 
 def check_if_file_exists(filename):
@@ -147,21 +875,126 @@ def Get_Arguments():
 
 	required_args.add_argument("-l", "--log",
 								type=str,
-								required=True,
-								help="Input IQ-TREE log file")
+								required=False,
+								default=None,
+								nargs="+",
+								help="Input IQ-TREE log file(s) or glob(s); "
+									"not needed with --native or --rollback")
 
 	required_args.add_argument("-d", "--dir",
-								type=dir_path,
+								type=str,
 								required=True,
-								help="Path to directory containing files for all"
-								"loci")
+								help="Path to directory containing files for all "
+								"loci; " + batchrun.TEMPLATE_HELP)
 
 	optional_args.add_argument("-b", "--blacklist_dir",
 								type=str,
 								required=False,
 								default="blacklist",
 								help="Specify name of blacklist directory; "
-									"default = 'blacklist'")
+									"default = 'blacklist'; " + batchrun.TEMPLATE_HELP)
+
+	optional_args.add_argument("-t", "--threads",
+								type=int,
+								required=False,
+								default=8,
+								help="Number of threads used to move files; "
+									"default = 8")
+
+	optional_args.add_argument("-r", "--resume",
+								action="store_true",
+								default=False,
+								help="Resume an interrupted run, skipping files "
+									"recorded in the blacklist manifest")
+
+	optional_args.add_argument("-R", "--rollback",
+								action="store_true",
+								default=False,
+								help="Move files recorded in the blacklist "
+									"manifest back to the loci directory")
+
+	optional_args.add_argument("-v", "--view_dir",
+								type=str,
+								required=False,
+								default=None,
+								help="Leave the loci directory untouched and create "
+									"this directory of links to the informative loci")
+
+	optional_args.add_argument("-L", "--link_type",
+								type=str,
+								required=False,
+								choices=["hard", "symbolic"],
+								default="hard",
+								help="Link type used for --view_dir; "
+									"default = 'hard'")
+
+	optional_args.add_argument("-i", "--include_list",
+								type=str,
+								required=False,
+								default=None,
+								help="Leave the loci directory untouched and write "
+									"paths of the informative loci to this file")
+
+	optional_args.add_argument("-P", "--partition_file",
+								type=str,
+								required=False,
+								default=None,
+								help="Leave the loci directory untouched and write "
+									"the informative loci as an IQ-TREE NEXUS "
+									"partition file (-p)")
+
+	batchrun.add_jobs_argument(optional_args)
+	compressio.add_threads_argument(optional_args)
+	compressio.add_checksum_argument(optional_args)
+	profiling.add_profile_arguments(optional_args)
+
+	optional_args.add_argument("-n", "--native",
+								action="store_true",
+								default=False,
+								help="Blacklist loci by counting parsimony-informative "
+									"sites in the loci files directly instead of "
+									"reading an IQ-TREE log")
+
+	optional_args.add_argument("--min_pis",
+								type=int,
+								required=False,
+								default=1,
+								help="With --native, blacklist loci with fewer "
+									"parsimony-informative sites; default = 1")
+
+	optional_args.add_argument("--processes",
+								type=int,
+								required=False,
+								default=None,
+								help="Worker processes for --native; "
+									"default = all cores")
+
+	optional_args.add_argument("-c", "--checkpoint",
+								type=str,
+								required=False,
+								default=None,
+								help="Checkpoint file storing the scanned byte offset "
+									"of the log; reruns only scan new output")
+
+	optional_args.add_argument("-F", "--follow",
+								action="store_true",
+								default=False,
+								help="Follow the log while IQ-TREE writes it and "
+									"blacklist loci as they are reported")
+
+	optional_args.add_argument("--interval",
+								type=float,
+								required=False,
+								default=5.0,
+								help="Seconds between polls of the log with "
+									"--follow; default = 5")
+
+	optional_args.add_argument("--follow_timeout",
+								type=float,
+								required=False,
+								default=600.0,
+								help="Stop following after this many seconds "
+									"without new log output; default = 600")
 
 	optional_args.add_argument("-h", "--help", action="help",
 						help="Displays this help menu")
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+### Shared on-disk genotype matrix for the ddrad_scripts tools.
+### Converts a pyRAD .snps or sequential PHYLIP alignment once into a raw
+### uint8 (sample x site) matrix that is opened with np.memmap afterwards.
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import compressio
+
+MATRIX_EXT = ".gmx"
+INDEX_EXT = ".gmx.json"
+LOCI_EXT = ".gmx.loci.npy"
+
+# Characters counted as missing data in per-sample and per-site statistics
+MISSING_CHARS = b"Nn-?."
+
+MISSING_LUT = np.zeros(256, dtype=bool)
+MISSING_LUT[np.frombuffer(MISSING_CHARS, dtype=np.uint8)] = True
+
+# Rows per chunk for vectorized statistics; bounds the temporary boolean matrix
+CHUNK_ROWS = 64
+
+# Nucleotides counted when classifying variable and parsimony-informative sites
+BASES = b"ACGT"
+
+# IUPAC code -> bitmask of compatible bases (A=1, C=2, G=4, T=8). Gaps, N and
+# any unknown character are compatible with every base.
+IUPAC_CODES = {"A": 1, "C": 2, "G": 4, "T": 8, "U": 8,
+                "M": 3, "R": 5, "W": 9, "S": 6, "Y": 10, "K": 12,
+                "V": 7, "H": 11, "D": 13, "B": 14}
+
+IUPAC_LUT = np.full(256, 15, dtype=np.uint8)
+for code, mask in IUPAC_CODES.items():
+    IUPAC_LUT[ord(code)] = mask
+    IUPAC_LUT[ord(code.lower())] = mask
+
+
+def main():
+
+    args = Get_Arguments()
+
+    gmx = build_matrix(args.file, args.out)
+
+    print("\nWrote {} samples x {} sites ({} loci) to {}\n".format(
+            gmx.nsamples, gmx.nsites, gmx.nloci, gmx.path))
+
+    return 0
+
+
+class GenotypeMatrix(object):
+    """
+    Read-only view of a genotype matrix built with build_matrix().
+    Attributes:
+        data: np.memmap of shape (nsamples, nsites), dtype uint8
+        samples: list of sample names, in row order
+        loci: array of locus start offsets with a final end offset (nloci + 1)
+        path: path to the raw matrix file
+    """
+
+    def __init__(self, data, samples, loci, path):
+        self.data = data
+        self.samples = samples
+        self.loci = loci
+        self.path = path
+
+    @property
+    def nsamples(self):
+        return self.data.shape[0]
+
+    @property
+    def nsites(self):
+        return self.data.shape[1]
+
+    @property
+    def nloci(self):
+        return len(self.loci) - 1
+
+    def row(self, name):
+        """
+        Function to get one sample row by name.
+        Input:
+            name: sample name (string)
+        Returns:
+            np.memmap row (uint8)
+        """
+        return self.data[self.samples.index(name)]
+
+
+def matrix_prefix(path):
+    """
+    Function to strip any matrix extension so prefix, prefix.gmx and
+    prefix.gmx.json all refer to the same matrix.
+    Input:
+        path (string)
+    Returns:
+        prefix (string)
+    """
+    for ext in (INDEX_EXT, LOCI_EXT, MATRIX_EXT):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def is_matrix(path):
+    """
+    Function to check whether path refers to a built genotype matrix.
+    Input:
+        path (string)
+    Returns:
+        bool
+    """
+    return os.path.isfile(matrix_prefix(path) + INDEX_EXT)
+
+
+def sniff_format(filename):
+    """
+    Function to detect whether a text alignment is a pyRAD .snps or PHYLIP file.
+    Input:
+        filename (string)
+    Returns:
+        "snps" or "phylip" (string)
+    """
+    with compressio.open_file(filename, "rb") as fin:
+        header = fin.readline()
+
+    if header.startswith(b"##"):
+        return "snps"
+
+    fields = header.split()
+    if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+        return "phylip"
+
+    raise ValueError("Could not determine the format of " + filename)
+
+
+def iter_rows(filename, fmt=None):
+    """
+    Generator that yields one sample row at a time from a .snps or
+    sequential PHYLIP file, so memory stays bounded by a single row.
+    Compressed files are decompressed as they are read.
+    pyRAD ' _ ' locus separators and PHYLIP block spacing are removed.
+    Input:
+        filename (string)
+        fmt: "snps", "phylip" or None to detect (string)
+    Yields:
+        tuple: (sample name (bytes), sequence (bytes), raw sequence (bytes))
+    """
+    if fmt is None:
+        fmt = sniff_format(filename)
+
+    with compressio.open_file(filename, "rb") as fin:
+        fin.readline()
+        for line in fin:
+            if line.isspace():
+                continue
+            name, raw = line.rstrip().split(None, 1)
+            if fmt == "snps":
+                seq = raw.replace(b" _ ", b"")
+            else:
+                seq = b"".join(raw.split())
+            yield name, seq, raw
+
+
+def locus_offsets(raw):
+    """
+    Function to get locus boundaries from one raw pyRAD .snps row.
+    Input:
+        raw: sequence including ' _ ' separators (bytes)
+    Returns:
+        np.ndarray (int64) of locus start offsets plus the final end offset
+    """
+    lengths = [len(locus) for locus in raw.split(b" _ ")]
+    return np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+
+def select_unlinked(loci, per_locus=1, missing=None, seed=None):
+    """
+    Function to pick up to per_locus sites from every locus in one vectorized
+    step. Sites are ranked within their locus by missing count (if given)
+    and then by a seeded random key, so the same seed gives the same sites.
+    Input:
+        loci: locus start offsets plus the final end offset (see locus_offsets)
+        per_locus: sites kept per locus (int)
+        missing: per-site missing counts to prefer the most complete sites,
+                 or None to pick at random (see missing_per_site)
+        seed: random seed (int or None)
+    Returns:
+        np.ndarray (int64) of selected site indices, in alignment order
+    """
+    loci = np.asarray(loci, dtype=np.int64)
+    lengths = np.diff(loci)
+    locus_ids = np.repeat(np.arange(len(lengths)), lengths)
+    keys = np.random.default_rng(seed).random(len(locus_ids))
+
+    if missing is None:
+        order = np.lexsort((keys, locus_ids))
+    else:
+        order = np.lexsort((keys, missing, locus_ids))
+
+    # Rank of each site within its locus after sorting
+    ranks = np.arange(len(order)) - loci[:-1][locus_ids[order]]
+    return np.sort(order[ranks < per_locus])
+
+
+def build_matrix(infile, prefix, fmt=None, sync=True):
+    """
+    Function to convert a .snps or PHYLIP file into an on-disk uint8 matrix.
+    Rows are appended one at a time, so conversion memory is bounded by a row.
+    Writes prefix.gmx (raw matrix), prefix.gmx.json (shape and sample names)
+    and prefix.gmx.loci.npy (locus offsets).
+    Input:
+        infile: .snps or PHYLIP filename (string)
+        prefix: output prefix (string)
+        fmt: "snps", "phylip" or None to detect (string)
+        sync: fsync the files before renaming them into place; temporary
+              matrices skip it (bool)
+    Returns:
+        GenotypeMatrix opened from the written files
+    """
+    if fmt is None:
+        fmt = sniff_format(infile)
+
+    prefix = matrix_prefix(prefix)
+    samples = list()
+    loci = None
+    nsites = None
+
+    # The index is written last, so is_matrix() is only true for complete matrices
+    with compressio.open_file(prefix + MATRIX_EXT, "wb", sync=sync) as fout:
+        for name, seq, raw in iter_rows(infile, fmt):
+            if nsites is None:
+                nsites = len(seq)
+                if fmt == "snps":
+                    loci = locus_offsets(raw)
+                else:
+                    loci = np.array([0, nsites], dtype=np.int64)
+            elif len(seq) != nsites:
+                raise ValueError("Sample {} has {} sites; expected {}".format(
+                                name.decode(), len(seq), nsites))
+            fout.write(seq)
+            samples.append(name.decode())
+
+    if nsites is None:
+        raise ValueError("No samples were found in " + infile)
+
+    with compressio.open_file(prefix + LOCI_EXT, "wb", sync=sync) as fout:
+        np.save(fout, loci)
+
+    index = {"nsamples": len(samples),
+            "nsites": nsites,
+            "samples": samples,
+            "source": os.path.abspath(infile),
+            "format": fmt}
+
+    with compressio.open_file(prefix + INDEX_EXT, "wt", sync=sync) as fout:
+        json.dump(index, fout)
+
+    return open_matrix(prefix)
+
+
+def open_matrix(prefix, mode="r"):
+    """
+    Function to open a genotype matrix written by build_matrix().
+    Input:
+        prefix: matrix prefix or any of its filenames (string)
+        mode: np.memmap mode (string)
+    Returns:
+        GenotypeMatrix
+    """
+    prefix = matrix_prefix(prefix)
+
+    with open(prefix + INDEX_EXT, "r") as fin:
+        index = json.load(fin)
+
+    shape = (index["nsamples"], index["nsites"])
+    data = np.memmap(prefix + MATRIX_EXT, dtype=np.uint8, mode=mode, shape=shape)
+    loci = np.load(prefix + LOCI_EXT, mmap_mode="r")
+
+    return GenotypeMatrix(data, index["samples"], loci, prefix + MATRIX_EXT)
+
+
+def missing_per_sample(data, chunk_rows=CHUNK_ROWS):
+    """
+    Function to count missing sites in each row of a uint8 matrix.
+    Input:
+        data: 2D uint8 array or memmap (sample x site)
+        chunk_rows: rows evaluated per vectorized step (int)
+    Returns:
+        np.ndarray (int64) of missing counts per sample
+    """
+    counts = np.empty(data.shape[0], dtype=np.int64)
+    for i in range(0, data.shape[0], chunk_rows):
+        counts[i:i + chunk_rows] = MISSING_LUT[data[i:i + chunk_rows]].sum(axis=1)
+    return counts
+
+
+def missing_per_site(data, chunk_rows=CHUNK_ROWS):
+    """
+    Function to count missing samples in each column of a uint8 matrix.
+    Input:
+        data: 2D uint8 array or memmap (sample x site)
+        chunk_rows: rows evaluated per vectorized step (int)
+    Returns:
+        np.ndarray (int64) of missing counts per site
+    """
+    counts = np.zeros(data.shape[1], dtype=np.int64)
+    for i in range(0, data.shape[0], chunk_rows):
+        counts += MISSING_LUT[data[i:i + chunk_rows]].sum(axis=0)
+    return counts
+
+
+def missing_counts(data, chunk_rows=CHUNK_ROWS):
+    """
+    Function to count missing data per sample and per site in one pass,
+    evaluating chunk_rows rows at a time.
+    Input:
+        data: 2D uint8 array or memmap (sample x site)
+        chunk_rows: rows evaluated per vectorized step (int)
+    Returns:
+        tuple: (np.ndarray (int64) of missing counts per sample,
+                np.ndarray (int64) of missing counts per site)
+    """
+    per_sample = np.empty(data.shape[0], dtype=np.int64)
+    per_site = np.zeros(data.shape[1], dtype=np.int64)
+    for i in range(0, data.shape[0], chunk_rows):
+        chunk = MISSING_LUT[data[i:i + chunk_rows]]
+        per_sample[i:i + chunk_rows] = chunk.sum(axis=1)
+        per_site += chunk.sum(axis=0)
+    return per_sample, per_site
+
+
+def base_counts(masks):
+    """
+    Function to count each unambiguous nucleotide in every column.
+    Input:
+        masks: 2D uint8 array of IUPAC bitmasks (see IUPAC_LUT)
+    Returns:
+        np.ndarray (int64) of shape (4, nsites), rows in BASES order
+    """
+    return np.stack([(masks == bit).sum(axis=0) for bit in (1, 2, 4, 8)])
+
+
+def count_informative_sites(block):
+    """
+    Function to count variable and parsimony-informative sites in a block.
+    IUPAC ambiguity codes are handled as the sets of bases they stand for:
+    a site is variable only if no single base is compatible with every
+    sequence (so A and R together are not variable). A site is
+    parsimony-informative if at least two unambiguous bases each occur at
+    least twice.
+    Input:
+        block: 2D uint8 array (sample x site)
+    Returns:
+        tuple: (variable sites (int), parsimony-informative sites (int))
+    """
+    masks = IUPAC_LUT[block]
+    variable = int(np.count_nonzero(np.bitwise_and.reduce(masks, axis=0) == 0))
+    informative = int(np.count_nonzero((base_counts(masks) >= 2).sum(axis=0) >= 2))
+    return variable, informative
+
+
+def read_alignment(filename):
+    """
+    Function to read a single-locus alignment in NEXUS, FASTA or PHYLIP
+    (sequential or interleaved NEXUS) format into a byte matrix.
+    Input:
+        filename (string)
+    Returns:
+        tuple: (list of sample names, 2D uint8 array (sample x site))
+    """
+    with compressio.open_file(filename, "rb") as fin:
+        text = fin.read()
+
+    stripped = text.lstrip()
+    seqs = dict()
+
+    if stripped[:6].upper() == b"#NEXUS":
+        start = stripped.upper().index(b"MATRIX") + len(b"MATRIX")
+        end = stripped.index(b";", start)
+        for line in stripped[start:end].splitlines():
+            fields = line.split()
+            if fields:
+                name = fields[0].strip(b"'\"")
+                seqs[name] = seqs.get(name, b"") + b"".join(fields[1:])
+    elif stripped.startswith(b">"):
+        for record in stripped[1:].split(b"\n>"):
+            lines = record.splitlines()
+            seqs[lines[0].split()[0]] = b"".join(b"".join(lines[1:]).split())
+    else:
+        for line in stripped.splitlines()[1:]:
+            fields = line.split()
+            if fields:
+                seqs[fields[0]] = b"".join(fields[1:])
+
+    if not seqs:
+        raise ValueError("No sequences found in " + filename)
+
+    lengths = set(len(seq) for seq in seqs.values())
+    if len(lengths) != 1:
+        raise ValueError("Sequences in " + filename + " are not aligned")
+
+    block = np.frombuffer(b"".join(seqs.values()), dtype=np.uint8)
+    return [name.decode() for name in seqs], block.reshape(len(seqs), lengths.pop())
+
+
+def Get_Arguments():
+    """
+    Parse command-line arguments. Imported with argparse.
+    Returns: object of command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Converts a pyRAD .snps or "
+                                    "PHYLIP file into a memory-mapped genotype "
+                                    "matrix shared by the ddrad_scripts tools",
+                                    add_help=False)
+
+    required_args = parser.add_argument_group("Required Arguments")
+    optional_args = parser.add_argument_group("Optional Arguments")
+
+    required_args.add_argument("-f", "--file",
+                                type=str,
+                                required=True,
+                                help="Input .snps or sequential PHYLIP file")
+    required_args.add_argument("-o", "--out",
+                                type=str,
+                                required=True,
+                                help="Output prefix; writes PREFIX.gmx, "
+                                "PREFIX.gmx.json and PREFIX.gmx.loci.npy")
+    optional_args.add_argument("-h", "--help",
+                                action="help",
+                                help="Displays this help menu")
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+
+    rtrn_code = main()
+    print("Program finished with exit status " + str(rtrn_code) + "\n")
+    sys.exit(rtrn_code)
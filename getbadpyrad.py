@@ -2,65 +2,173 @@
 
 import argparse
 import csv
+import os
 import sys
 
+import numpy as np
+
+import batchrun
+import compressio
+import profiling
+import pyradstats
+import resultcache
+
+# Width of the '#' bars in the threshold sweep summary
+CURVE_WIDTH = 50
+
 def main():
     
     arguments = get_arguments()        
+    compressio.set_threads(arguments.io_threads)
+    compressio.set_checksum(arguments.checksum)
+    
+    infiles = batchrun.expand_inputs(arguments.stats)
+    
+    try:
+        namespaces = batchrun.per_input_arguments(arguments, "stats", infiles, ["outfile"])
+    except ValueError as e:
+        print("\nError: " + str(e) + "\n")
+        return 1
+    
+    return batchrun.run_batch(process_stats, namespaces, infiles, arguments.jobs)
+    
+def process_stats(arguments):
+    # Writes excluded samples for one .stats file.
     
     sample_list = list()
+    proportions = get_proportions(arguments)
     
-    with open(arguments.stats, "r") as fin:
-        loci_count, sample_list = get_sample_block(fin)
-        
-    max_missing = get_loci_proportion(loci_count, sample_list, arguments.proportion)
+    cache = open_cache(arguments, proportions)
+    if cache.restore():
+        return 0
     
+    with profiling.stage("read"):
+        loci_count, sample_table = get_sample_block(arguments.stats)
+    profiling.count_files("read", [arguments.stats], len(sample_table.names))
     
-    with open(arguments.outfile, "w") as fout:
-        write_excluded_loci(max_missing, sample_list, fout, arguments.outfile, arguments.proportion, loci_count)
+    if len(proportions) == 1 and not arguments.long:
+        sample_list = sample_table.as_tuples()
+        max_missing = get_loci_proportion(loci_count, sample_list, proportions[0])
+        
+        with profiling.stage("write"), compressio.open_file(arguments.outfile, "wt") as fout:
+            write_excluded_loci(max_missing, sample_list, fout, arguments.outfile, proportions[0], loci_count)
+        profiling.count_files("write", [arguments.outfile])
+        cache.store()
+        return 0
+    
+    with profiling.stage("threshold"):
+        minima, excluded = sweep_thresholds(loci_count, sample_table, proportions)
+    profiling.count("threshold", len(proportions))
+    
+    if arguments.long:
+        with profiling.stage("write"):
+            write_long_table(proportions, minima, excluded, arguments.outfile)
+        profiling.count_files("write", [arguments.outfile], sum(len(names) for names in excluded))
+    else:
+        for proportion, missing, names in zip(proportions, minima, excluded):
+            filename = threshold_filename(arguments.outfile, proportion)
+            with profiling.stage("write"), compressio.open_file(filename, "wt") as fout:
+                fout.write(",".join(names))
+            profiling.count_files("write", [filename], len(names))
+        print("\nWrote one CSV per threshold to {}\n".format(threshold_filename(arguments.outfile, "*")))
+    
+    print_curve(proportions, minima, excluded, len(sample_table.names))
+    cache.store()
+    return 0
     
     
 def get_arguments():
 
     parser = argparse.ArgumentParser(description="Writes CSV of samplesIDs from pyRAD stats file for individuals fewer loci than specified proportion")
 
-    parser.add_argument("-s", "--stats", type=str, required=True, help="pyRAD .stats file")
+    parser.add_argument("-s", "--stats", type=str, required=True, nargs="+", help="pyRAD .stats file(s) or glob(s); may be gzip, bgzip or zstd compressed")
     parser.add_argument("-o", "--outfile", type=str, required=False,
-                        help="Output filename; Default = out.csv", nargs="?", default="out.csv")
-    parser.add_argument("-p", "--proportion", type=float, required=True, help="Exclude samples with fewer loci than specified proportion; must be float value")
+                        help="Output filename; .gz, .bgz or .zst names are compressed; Default = out.csv; " + batchrun.TEMPLATE_HELP, nargs="?", default="out.csv")
+    thresholds = parser.add_mutually_exclusive_group(required=True)
+    thresholds.add_argument("-p", "--proportion", type=float, nargs="+", help="Exclude samples with fewer loci than specified proportion; must be float value. Several values run a threshold sweep")
+    thresholds.add_argument("-r", "--range", type=float, nargs=3, metavar=("START", "STOP", "STEP"), help="Sweep proportions from START to STOP (inclusive) in steps of STEP")
+    batchrun.add_jobs_argument(parser)
+    compressio.add_threads_argument(parser)
+    compressio.add_checksum_argument(parser)
+    profiling.add_profile_arguments(parser)
+    resultcache.add_cache_arguments(parser)
+    parser.add_argument("-l", "--long", action="store_true", default=False, help="Write all thresholds to one long-format CSV (proportion,min_loci,sample) instead of one CSV per threshold")
     
     args = parser.parse_args()
 
     return args
     
     
-def get_sample_block(infile):
-    
-    my_lst = list()
-    
-    for line in infile:
-        line = line.rstrip()     
-        if line.strip().startswith('taxon'):
-            break
-            
-    for line in infile:
-        line = line.rstrip()
-        if line.strip().startswith('##'):
-            break
-        if line.strip():
-            columns = line.split()
-            my_tuple = (columns[0], columns[1])
-            my_lst.append(my_tuple)
-            
-            
-    for line in infile:
-        if line.strip().startswith('sampled unlinked SNPs'):
-            line = line.rstrip()
-            snps = line.split("=")
-            numloci = snps[1].strip()
-            
-    return numloci, my_lst
+def open_cache(args, proportions):
+    # Returns the result cache for one .stats file (see resultcache.py); the
+    # outputs are the CSV, the long table or one CSV per threshold.
+    
+    if len(proportions) == 1 or args.long:
+        outputs = [args.outfile]
+    else:
+        outputs = [threshold_filename(args.outfile, proportion) for proportion in proportions]
+    
+    options = {"proportions": proportions, "long": args.long}
+    return resultcache.open_cache(args, [args.stats], outputs, options)
+    
+def get_sample_block(file):
+    # Reads the per-sample block (a pyradstats.SampleTable) and the number of
+    # sampled unlinked SNPs with the shared pyradstats parser.
+    
+    stats = pyradstats.load_stats(file)
+    return stats.total_loci, stats.samples
      
+def get_proportions(args):
+    # Returns the list of proportions given with -p or -r.
+    
+    if args.proportion is not None:
+        return args.proportion
+    
+    start, stop, step = args.range
+    return np.round(np.arange(start, stop + step / 2.0, step), 10).tolist()
+
+def sweep_thresholds(num_loci, samples, proportions):
+    # Sorts the locus count column of a pyradstats.SampleTable once and
+    # answers every threshold with a binary search.
+    # Returns:
+    #       list of minimum locus counts, one per proportion
+    #       list of excluded sample names per proportion, in .stats file order
+    
+    names = np.array(samples.names, dtype=object)
+    counts = samples.nloci.astype(np.int64, copy=False)
+    order = np.argsort(counts, kind="stable")
+    
+    minima = [get_loci_proportion(num_loci, samples, proportion) for proportion in proportions]
+    n_excluded = np.searchsorted(counts[order], minima, side="left")
+    
+    excluded = [names[np.sort(order[:n])].tolist() for n in n_excluded]
+    return minima, excluded
+
+def threshold_filename(filename, proportion):
+    # out.csv -> out_p0.15.csv; out.csv.gz -> out_p0.15.csv.gz
+    
+    filename, compression = compressio.split_extension(filename)
+    root, ext = os.path.splitext(filename)
+    return "{}_p{}{}{}".format(root, proportion, ext, compression)
+
+def write_long_table(proportions, minima, excluded, filename):
+    
+    with compressio.open_file(filename, "wt", newline="") as fout:
+        wr = csv.writer(fout, delimiter=",")
+        wr.writerow(["proportion", "min_loci", "sample"])
+        for proportion, missing, names in zip(proportions, minima, excluded):
+            wr.writerows([proportion, missing, name] for name in names)
+    print("\nWrote excluded samples for {} thresholds to {}\n".format(len(proportions), filename))
+
+def print_curve(proportions, minima, excluded, num_samples):
+    # Prints samples excluded versus threshold as a text bar chart.
+    
+    print("proportion\tmin_loci\texcluded")
+    for proportion, missing, names in zip(proportions, minima, excluded):
+        bar = "#" * int(round(CURVE_WIDTH * len(names) / float(max(num_samples, 1))))
+        print("{}\t{}\t{}/{}\t{}".format(proportion, missing, len(names), num_samples, bar))
+    print("")
+
 def get_loci_proportion(number, lst_of_tuples, proportion):
     
     percentage = float(proportion) * float(number)
@@ -82,4 +190,5 @@ def write_excluded_loci(missing, samples, ofile, filename, proportion, num_loci)
         
 ############################################################################################################################################################
     
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
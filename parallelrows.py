@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+### Parallel conversion of uncompressed pyRAD .snps files for snps2phylip.py.
+### The input is split into newline-aligned byte ranges. A first pass over
+### the ranges on a process pool collects every row's name and sequence
+### length, which fixes the byte offset of every row in each output; a
+### second pass removes the ' _ ' locus separators and writes each range's
+### rows straight to those offsets with os.pwrite. Output is byte-identical
+### to the serial writers and does not depend on the number of processes.
+
+import concurrent.futures
+import os
+
+import numpy as np
+
+import seqwriters
+
+# Nominal size of one byte range; ranges are also split so every process
+# gets several, which evens out the load
+CHUNK_BYTES = 32 * 1024 * 1024
+
+# Ranges per process
+RANGES_PER_PROCESS = 4
+
+
+def supported(formats):
+    """
+    Function to check whether every format writes rows independently of
+    each other (see seqwriters.AlignmentWriter.ROW_LAYOUT).
+    Input:
+        formats: format names (list)
+    Returns:
+        bool
+    """
+    return all(seqwriters.WRITERS[fmt].ROW_LAYOUT is not None for fmt in formats)
+
+
+def split_ranges(filename, processes, chunk_bytes=CHUNK_BYTES):
+    """
+    Function to split the rows of a .snps file (after its header line) into
+    byte ranges that start and end on line boundaries.
+    Input:
+        filename (string)
+        processes: number of processes the ranges are shared between (int)
+        chunk_bytes: nominal range size (int)
+    Returns:
+        list of (start, stop) byte offsets
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as fin:
+        fin.readline()
+        first = fin.tell()
+
+        nranges = max(processes * RANGES_PER_PROCESS, -(-(size - first) // chunk_bytes), 1)
+        bounds = [first]
+        for nominal in np.linspace(first, size, nranges + 1)[1:-1].astype(np.int64):
+            # Move to the start of the next line
+            fin.seek(max(int(nominal) - 1, bounds[-1]))
+            fin.readline()
+            if fin.tell() > bounds[-1]:
+                bounds.append(fin.tell())
+        if bounds[-1] < size:
+            bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_range(filename, start, stop):
+    """
+    Generator over the rows of one byte range, split as in genomatrix.iter_rows.
+    Input:
+        filename (string)
+        start, stop: byte offsets on line boundaries (int)
+    Yields:
+        tuple: (sample name (bytes), raw sequence with separators (bytes))
+    """
+    with open(filename, "rb") as fin:
+        fin.seek(start)
+        block = fin.read(stop - start)
+    for line in block.split(b"\n"):
+        if not line or line.isspace():
+            continue
+        name, raw = line.rstrip().split(None, 1)
+        yield name, raw
+
+
+def scan_range(filename, start, stop):
+    """
+    Function to collect the sample names and sequence lengths of one range.
+    Input:
+        filename (string)
+        start, stop: byte offsets (int)
+    Returns:
+        tuple: (names (list of bytes), sequence lengths (list of int))
+    """
+    names = list()
+    lengths = list()
+    for name, raw in iter_range(filename, start, stop):
+        names.append(name)
+        lengths.append(len(raw) - 3 * raw.count(b" _ "))
+    return names, lengths
+
+
+def write_range(filename, start, stop, targets):
+    """
+    Function to write the rows of one range to every output.
+    Input:
+        filename: .snps filename (string)
+        start, stop: byte offsets (int)
+        targets: (output filename, byte offset, prefix, separator) tuples (list)
+    Returns:
+        int: bytes written
+    """
+    rows = [(name, raw.replace(b" _ ", b"")) for name, raw in iter_range(filename, start, stop)]
+    written = 0
+    for outfile, offset, prefix, separator in targets:
+        block = b"".join(b"".join((prefix, name, separator, seq, b"\n")) for name, seq in rows)
+        fd = os.open(outfile, os.O_WRONLY)
+        try:
+            view = memoryview(block)
+            while view:
+                n = os.pwrite(fd, view, offset)
+                view = view[n:]
+                offset += n
+        finally:
+            os.close(fd)
+        written += len(block)
+    return written
+
+
+def convert(infile, outputs, processes, **options):
+    """
+    Function to convert a .snps file to every output on a process pool.
+    Input:
+        infile: uncompressed .snps filename (string)
+        outputs: (format, filename) tuples with uncompressed outputs whose
+                formats are supported() (list)
+        processes: number of worker processes (int)
+        options: passed to the writers
+    Returns:
+        tuple: (number of samples (int), number of sites (int))
+    Raises:
+        ValueError if there are no samples or rows differ in length
+    """
+    ranges = split_ranges(infile, processes)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        scans = list(pool.map(scan_range, *zip(*[(infile, start, stop) for start, stop in ranges])))
+
+        names = [name for range_names, lengths in scans for name in range_names]
+        lengths = np.array([n for range_names, range_lengths in scans for n in range_lengths],
+                        dtype=np.int64)
+        if not len(names):
+            raise ValueError("No samples were found")
+        nsites = int(lengths[0])
+        bad = np.flatnonzero(lengths != nsites)
+        if len(bad):
+            raise ValueError("Sample {} has {} sites; expected {}".format(
+                            names[bad[0]].decode(), lengths[bad[0]], nsites))
+
+        # Header first; rows are written around the open writers
+        writers = list()
+        for fmt, filename in outputs:
+            writer = seqwriters.WRITERS[fmt](filename, len(names), nsites, **options)
+            writer.fout.flush()
+            writers.append(writer)
+
+        # Bytes per range and output, from the name lengths and the fixed row length
+        name_bytes = np.array([sum(len(name) for name in range_names) for range_names, _ in scans],
+                            dtype=np.int64)
+        row_counts = np.array([len(range_names) for range_names, _ in scans], dtype=np.int64)
+        targets = [list() for _ in ranges]
+        ends = list()
+        for writer in writers:
+            prefix, separator = writer.ROW_LAYOUT
+            sizes = name_bytes + row_counts * (len(prefix) + len(separator) + nsites + 1)
+            offsets = writer.fout.tell() + np.concatenate(([0], np.cumsum(sizes)))
+            for i in range(len(ranges)):
+                # Rows go to the temporary file the writer renames into place on close()
+                targets[i].append((writer.fout.temp, int(offsets[i]), prefix, separator))
+            ends.append(int(offsets[-1]))
+
+        try:
+            futures = [pool.submit(write_range, infile, start, stop, range_targets)
+                    for (start, stop), range_targets in zip(ranges, targets)]
+            for future in futures:
+                future.result()
+        except BaseException:
+            for writer in writers:
+                writer.discard()
+            raise
+
+    for writer, end in zip(writers, ends):
+        writer.fout.seek(end)
+        writer.count = len(names)
+        writer.close()
+
+    return len(names), nsites
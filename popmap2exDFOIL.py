@@ -5,65 +5,487 @@
 ### Please submit any issues or bug reports to: btm002@email.uark.edu
 
 import argparse
+import concurrent.futures
+import csv
+import itertools
+import os
+import re
 import sys
-
-import numpy as np
-import pandas as pd
+import tempfile
 
 from functools import reduce
 
+import batchrun
+import compressio
+import profiling
+
+# Individuals listed per join diagnostic before truncating
+MAX_REPORTED = 10
+
 def main():
 
     args = Get_Arguments()
+    compressio.set_threads(args.io_threads)
+    compressio.set_checksum(args.checksum)
 
-    pop = args.popmap
-    batch = args.batch
-    species = args.species
-    subspecies = args.subspecies
+    popmaps = batchrun.expand_inputs(args.popmap)
+
+    # The quintet outputs are written per popmap, so a batch needs {stem} in
+    # them; the default --subset_dir only matters with --alignment.
+    outputs = ["outfile", "report"]
+    if args.alignment is not None:
+        outputs.extend(["subset_dir", "matrix", "row_index"])
+
+    try:
+        namespaces = batchrun.per_input_arguments(args, "popmap", popmaps, outputs,
+                                ["batch", "species", "subspecies", "alignment", "quintets"])
+    except ValueError as e:
+        print("\nError: " + str(e) + "\n")
+        return 1
 
-    validate_file_exists(pop)
-    poplist = read_popmap(pop)
-    popdf = pd.DataFrame.from_records(poplist, columns = ["Individual", "popID"])
+    return batchrun.run_batch(make_sampleinfo, namespaces, popmaps, args.jobs)
 
-    batchdf = pd.DataFrame()
-    spdf = pd.DataFrame()
-    subspdf = pd.DataFrame()
+def make_sampleinfo(args):
+    """
+    Function to write the ExDFOIL sample info file for one popmap.
+    Input:
+        args: argparse namespace holding a single popmap and its map files
+    Returns:
+        int: exit status
+    """
+    pop = args.popmap
 
-    if batch is not None:
-        validate_file_exists(batch)
-        batchlist = read_popmap(batch)
-        batchdf = pd.DataFrame.from_records(batchlist, columns = ["Individual", "batch"])
+    with profiling.stage("read"):
+        validate_file_exists(pop)
+        popmap = read_popmap(pop)
+        maps = [("popID", popmap)]
 
-    if species is not None:
-        validate_file_exists(species)
-        splist = read_popmap(species)
-        spdf = pd.DataFrame.from_records(splist, columns = ["Individual", "speciesID"])
+        # Column order of the output: batch, popID, speciesID, subspeciesID
+        if args.batch is not None:
+            validate_file_exists(args.batch)
+            maps.insert(0, ("batch", read_popmap(args.batch)))
 
-    if subspecies is not None:
-        validate_file_exists(subspecies)
-        subsplist = read_popmap(subspecies)
-        subspdf = pd.DataFrame.from_records(subsplist, columns = ["Individual", "subspeciesID"])
+        if args.species is not None:
+            validate_file_exists(args.species)
+            maps.append(("speciesID", read_popmap(args.species)))
 
-    tmpdfs = [batchdf, popdf, spdf, subspdf]
+        if args.subspecies is not None:
+            validate_file_exists(args.subspecies)
+            maps.append(("subspeciesID", read_popmap(args.subspecies)))
+    profiling.count_files("read", [pop, args.batch, args.species, args.subspecies],
+                        sum(len(records) for column, records in maps))
 
-    dfs = list()
-    for df in tmpdfs:
-        if not df.empty:
-            dfs.append(df)
+    # Empty map files are skipped, as empty DataFrames were.
+    maps = [(column, records) for column, records in maps if records]
 
-    if not dfs:
+    if not maps:
         print("Error: Was not able to join files. Make sure each individualID is present in all files.")
+        return 1
+
+    if args.pandas and args.join != "inner":
+        print("Error: --pandas only supports --join inner")
+        return 1
+
+    if args.pandas:
+        import pandas as pd
+
+        with profiling.stage("join"):
+            dfs = [pd.DataFrame.from_records(records, columns = ["Individual", column])
+                    for column, records in maps]
+            df_final = merge_dataframes(dfs)
+    else:
+        with profiling.stage("join"):
+            header, rows, table = join_maps(maps, args.join, args.missing_value)
+        with profiling.stage("diagnose"):
+            diagnostics = diagnose_join(maps, table)
+        print_diagnostics(diagnostics, len(table), len(rows))
+
+    # The sample info file and report are written only once the quintet
+    # alignments succeed, so a failed run publishes nothing.
+    if args.alignment is not None:
+        status = make_quintets(args, popmap)
+        if status:
+            return status
+
+    if args.pandas:
+        with profiling.stage("write"), compressio.open_file(args.outfile, "wt", newline="") as fout:
+            df_final.to_csv(fout, sep = " ", header = True, index = False)
+    else:
+        with profiling.stage("write"):
+            if args.report is not None:
+                write_join_report(diagnostics, args.report)
+            write_sampleinfo(header, rows, args.outfile)
+        profiling.count_files("write", [args.outfile, args.report], len(rows))
+
+    return 0
 
-    df_final = merge_dataframes(dfs)
-    df_final.to_csv(args.outfile, sep = " ", header = True, index = False)
+def make_quintets(args, popmap):
+    """
+    Function to write one alignment per population quintet (P1 P2 P3 P4 O).
+    The alignment is read once: a text alignment is converted to a
+    genomatrix.py matrix, sample rows are indexed by population once, and
+    every quintet is then a selection of rows sliced from the memory-mapped
+    matrix, written on a process pool.
+    Input:
+        args: argparse namespace with the alignment and quintet options
+        popmap: list of (indID, popID) tuples
+    Returns:
+        int: exit status
+    """
+    # numpy, genomatrix and seqwriters are only imported with --alignment
+    import genomatrix
+    import seqwriters
+
+    if args.quintets is None:
+        print("\nError: --alignment requires --quintets\n")
+        return 1
+
+    formats = [fmt.strip() for fmt in args.subset_formats.split(",") if fmt.strip()]
+    if formats == ["none"]:
+        formats = list()
+    unknown = [fmt for fmt in formats if fmt not in seqwriters.WRITERS]
+    if unknown:
+        print("\nError: Unknown --subset_formats: " + ",".join(unknown) + "\n")
+        return 1
+
+    if args.row_index is not None and args.matrix is None and not genomatrix.is_matrix(args.alignment):
+        print("\nError: --row_index needs a matrix that is kept: pass a genomatrix.py "
+            "matrix as --alignment, or --matrix PREFIX\n")
+        return 1
+
+    validate_file_exists(args.quintets)
+
+    spool = None
+    try:
+        quintets = read_quintets(args.quintets)
+
+        with profiling.stage("index"):
+            if genomatrix.is_matrix(args.alignment):
+                prefix = genomatrix.matrix_prefix(args.alignment)
+            else:
+                validate_file_exists(args.alignment)
+                if args.matrix is not None:
+                    prefix = args.matrix
+                else:
+                    spool = tempfile.TemporaryDirectory(
+                            dir=os.path.abspath(os.path.dirname(args.subset_dir) or "."))
+                    prefix = os.path.join(spool.name, "alignment")
+                genomatrix.build_matrix(args.alignment, prefix, sync=spool is None)
+            gmx = genomatrix.open_matrix(prefix)
+            index, unplaced = index_populations(gmx.samples, popmap)
+        profiling.count_files("index", [args.alignment], gmx.nsamples)
+
+        if unplaced:
+            print("Warning: {} samples in the popmap are not in {}".format(len(unplaced), args.alignment))
+            for ind in unplaced[:MAX_REPORTED]:
+                print("\t" + ind)
+            if len(unplaced) > MAX_REPORTED:
+                print("\t...and {} more".format(len(unplaced) - MAX_REPORTED))
+
+        jobs, skipped = select_quintets(quintets, index)
+        if skipped:
+            print("Warning: Skipped {} quintets with populations that have no samples "
+                "in the alignment".format(len(skipped)))
+            for quintet, missing in skipped[:MAX_REPORTED]:
+                print("\t" + " ".join(quintet) + "\t(" + ",".join(missing) + ")")
+            if len(skipped) > MAX_REPORTED:
+                print("\t...and {} more".format(len(skipped) - MAX_REPORTED))
+
+        if args.row_index is not None:
+            with profiling.stage("write"):
+                write_row_index(jobs, prefix, args.row_index)
+            profiling.count_files("write", [args.row_index], len(jobs))
+
+        if formats:
+            with profiling.stage("subset"):
+                written = write_quintets(prefix, jobs, formats, args.subset_dir, args.processes)
+            profiling.count("subset", sum(len(rows) for quintet, rows in jobs), written)
+            print("Wrote {} quintet alignments to {}".format(len(jobs), args.subset_dir))
+
+    except ValueError as e:
+        print("\nError: " + str(e) + "\n")
+        return 1
+
+    finally:
+        if spool is not None:
+            spool.cleanup()
 
     return 0
 
+def read_quintets(file):
+    """
+    Function to read population quintets, one per line: P1 P2 P3 P4 O.
+    Blank lines and lines starting with # are skipped.
+    Input:
+        file: filename (string)
+    Returns:
+        list of 5-tuples of popIDs
+    Raises:
+        ValueError for lines without five distinct popIDs
+    """
+    quintets = list()
+    with compressio.open_file(file, "rt") as fin:
+        for number, line in enumerate(fin, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) != 5:
+                raise ValueError("Line {} of {} has {} populations; expected 5 "
+                                "(P1 P2 P3 P4 O)".format(number, file, len(fields)))
+            if len(set(fields)) != 5:
+                # A repeated population would write its samples twice
+                raise ValueError("Line {} of {} repeats a population; the five popIDs "
+                                "must be distinct".format(number, file))
+            quintets.append(tuple(fields))
+    return quintets
+
+def index_populations(samples, popmap):
+    """
+    Function to index the matrix rows of every population in one pass.
+    Input:
+        samples: sample names in matrix row order (list)
+        popmap: list of (indID, popID) tuples
+    Returns:
+        dict: popID -> np.ndarray of row indices, in matrix order
+        list: popmap individuals that are not in the matrix
+    """
+    import numpy as np
+
+    rows = dict((name, i) for i, name in enumerate(samples))
+    index = dict()
+    unplaced = list()
+    for ind, pop in popmap:
+        if ind in rows:
+            index.setdefault(pop, list()).append(rows[ind])
+        else:
+            unplaced.append(ind)
+    return dict((pop, np.unique(np.array(ids, dtype=np.int64))) for pop, ids in index.items()), unplaced
+
+def select_quintets(quintets, index):
+    """
+    Function to turn every quintet into its matrix rows, P1 to O.
+    Input:
+        quintets: list of 5-tuples of popIDs
+        index: popID -> row indices, from index_populations (dict)
+    Returns:
+        list of (quintet, row indices) tuples
+        list of (quintet, popIDs without samples) tuples that were skipped
+    """
+    import numpy as np
+
+    jobs = list()
+    skipped = list()
+    for quintet in quintets:
+        missing = [pop for pop in quintet if pop not in index]
+        if missing:
+            skipped.append((quintet, missing))
+        else:
+            jobs.append((quintet, np.concatenate([index[pop] for pop in quintet])))
+    return jobs, skipped
+
+def quintet_name(quintet):
+    """
+    Function to name the files of one quintet: P1_P2_P3_P4_O, with characters
+    other than letters, digits, '.' and '-' replaced by '_'.
+    Input:
+        quintet: 5-tuple of popIDs
+    Returns:
+        string
+    """
+    return "_".join(re.sub(r"[^\w.-]", "_", pop) for pop in quintet)
+
+def write_row_index(jobs, prefix, file):
+    """
+    Function to write the matrix rows of every quintet, so the subsets can
+    be sliced from the memory-mapped matrix without copying:
+    np.memmap(PREFIX.gmx)[rows].
+    Input:
+        jobs: list of (quintet, row indices) tuples
+        prefix: matrix prefix (string)
+        file: output filename (string)
+    Returns:
+        None
+    """
+    import genomatrix
+
+    with compressio.open_file(file, "wt") as fout:
+        fout.write("# matrix\t{}\n".format(os.path.abspath(prefix) + genomatrix.MATRIX_EXT))
+        fout.write("quintet\tP1\tP2\tP3\tP4\tO\tnsamples\trows\n")
+        for quintet, rows in jobs:
+            fout.write("{}\t{}\t{}\t{}\n".format(quintet_name(quintet), "\t".join(quintet),
+                        len(rows), ",".join(str(i) for i in rows)))
+
+def write_quintets(prefix, jobs, formats, outdir, processes=1):
+    """
+    Function to write every quintet alignment, on a process pool if
+    processes > 1. Workers open the matrix themselves, so only row indices
+    are sent to them.
+    Input:
+        prefix: matrix prefix (string)
+        jobs: list of (quintet, row indices) tuples
+        formats: output formats in seqwriters.WRITERS (list)
+        outdir: output directory (string)
+        processes: number of worker processes (int)
+    Returns:
+        int: bytes written
+    """
+    import seqwriters
+
+    os.makedirs(outdir, exist_ok=True)
+    tasks = list()
+    for quintet, rows in jobs:
+        base = os.path.join(outdir, quintet_name(quintet))
+        tasks.append((prefix, rows, [(fmt, base + seqwriters.WRITERS[fmt].EXTENSION) for fmt in formats]))
+
+    if processes <= 1:
+        return sum(write_quintet(*task) for task in tasks)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        return sum(pool.map(write_quintet, *zip(*tasks)))
+
+def write_quintet(prefix, rows, outputs):
+    """
+    Function to write one quintet's rows from the matrix to every output.
+    Input:
+        prefix: matrix prefix (string)
+        rows: matrix row indices (np.ndarray)
+        outputs: list of (format, filename) tuples
+    Returns:
+        int: bytes written
+    """
+    import genomatrix
+    import seqwriters
+
+    gmx = genomatrix.open_matrix(prefix)
+    selected = ((gmx.samples[i].encode(), gmx.data[i].tobytes()) for i in rows)
+    seqwriters.write_alignment(selected, outputs, len(rows), gmx.nsites)
+    return sum(os.path.getsize(filename) for fmt, filename in outputs)
+
 def merge_dataframes(dfs):
 
+    import pandas as pd
+
     df_final = reduce(lambda left, right: pd.merge(left, right, on="Individual"), dfs)
     return df_final
 
+def join_maps(maps, how="inner", missing_value="NA"):
+    """
+    Function to join every two-column map on the individual ID with a single
+    multi-way hash join. Individuals are ordered by first appearance across
+    the maps; individuals with several values in a map get one row per
+    combination, as with pd.merge.
+    Input:
+        maps: list of (column name, list of (indID, value) tuples) (list)
+        how: "inner" (in every map), "left" (in the popmap) or "outer" (in any map)
+        missing_value: value written for maps missing an individual (string)
+    Returns:
+        header (list), rows (list of lists),
+        table: indID -> list of value lists, one per map (dict)
+    """
+    nmaps = len(maps)
+    table = dict()
+    for i, (column, records) in enumerate(maps):
+        for ind, value in records:
+            if ind not in table:
+                table[ind] = [list() for j in range(nmaps)]
+            table[ind][i].append(value)
+
+    header = ["Individual"] + [column for column, records in maps]
+    required = [i for i, (column, records) in enumerate(maps)
+                if how == "inner" or (how == "left" and column == "popID")]
+
+    rows = list()
+    for ind, values in table.items():
+        if any(not values[i] for i in required):
+            continue
+        values = [vals if vals else [missing_value] for vals in values]
+        rows.extend([ind] + list(combo) for combo in itertools.product(*values))
+
+    return header, rows, table
+
+def diagnose_join(maps, table):
+    """
+    Function to find individuals missing from maps, duplicated within a map,
+    or assigned conflicting values within a map.
+    Input:
+        maps: list of (column name, list of (indID, value) tuples) (list)
+        table: indID -> list of value lists, from join_maps (dict)
+    Returns:
+        dict: issue ("missing", "duplicate", "conflict") ->
+              list of (column, indID, values) tuples
+    """
+    diagnostics = {"missing": list(), "duplicate": list(), "conflict": list()}
+    columns = [column for column, records in maps]
+
+    for ind, values in table.items():
+        for column, vals in zip(columns, values):
+            if not vals:
+                diagnostics["missing"].append((column, ind, vals))
+            elif len(set(vals)) > 1:
+                diagnostics["conflict"].append((column, ind, vals))
+            elif len(vals) > 1:
+                diagnostics["duplicate"].append((column, ind, vals))
+
+    return diagnostics
+
+def print_diagnostics(diagnostics, num_individuals, num_rows):
+    """
+    Function to summarize join diagnostics, listing a few individuals per issue.
+    Input:
+        diagnostics: from diagnose_join (dict)
+        num_individuals: individuals in any map (int)
+        num_rows: rows written (int)
+    Returns:
+        None
+    """
+    print("\nJoined {} individuals into {} rows".format(num_individuals, num_rows))
+
+    labels = {"missing": "missing from the {} map",
+            "duplicate": "listed more than once in the {} map",
+            "conflict": "assigned conflicting values in the {} map"}
+
+    for issue in ("missing", "duplicate", "conflict"):
+        by_column = dict()
+        for column, ind, vals in diagnostics[issue]:
+            by_column.setdefault(column, list()).append((ind, vals))
+        for column, entries in by_column.items():
+            print("Warning: {} individuals {}".format(len(entries), labels[issue].format(column)))
+            for ind, vals in entries[:MAX_REPORTED]:
+                print("\t" + ind + ("" if issue == "missing" else "\t" + ",".join(vals)))
+            if len(entries) > MAX_REPORTED:
+                print("\t...and {} more".format(len(entries) - MAX_REPORTED))
+
+def write_join_report(diagnostics, file):
+    """
+    Function to write every join diagnostic as a tab-separated table.
+    Input:
+        diagnostics: from diagnose_join (dict)
+        file: output filename (string)
+    Returns:
+        None
+    """
+    with compressio.open_file(file, "wt") as fout:
+        fout.write("issue\tmap\tIndividual\tvalues\n")
+        for issue in ("missing", "duplicate", "conflict"):
+            for column, ind, vals in diagnostics[issue]:
+                fout.write("{}\t{}\t{}\t{}\n".format(issue, column, ind, ",".join(vals)))
+
+def write_sampleinfo(header, rows, outfile):
+    """
+    Function to write the space-delimited sample info file, quoting fields
+    the same way DataFrame.to_csv does.
+    Input:
+        header (list)
+        rows (list of lists)
+        outfile (string)
+    Returns:
+        None
+    """
+    with compressio.open_file(outfile, "wt", newline="") as fout:
+        wr = csv.writer(fout, delimiter=" ", lineterminator="\n")
+        wr.writerow(header)
+        wr.writerows(rows)
+
 def read_popmap(file):
     """
     Function to read a population map file in the format: indID\tpopID
@@ -73,7 +495,7 @@ def read_popmap(file):
         list of tuples containing (indID, popID) (list)
         """
     list_of_tuples = list()
-    with open(file, "r") as fin:
+    with compressio.open_file(file, "rt") as fin:
         for line in fin:
             line = line.strip()
             if not line:
@@ -116,7 +538,8 @@ def Get_Arguments():
     required_args.add_argument("-p", "--popmap",
                                 type=str,
                                 required=True,
-                                help="String; Tab-separated popmap file: indID\tpopID")
+                                nargs="+",
+                                help="String; Tab-separated popmap file(s) or glob(s): indID\tpopID")
 
     ## Optional Arguments
     optional_args.add_argument("-b", "--batch",
@@ -124,25 +547,101 @@ def Get_Arguments():
                                 required=False,
                                 default=None,
                                 nargs="?",
-                                help="Filename containing batchIDs")
+                                help="Filename containing batchIDs; "
+                                + batchrun.TEMPLATE_HELP)
     optional_args.add_argument("-S", "--species",
                                 type=str,
                                 required=False,
                                 default=None,
                                 nargs="?",
-                                help="Filename containing speciesIDs")
+                                help="Filename containing speciesIDs; "
+                                + batchrun.TEMPLATE_HELP)
     optional_args.add_argument("-s", "--subspecies",
                                 type=str,
                                 required=False,
                                 default=None,
                                 nargs="?",
-                                help="Filename containing subspeciesIDs")
+                                help="Filename containing subspeciesIDs; "
+                                + batchrun.TEMPLATE_HELP)
     optional_args.add_argument("-o", "--outfile",
                                 type=str,
                                 required=False,
                                 default="mysampleinfo.txt",
                                 nargs="?",
-                                help="Specify output filename; default=mysampleinfo.txt")
+                                help="Specify output filename; .gz, .bgz or .zst names "
+                                "are compressed; default=mysampleinfo.txt; "
+                                + batchrun.TEMPLATE_HELP)
+    batchrun.add_jobs_argument(optional_args)
+    compressio.add_threads_argument(optional_args)
+    compressio.add_checksum_argument(optional_args)
+    profiling.add_profile_arguments(optional_args)
+    optional_args.add_argument("-J", "--join",
+                                type=str,
+                                required=False,
+                                choices=["inner", "left", "outer"],
+                                default="inner",
+                                help="inner: individuals in every map; left: every "
+                                "individual in the popmap; outer: individuals in any map; "
+                                "default=inner")
+    optional_args.add_argument("-m", "--missing_value",
+                                type=str,
+                                required=False,
+                                default="NA",
+                                help="Value written for maps missing an individual "
+                                "with --join left/outer; default=NA")
+    optional_args.add_argument("-r", "--report",
+                                type=str,
+                                required=False,
+                                default=None,
+                                help="Write every missing, duplicate and conflicting "
+                                "individual to this tab-separated file; " + batchrun.TEMPLATE_HELP)
+    optional_args.add_argument("-a", "--alignment",
+                                type=str,
+                                required=False,
+                                default=None,
+                                help="Also write one alignment per population quintet from "
+                                "this .snps or sequential PHYLIP file, or genomatrix.py matrix; "
+                                "the alignment is read once and rows are indexed by popID")
+    optional_args.add_argument("-q", "--quintets",
+                                type=str,
+                                required=False,
+                                default=None,
+                                help="File with one quintet of popIDs per line: P1 P2 P3 P4 O")
+    optional_args.add_argument("-d", "--subset_dir",
+                                type=str,
+                                required=False,
+                                default="quintets",
+                                help="Directory for the quintet alignments, named "
+                                "P1_P2_P3_P4_O.EXT; default=quintets; " + batchrun.TEMPLATE_HELP)
+    optional_args.add_argument("-F", "--subset_formats",
+                                type=str,
+                                required=False,
+                                default="phylip",
+                                help="Comma-separated formats of the quintet alignments (see "
+                                "snps2phylip.py -F), or none to write only --row_index; "
+                                "default=phylip")
+    optional_args.add_argument("-M", "--matrix",
+                                type=str,
+                                required=False,
+                                default=None,
+                                help="Keep the genotype matrix built from a text --alignment "
+                                "as PREFIX.gmx (default: a temporary matrix is removed)")
+    optional_args.add_argument("-i", "--row_index",
+                                type=str,
+                                required=False,
+                                default=None,
+                                help="Write the matrix rows of every quintet to this "
+                                "tab-separated file, for slicing the memory-mapped matrix")
+    optional_args.add_argument("-P", "--processes",
+                                type=int,
+                                required=False,
+                                default=1,
+                                help="Worker processes writing quintet alignments; default=1")
+    optional_args.add_argument("--pandas",
+                                action="store_true",
+                                default=False,
+                                help="Join the maps with pandas instead of the "
+                                "default dict-based join; output is identical")
     optional_args.add_argument("-h", "--help",
                                 action="help",
                                 help="Displays this help menu")
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+### Shared instrumentation for the ddrad_scripts tools. Tools wrap their
+### hot paths in named stages (with profiling.stage("read"): ...) and add
+### record and byte counts; with --profile, one JSON line per stage and a
+### total line are written to stderr or a file, and --cprofile also dumps
+### cProfile statistics. Until a run is profiled, stage() returns a shared
+### no-op context and count() returns at once, so the calls can stay in place.
+
+import cProfile
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_enabled = False
+
+# Stage name -> [seconds, calls, records, bytes, peak RSS in MB]
+_stages = dict()
+
+
+class _NullStage(object):
+    """Context manager used for every stage while profiling is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """Context manager timing one stage while profiling is on."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        totals = _totals(self.name)
+        totals[0] += time.perf_counter() - self.start
+        totals[1] += 1
+        totals[4] = peak_rss_mb()
+        return False
+
+
+def _totals(name):
+    if name not in _stages:
+        _stages[name] = [0.0, 0, 0, 0, None]
+    return _stages[name]
+
+
+def enabled():
+    """
+    Function to check whether the current run is being profiled.
+    Returns:
+        bool
+    """
+    return _enabled
+
+
+def stage(name):
+    """
+    Function to time a named stage: with profiling.stage("write"): ...
+    Input:
+        name: stage name, e.g. "read", "transform", "write", "move" (string)
+    Returns:
+        context manager
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(name, records=0, nbytes=0):
+    """
+    Function to add records and bytes processed to a stage.
+    Input:
+        name: stage name (string)
+        records, nbytes (int)
+    Returns:
+        None
+    """
+    if not _enabled:
+        return
+    totals = _totals(name)
+    totals[2] += records
+    totals[3] += nbytes
+
+
+def count_files(name, paths, records=0):
+    """
+    Function to add the size of files to a stage; the files are only
+    stat'ed when profiling is on.
+    Input:
+        name: stage name (string)
+        paths: filenames; missing files are skipped (list)
+        records (int)
+    Returns:
+        None
+    """
+    if not _enabled:
+        return
+    nbytes = sum(os.path.getsize(path) for path in paths if path and os.path.isfile(path))
+    count(name, records, nbytes)
+
+
+def peak_rss_mb():
+    """
+    Function to get this process's peak resident memory.
+    Returns:
+        float (MB), or None where the resource module is unavailable
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / (1024.0 * 1024 if sys.platform == "darwin" else 1024.0), 1)
+
+
+def add_profile_arguments(group):
+    """
+    Function to add the shared --profile and --cprofile options to an
+    argparse parser or argument group.
+    Input:
+        group: argparse parser or argument group
+    Returns:
+        None
+    """
+    group.add_argument("--profile",
+                        type=str,
+                        required=False,
+                        nargs="?",
+                        const="-",
+                        default=None,
+                        help="Write stage timings, record and byte counts and peak "
+                        "memory as JSON lines to this file (appended), or to "
+                        "stderr if no file is given")
+    group.add_argument("--cprofile",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="Also write cProfile statistics for each input to "
+                        "PREFIX.INPUT.prof (read with pstats or snakeviz)")
+
+
+def run(worker, namespace, label):
+    """
+    Function to run worker(namespace), profiling it if the namespace has
+    --profile or --cprofile set. Called by batchrun for every input.
+    Input:
+        worker: function taking a namespace (function)
+        namespace: argparse namespace (argparse.Namespace)
+        label: input name written in the profile (string)
+    Returns:
+        the worker's return value
+    """
+    global _enabled
+
+    output = getattr(namespace, "profile", None)
+    prefix = getattr(namespace, "cprofile", None)
+    if output is None and prefix is None:
+        return worker(namespace)
+
+    _stages.clear()
+    _enabled = True
+    profiler = cProfile.Profile() if prefix is not None else None
+    status = None
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        status = worker(namespace)
+        return status
+    finally:
+        wall = time.perf_counter() - start
+        _enabled = False
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats("{}.{}.prof".format(prefix, os.path.basename(label)))
+        if output is not None:
+            emit(output, label, wall, status)
+
+
+def emit(output, label, wall, status):
+    """
+    Function to write one JSON line per stage plus a "total" line.
+    Input:
+        output: filename, or "-" for stderr (string)
+        label: input name (string)
+        wall: seconds for the whole input (float)
+        status: the worker's exit status, None if it raised (int)
+    Returns:
+        None
+    """
+    tool = os.path.basename(sys.argv[0])
+    lines = list()
+    for name, (seconds, calls, records, nbytes, peak) in _stages.items():
+        record = {"tool": tool, "input": label, "stage": name,
+                "seconds": round(seconds, 6), "calls": calls,
+                "records": records, "bytes": nbytes, "peak_rss_mb": peak}
+        if nbytes and seconds:
+            record["mb_per_s"] = round(nbytes / 1e6 / seconds, 2)
+        lines.append(json.dumps(record))
+
+    lines.append(json.dumps({"tool": tool, "input": label, "stage": "total",
+                            "seconds": round(wall, 6), "status": status,
+                            "pid": os.getpid(), "peak_rss_mb": peak_rss_mb()}))
+    text = "\n".join(lines) + "\n"
+
+    if output == "-":
+        sys.stderr.write(text)
+        sys.stderr.flush()
+    else:
+        # One append per input, so lines from batch workers do not interleave
+        with open(output, "a") as fout:
+            fout.write(text)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+### Single-pass parser for pyRAD .stats files shared by getbadpyrad.py and
+### samplePicker.py. Parsed files are cached on disk in FILE.parsed.json,
+### keyed on the file's modification time and size.
+
+import json
+import os
+
+import numpy as np
+
+import compressio
+
+# Summary line holding the number of loci used as the total by the scripts
+TOTAL_LOCI_KEY = "sampled unlinked SNPs"
+
+# Parse cache stored next to each .stats file; bump the version when the
+# parsed structure changes
+CACHE_EXT = ".parsed.json"
+CACHE_VERSION = 1
+
+
+class StatsSection(object):
+    """
+    One table from a .stats file.
+    Attributes:
+        comments: "##" lines preceding the table, without the "##" (list)
+        header: column names (list)
+        rows: rows as lists of strings (list)
+    """
+
+    def __init__(self, comments, header, rows):
+        self.comments = comments
+        self.header = header
+        self.rows = rows
+
+
+class SampleTable(object):
+    """
+    Per-sample block of a .stats file ("taxon nloci ...") with typed columns.
+    Attributes:
+        names: sample names, in file order (list)
+        columns: column name -> np.ndarray (int64, float64 or object) (dict)
+    """
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+
+    @property
+    def nloci(self):
+        """Locus counts per sample (first numeric column)."""
+        return next(iter(self.columns.values()))
+
+    def as_tuples(self):
+        """
+        Function to get the table as (name, nloci) tuples.
+        Returns:
+            list of tuples (string, int)
+        """
+        return list(zip(self.names, self.nloci.tolist()))
+
+
+class StatsFile(object):
+    """
+    Parsed .stats file.
+    Attributes:
+        samples: SampleTable for the "taxon" block
+        sections: first header column -> StatsSection, for every table (dict)
+        summary: "key= value" and "value ## key" lines, key -> string (dict)
+    """
+
+    def __init__(self, samples, sections, summary):
+        self.samples = samples
+        self.sections = sections
+        self.summary = summary
+
+    @property
+    def total_loci(self):
+        """Number of sampled unlinked SNPs (one per locus)."""
+        if TOTAL_LOCI_KEY not in self.summary:
+            raise ValueError("No '" + TOTAL_LOCI_KEY + "' line in .stats file")
+        return int(self.summary[TOTAL_LOCI_KEY])
+
+
+def load_stats(filename, use_cache=True):
+    """
+    Function to read a pyRAD .stats file, reusing the parse cached by an
+    earlier run if the file's modification time and size are unchanged
+    (see cache_path).
+    Input:
+        filename (string)
+        use_cache (bool)
+    Returns:
+        StatsFile
+    """
+    stat = os.stat(filename)
+    key = [CACHE_VERSION, stat.st_mtime_ns, stat.st_size]
+    cache_file = cache_path(filename)
+
+    if use_cache:
+        parsed = read_cache(cache_file, key)
+        if parsed is not None:
+            return parsed
+
+    with compressio.open_file(filename, "rt") as fin:
+        parsed = parse_stats(fin)
+
+    if use_cache:
+        write_cache(cache_file, key, parsed)
+    return parsed
+
+
+def cache_path(filename):
+    """
+    Function to name the parse cache of a .stats file.
+    Input:
+        filename (string)
+    Returns:
+        string: FILE.parsed.json, next to the .stats file
+    """
+    return os.path.normpath(os.path.abspath(filename)) + CACHE_EXT
+
+
+def read_cache(cache_file, key):
+    """
+    Function to load a cached parse. The sample table is rebuilt from the
+    cached "taxon" section.
+    Input:
+        cache_file (string)
+        key: [version, modification time, size] of the .stats file (list)
+    Returns:
+        StatsFile, or None if there is no usable cache for this key
+    """
+    try:
+        with open(cache_file, "r") as fin:
+            record = json.load(fin)
+        if record["key"] != key:
+            return None
+        sections = dict()
+        for comments, header, rows in record["sections"]:
+            sections.setdefault(header[0], StatsSection(comments, header, rows))
+        return StatsFile(make_sample_table(sections["taxon"]), sections, record["summary"])
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        return None
+
+
+def write_cache(cache_file, key, parsed):
+    """
+    Function to cache a parse atomically. A directory that cannot be
+    written to is skipped; the file is then parsed on every run.
+    Input:
+        cache_file (string)
+        key: as for read_cache (list)
+        parsed: StatsFile
+    Returns:
+        None
+    """
+    record = {"key": key,
+            "sections": [[section.comments, section.header, section.rows]
+                        for section in parsed.sections.values()],
+            "summary": parsed.summary}
+    temp = compressio.temp_name(cache_file)
+    try:
+        with open(temp, "w") as fout:
+            json.dump(record, fout)
+        os.replace(temp, cache_file)
+    except OSError:
+        pass
+    finally:
+        compressio.remove_temp(temp)
+
+
+def parse_stats(infile):
+    """
+    Function to parse every section of a .stats file in one pass.
+    Each line is stripped once. Tables start at the first non-comment line
+    after a comment or blank line and run to the next comment, blank or
+    "key= value" line.
+    Input:
+        infile: open file object or iterable of lines
+    Returns:
+        StatsFile
+    """
+    sections = dict()
+    summary = dict()
+    comments = list()
+    header = None
+    rows = None
+
+    for line in infile:
+        stripped = line.strip()
+
+        if not stripped or stripped.startswith("##") or "=" in stripped:
+            if header is not None:
+                sections.setdefault(header[0], StatsSection(comments, header, rows))
+                header = None
+                comments = list()
+            if "=" in stripped and not stripped.startswith("##"):
+                # e.g. "sampled unlinked SNPs= 100"
+                key, value = stripped.split("=", 1)
+                summary[key.strip()] = value.strip()
+            elif stripped:
+                comments.append(stripped.lstrip("#").strip())
+            continue
+
+        if header is None:
+            if "##" in stripped:
+                # e.g. "108       ## loci with > minsp containing data"
+                value, key = stripped.split("##", 1)
+                summary[key.strip()] = value.strip()
+                continue
+            # A header starting with a tab has an unnamed index column.
+            header = line.rstrip("\r\n").split("\t") if line.startswith("\t") else stripped.split()
+            header = [col.strip() or "index" for col in header]
+            rows = list()
+            continue
+
+        rows.append(stripped.split())
+
+    if header is not None:
+        sections.setdefault(header[0], StatsSection(comments, header, rows))
+
+    if "taxon" not in sections:
+        raise ValueError("No 'taxon' sample block in .stats file")
+
+    return StatsFile(make_sample_table(sections["taxon"]), sections, summary)
+
+
+def make_sample_table(section):
+    """
+    Function to convert the "taxon" section to typed column arrays.
+    Input:
+        section: StatsSection
+    Returns:
+        SampleTable
+    """
+    names = [row[0] for row in section.rows]
+    columns = dict()
+
+    for i, col in enumerate(section.header[1:], start=1):
+        values = [row[i] if i < len(row) else "" for row in section.rows]
+        columns[col] = to_array(values)
+
+    return SampleTable(names, columns)
+
+
+def to_array(values):
+    """
+    Function to convert strings to the narrowest of int64, float64 or object.
+    Input:
+        values: list of strings
+    Returns:
+        np.ndarray
+    """
+    for dtype in (np.int64, np.float64):
+        try:
+            return np.array(values, dtype=dtype)
+        except ValueError:
+            pass
+    return np.array(values, dtype=object)
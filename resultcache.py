@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+### Opt-in on-disk result cache for the ddrad_scripts tools. A run is keyed
+### on its inputs (their path, size, modification time and inode, or their
+### content with --cache_key content), the options that change its output,
+### the compression of each output and the scripts themselves. A rerun with
+### the same key restores its outputs by hardlinking (or, across file
+### systems, copying) the cached files instead of redoing the work. The cache
+### is bounded in size; the least recently used entries are evicted first.
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import compressio
+
+# Cache directory used when --cache is given without one, or set in the
+# environment to turn the cache on for every run (--no-cache overrides it)
+CACHE_ENV = "DDRAD_CACHE"
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ddrad_scripts")
+
+# Default size limit in GB
+DEFAULT_SIZE = 10.0
+
+# Chunk size when hashing input contents
+HASH_CHUNK = 1024 * 1024
+
+MANIFEST = "manifest.json"
+
+
+class _NullCache(object):
+    """Cache used when caching is off: never hits and stores nothing."""
+
+    key = None
+
+    def restore(self):
+        return False
+
+    def store(self):
+        pass
+
+
+_NULL_CACHE = _NullCache()
+
+
+class ResultCache(object):
+    """
+    Cached outputs of one run of a tool on one input.
+    Attributes:
+        root: cache directory (string)
+        key: hex digest identifying the run (string)
+        outputs: output filenames, in a fixed order (list)
+        limit: size limit in bytes (int)
+        sidecars: checksum sidecar filename -> its output's filename (dict)
+    """
+
+    def __init__(self, root, key, outputs, limit, sidecars=None):
+        self.root = root
+        self.key = key
+        self.outputs = list(outputs)
+        self.limit = limit
+        self.sidecars = dict(sidecars or {})
+        self.entry = os.path.join(root, "entries", key)
+
+    def restore(self):
+        """
+        Function to restore the outputs from the cache. Entries whose files
+        were changed since they were stored (e.g. an output hardlinked from
+        the cache was edited in place) are dropped. Checksum sidecars are
+        rewritten to name the restored output. If an output cannot be
+        placed, the outputs restored before it are removed again.
+        Returns:
+            bool: True if the outputs were restored
+        """
+        try:
+            with open(os.path.join(self.entry, MANIFEST), "r") as fin:
+                manifest = json.load(fin)
+            for index, size, mtime in manifest["files"]:
+                st = os.stat(os.path.join(self.entry, str(index)))
+                if st.st_size != size or st.st_mtime_ns != mtime:
+                    raise ValueError("modified cache entry")
+        except (OSError, ValueError, KeyError):
+            if os.path.isdir(self.entry):
+                shutil.rmtree(self.entry, ignore_errors=True)
+            return False
+
+        placed = list()
+        try:
+            for index, size, mtime in manifest["files"]:
+                cached = os.path.join(self.entry, str(index))
+                filename = self.outputs[index]
+                if filename in self.sidecars:
+                    with open(cached, "r") as fin:
+                        compressio.save_sidecar(self.sidecars[filename], json.load(fin))
+                else:
+                    place(cached, filename)
+                placed.append(filename)
+        except (OSError, ValueError):
+            for filename in placed:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            return False
+
+        # The manifest's modification time orders entries for eviction
+        os.utime(os.path.join(self.entry, MANIFEST))
+        print("Restored {} cached output(s) for key {}".format(len(manifest["files"]),
+                                                                self.key[:12]))
+        return True
+
+    def store(self):
+        """
+        Function to hardlink the outputs that exist into a new cache entry
+        (copying them if the cache is on another file system), then
+        evict the least recently used entries beyond the size limit. The
+        entry is built in a temporary directory and renamed into place, so
+        concurrent runs never see a partial entry.
+        Returns:
+            None
+        """
+        entries = os.path.join(self.root, "entries")
+        try:
+            os.makedirs(entries, exist_ok=True)
+            staging = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        except OSError as e:
+            print("Warning: Could not write to the cache {}: {}".format(self.root, e))
+            return
+
+        try:
+            files = list()
+            for index, filename in enumerate(self.outputs):
+                if not os.path.isfile(filename):
+                    continue
+                cached = os.path.join(staging, str(index))
+                # Outputs are replaced by rename, never rewritten in place, so a
+                # hardlink keeps the stored contents; edits in place are caught
+                # by the size and mtime check in restore()
+                try:
+                    os.link(filename, cached)
+                except OSError:
+                    shutil.copyfile(filename, cached)
+                st = os.stat(cached)
+                files.append([index, st.st_size, st.st_mtime_ns])
+            with open(os.path.join(staging, MANIFEST), "w") as fout:
+                json.dump({"files": files, "created": time.time(),
+                            "tool": os.path.basename(sys.argv[0])}, fout)
+            os.rename(staging, self.entry)
+        except OSError:
+            # Another run stored the same key first, or the disk is full
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        evict(self.root, self.limit)
+
+
+def add_cache_arguments(group):
+    """
+    Function to add the shared --cache, --no-cache, --cache_size and
+    --cache_key options to an argparse parser or argument group.
+    Input:
+        group: argparse parser or argument group
+    Returns:
+        None
+    """
+    group.add_argument("--cache",
+                        type=str,
+                        required=False,
+                        nargs="?",
+                        const=DEFAULT_DIR,
+                        default=os.environ.get(CACHE_ENV) or None,
+                        help="Reuse the outputs of earlier runs with the same inputs and "
+                        "options from this cache directory (default " + DEFAULT_DIR +
+                        "); also turned on by setting " + CACHE_ENV + "=DIR")
+    group.add_argument("--no-cache", "--no_cache",
+                        dest="no_cache",
+                        action="store_true",
+                        default=False,
+                        help="Neither read nor write the cache, even if --cache or " +
+                        CACHE_ENV + " is set")
+    group.add_argument("--cache_size",
+                        type=float,
+                        required=False,
+                        default=DEFAULT_SIZE,
+                        help="Cache size limit in GB; least recently used results are "
+                        "evicted; default = " + str(DEFAULT_SIZE))
+    group.add_argument("--cache_key",
+                        type=str,
+                        required=False,
+                        default="stat",
+                        choices=["stat", "content"],
+                        help="Identify inputs by path, size, modification time and inode "
+                        "(stat; fast) or by hashing their contents (content); default = stat")
+
+
+def open_cache(namespace, inputs, outputs, options, cacheable=True):
+    """
+    Function to get the cache for one run.
+    Input:
+        namespace: argparse namespace with the cache options
+        inputs: input filenames the outputs depend on (list)
+        outputs: output filenames, in a fixed order (list)
+        options: options that change the outputs (dict of JSON values)
+        cacheable: False for runs whose outputs are not reproducible, e.g.
+                    random subsets without a seed (bool)
+    Returns:
+        ResultCache, or a no-op cache if caching is off or an input is missing
+    """
+    root = getattr(namespace, "cache", None)
+    if root is None or getattr(namespace, "no_cache", False) or not cacheable:
+        return _NULL_CACHE
+
+    sidecars = dict()
+    if compressio.checksums_enabled():
+        # Sidecars are cached with their outputs (see compressio.write_sidecar)
+        sidecars = dict((compressio.sidecar_name(filename), filename) for filename in outputs)
+        outputs = list(outputs) + list(sidecars)
+
+    try:
+        key = run_key(inputs, outputs, options, namespace.cache_key)
+    except OSError:
+        # Let the tool report the missing input
+        return _NULL_CACHE
+    return ResultCache(os.path.abspath(root), key, outputs, int(namespace.cache_size * 1024 ** 3),
+                        sidecars)
+
+
+def run_key(inputs, outputs, options, mode="stat"):
+    """
+    Function to build the key of one run.
+    Input:
+        inputs: input filenames (list)
+        outputs: output filenames; only their compression enters the key (list)
+        options: options that change the outputs (dict)
+        mode: "stat" or "content" (string)
+    Returns:
+        hex digest (string)
+    """
+    record = {"tool": os.path.basename(sys.argv[0]),
+            "code": code_version(),
+            "inputs": [fingerprint(filename, mode) for filename in inputs],
+            "outputs": [compressio.output_codec(filename) for filename in outputs],
+            "options": options}
+    text = json.dumps(record, sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+def fingerprint(filename, mode="stat"):
+    """
+    Function to identify one input.
+    Input:
+        filename (string)
+        mode: "stat" (path, size, modification time and inode) or "content"
+                (size and BLAKE2 hash of the bytes) (string)
+    Returns:
+        list
+    Raises:
+        OSError if the file cannot be read
+    """
+    st = os.stat(filename)
+    if mode == "stat":
+        return [os.path.realpath(filename), st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev]
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return [st.st_size, digest.hexdigest()]
+
+
+def code_version():
+    """
+    Function to identify the scripts, so editing any of them invalidates
+    earlier results.
+    Returns:
+        list of (filename, size, modification time) lists
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    return [[name, st.st_size, st.st_mtime_ns]
+            for name, st in ((name, os.stat(os.path.join(here, name)))
+                            for name in sorted(os.listdir(here)) if name.endswith(".py"))]
+
+
+def place(cached, filename):
+    """
+    Function to put a cached file at an output name: a hardlink where the
+    cache and output share a file system, a copy otherwise. The link or copy
+    is made under a temporary name and renamed over any existing output, so
+    the output is never partial and an old hardlink is not written through.
+    Input:
+        cached, filename (string)
+    Returns:
+        None
+    """
+    temp = compressio.temp_name(filename)
+    try:
+        try:
+            os.link(cached, temp)
+        except OSError:
+            shutil.copyfile(cached, temp)
+        compressio.remove_sidecar(filename)
+        os.replace(temp, filename)
+    finally:
+        compressio.remove_temp(temp)
+
+
+def evict(root, limit):
+    """
+    Function to remove the least recently used entries until the cache
+    fits in limit bytes.
+    Input:
+        root: cache directory (string)
+        limit: size limit in bytes (int)
+    Returns:
+        int: number of entries removed
+    """
+    entries = os.path.join(root, "entries")
+    found = list()
+    total = 0
+    for name in os.listdir(entries):
+        entry = os.path.join(entries, name)
+        try:
+            used = os.stat(os.path.join(entry, MANIFEST)).st_mtime
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        except OSError:
+            continue
+        found.append((used, size, entry))
+        total += size
+
+    removed = 0
+    for used, size, entry in sorted(found):
+        if total <= limit:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
@@ -2,35 +2,101 @@
 
 import argparse
 import csv
-import operator
+import heapq
+import re
 import sys
 
+import numpy as np
+
+import batchrun
+import compressio
+import genomatrix
+import popmap2exDFOIL
+import profiling
+import pyradstats
+import resultcache
+
+# Populations or samples listed per warning before truncating
+MAX_REPORTED = 10
 
 def main():
 
     arguments = Get_Arguments()
+    compressio.set_threads(arguments.io_threads)
+    compressio.set_checksum(arguments.checksum)
+
+    infiles = batchrun.expand_inputs(arguments.file)
+
+    try:
+        namespaces = batchrun.per_input_arguments(arguments, "file", infiles, ["out"])
+    except ValueError as e:
+        print("\nError: " + str(e) + "\n")
+        return 1
+
+    return batchrun.run_batch(pick_samples, namespaces, infiles, arguments.jobs)
+
+def pick_samples(arguments):
+    # Picks samples from one input file; arguments holds a single input and prefix.
+
     file = arguments.file
     outfile = arguments.out
     stats = arguments.stats
     phylip = arguments.phylip
-    start = arguments.start
-    end = arguments.end
     to_keep = arguments.keep
     
     if stats and phylip:
         raise Exception("Error: Only one input file type can be specified")
         return 1
-    
-    if stats:
-        try:
-            with open(file, "r") as fin:
-                total_loci, sample_lst = read_stats(fin)
-        except IOError:
-            print("\nError: The file " + file + " does not exist.\n")
-            return 1
-            
-        sorted_lst = sort_list_of_tuples(sample_lst, start, end)
-        keepers, excluded = get_first_n_samples(sorted_lst, start, end, to_keep)
+
+    if not stats and not phylip:
+        print("\nError: One of --stats or --phylip must be specified\n")
+        return 1
+
+    if arguments.regex and arguments.popmap:
+        print("\nError: Only one of --regex or --popmap can be specified\n")
+        return 1
+
+    if to_keep < 1:
+        print("\nError: -k must be at least 1\n")
+        return 1
+
+    # A compression extension on the prefix moves to the end: out.gz -> out.keepers.csv.gz
+    prefix, compression = compressio.split_extension(outfile)
+    keep_ext = (prefix + ".keepers.csv" + compression)
+    excl_ext = (prefix + ".excluded.csv" + compression)
+
+    cache = open_cache(arguments, [keep_ext, excl_ext])
+    if cache.restore():
+        return 0
+
+    try:
+        key = population_key(arguments)
+    except IOError:
+        print("\nError: The file " + arguments.popmap + " does not exist.\n")
+        return 1
+    except re.error as e:
+        print("\nError: Invalid --regex: " + str(e) + "\n")
+        return 1
+
+    try:
+        with profiling.stage("read"):
+            if stats:
+                total_loci, sample_lst = read_stats(file)
+            else:
+                sample_lst = read_phylip(file)
+    except IOError:
+        print("\nError: The file " + file + " does not exist.\n")
+        return 1
+
+    profiling.count_files("read", [file], len(sample_lst))
+
+    if sample_lst:
+        with profiling.stage("select"):
+            keepers, excluded, unassigned, small = select_top_n(sample_lst, key, to_keep,
+                                                                arguments.tie_break)
+        profiling.count("select", len(sample_lst))
+        report_groups(unassigned, small, to_keep)
+        excluded.extend(unassigned)
         
         print(keepers)
         
@@ -38,18 +104,18 @@ def main():
         excluded_count = len(excluded)
         
         try:
-            keep_ext = (outfile + ".keepers.csv")
-            excl_ext = (outfile + ".excluded.csv")
-            with open(keep_ext, "w") as fout:
+            with profiling.stage("write"), compressio.open_file(keep_ext, "wt", newline="") as fout:
                 wr = csv.writer(fout, delimiter=",")
                 wr.writerows([keepers])
                 print("\n\nSamples to keep written to: " + keep_ext)
                 print("Number of samples kept: " + str(keep_count) + "\n")
-            with open(excl_ext, "w") as fout:
+            with profiling.stage("write"), compressio.open_file(excl_ext, "wt", newline="") as fout:
                 wr = csv.writer(fout, delimiter=",")
                 wr.writerows([excluded])
                 print("Samples to exclude written to: " + excl_ext)
                 print("Number of samples excluded: " + str(excluded_count) + "\n\n")
+            profiling.count_files("write", [keep_ext, excl_ext], keep_count + excluded_count)
+            cache.store()
 
         except IOError:
             print("Error: Could not write output to files; aborting program")
@@ -68,8 +134,8 @@ def Get_Arguments():
 
     required_args.add_argument("-k", "--keep", type=int, required=True,
                         help="Number of samples to keep for each taxon")
-    required_args.add_argument("-f", "--file", type=str, required=True,
-                        help="Input file name")
+    required_args.add_argument("-f", "--file", type=str, required=True, nargs="+",
+                        help="Input file name(s) or glob(s)")
     choose_one.add_argument("-p", "--phylip", action="store_true",default=False,
                         help="Boolean; Toggles PHYLIP input format; default=True")
     choose_one.add_argument("-S", "--stats", action="store_true", default=False,
@@ -81,93 +147,144 @@ def Get_Arguments():
                         help="Specify first character of sample ID to be used as pattern for population ID; default=1")
     optional_args.add_argument("-e", "--end", type=int, required=False, nargs="?", default="4",
                         help="Specify last character of sample ID to be used as pattern for population ID; default=4")
+    optional_args.add_argument("-r", "--regex", type=str, required=False, default=None,
+                        help="Regular expression giving the population ID of each sample ID (first capture group, or the whole match); "
+                        "replaces -s/-e; samples that do not match are excluded")
+    optional_args.add_argument("-P", "--popmap", type=str, required=False, default=None,
+                        help="Tab-separated popmap file (indID\tpopID) giving the population of each sample; "
+                        "replaces -s/-e; samples not in the popmap are excluded")
+    optional_args.add_argument("-t", "--tie_break", type=str, required=False, default="name",
+                        choices=["name", "order"],
+                        help="Order of samples with equal scores: name (sample ID) or order (input order); default=name")
     optional_args.add_argument("-o", "--out", type=str, required=False, nargs="?", default="out",
-                        help="Specify output file prefix for samples to keep (best samples); default=out")
+                        help="Specify output file prefix for samples to keep (best samples); default=out; " + batchrun.TEMPLATE_HELP)
+    batchrun.add_jobs_argument(optional_args)
+    compressio.add_threads_argument(optional_args)
+    compressio.add_checksum_argument(optional_args)
+    profiling.add_profile_arguments(optional_args)
+    resultcache.add_cache_arguments(optional_args)
     args = parser.parse_args()
 
     return args
     
-def read_stats(infile):
-    
+def read_stats(file):
+    # Reads (sample, nloci) tuples and the number of sampled unlinked SNPs
+    # with the shared pyradstats parser.
+
+    stats = pyradstats.load_stats(file)
+    return stats.total_loci, stats.samples.as_tuples()
+
+def read_phylip(file):
+    # Scores each sample by its number of non-missing sites (see genomatrix.MISSING_CHARS).
+    # A genotype matrix built with genomatrix.py is scored in chunked, vectorized passes
+    # over the memmap; a PHYLIP file is streamed one row at a time and each row is
+    # scored as a byte array, so no per-character Python loop runs.
+
+    if genomatrix.is_matrix(file):
+        gmx = genomatrix.open_matrix(file)
+        present = gmx.nsites - genomatrix.missing_per_sample(gmx.data)
+        return list(zip(gmx.samples, present.tolist()))
+
     my_lst = list()
-    
-    for line in infile:
-        line = line.rstrip()     
-        if line.strip().startswith('taxon'):
-            break
-            
-    for line in infile:
-
-        line = line.rstrip()
-        if line.strip().startswith('##'):
-            break
-            
-        if line.strip():
-            columns = line.split()
-            my_tuple = (columns[0], int(columns[1]))
-            my_lst.append(my_tuple)
-            
-
-    for line in infile:
-        if line.strip().startswith('sampled unlinked SNPs'):
-            line = line.rstrip()
-            snps = line.split("=")
-            numloci = snps[1].strip()
-            
-    return numloci, my_lst
-
-def sort_list_of_tuples(my_tpl_lst, start, end):
-
-    sorted_tpl = sorted(sorted(my_tpl_lst, key = lambda x: x[1], reverse = True), key = lambda x: x[0][start-1:end])
-    return sorted_tpl
-
-def get_first_n_samples(my_lst, start, end, keep_val):
+    for name, seq, raw in genomatrix.iter_rows(file, "phylip"):
+        row = np.frombuffer(seq, dtype=np.uint8)
+        present = len(seq) - int(np.count_nonzero(genomatrix.MISSING_LUT[row]))
+        my_lst.append((name.decode(), present))
+
+    return my_lst
+
+def open_cache(arguments, outputs):
+    # Returns the result cache for one input (see resultcache.py); a popmap is
+    # keyed as an input too.
+
+    file = arguments.file
+    if arguments.phylip and genomatrix.is_matrix(file):
+        prefix = genomatrix.matrix_prefix(file)
+        inputs = [prefix + ext for ext in (genomatrix.MATRIX_EXT, genomatrix.INDEX_EXT, genomatrix.LOCI_EXT)]
+    else:
+        inputs = [file]
+    if arguments.popmap:
+        inputs.append(arguments.popmap)
+
+    options = dict((name, getattr(arguments, name)) for name in
+                ("keep", "stats", "phylip", "start", "end", "regex", "tie_break"))
+    return resultcache.open_cache(arguments, inputs, outputs, options)
+
+def population_key(arguments):
+    # Returns a function mapping a sample name to its population, or to None for
+    # samples that cannot be assigned: a popmap lookup, the first capture group
+    # (or whole match) of --regex, or the [start-1:end] slice of the name.
+
+    if arguments.popmap:
+        popmap = dict(popmap2exDFOIL.read_popmap(arguments.popmap))
+        return popmap.get
+
+    if arguments.regex:
+        pattern = re.compile(arguments.regex)
+        def from_regex(name):
+            match = pattern.search(name)
+            if match is None:
+                return None
+            return match.group(1) if pattern.groups else match.group(0)
+        return from_regex
+
+    start = arguments.start
+    end = arguments.end
+    return lambda name: name[start-1:end]
+
+def select_top_n(sample_lst, key, keep_val, tie_break="name"):
+    # Groups (name, score) tuples by population in one pass over a dict, then
+    # takes the keep_val best samples of each group with a bounded heap, so the
+    # selection is O(n log k). Ties on the score are broken by sample name or by
+    # input order. Populations are written in sorted order, keepers best first
+    # and exclusions in input order, so the output is the same on every run.
+    # Returns keepers, exclusions, unassigned samples and the populations with
+    # fewer than keep_val samples as (population, size) tuples.
+
+    groups = dict()
+    unassigned = list()
+    for index, (name, score) in enumerate(sample_lst):
+        pop = key(name)
+        if pop is None:
+            unassigned.append(name)
+        else:
+            groups.setdefault(pop, []).append(index)
+
+    if tie_break == "order":
+        rank = lambda i: (-sample_lst[i][1], i)
+    else:
+        rank = lambda i: (-sample_lst[i][1], sample_lst[i][0], i)
 
     keep_lst = list()
     exclusions = list()
-    counter = 0
-    exclude_counter = 0
-    previous_ind = None
-    previous_pattern = None
+    small = list()
+    for pop in sorted(groups):
+        members = groups[pop]
+        if len(members) < keep_val:
+            small.append((pop, len(members)))
+        best = heapq.nsmallest(keep_val, members, key=rank)
+        chosen = set(best)
+        keep_lst.extend(sample_lst[i][0] for i in best)
+        exclusions.extend(sample_lst[i][0] for i in members if i not in chosen)
 
-    
-    for ind in my_lst:
-    
-        pattern = str(ind[0][start-1:end])
-        
-        if pattern == previous_pattern:
-           
-            if counter < keep_val and keep_val != 1:
-                counter += 1
-                keep_lst.append(ind[0])
-            elif counter >= keep_val:
-                exclude_counter += 1
-                exclusions.append(ind[0])
-           # print(pattern + "\t" + str(counter))
-        elif previous_pattern == None:
-            counter += 1
-            keep_lst.append(ind[0])
-            #print(pattern + "\t" + str(counter))
-
-        elif pattern != previous_pattern:
-            if counter < keep_val and counter == 1:
-                keep_lst.append(ind[0])
-                print("Warning: Population " + previous_pattern + " only contains " + str(counter) + " individuals (fewer than -k option)")
-
-            elif counter < keep_val and counter > 1:
-                print("Warning: Population " + previous_pattern + " only contains " + str(counter) + " individuals (fewer than -k option)")
-            
-            elif counter == keep_val and counter == 1:
-                keep_lst.append(ind[0])
-            else:
-                keep_lst.append(ind[0])
-            #print(pattern + "\t" + str(counter))
-            counter = 1
-            
-        previous_pattern = pattern
-        previous_ind = ind[0]
-        
-    return keep_lst, exclusions
+    return keep_lst, exclusions, unassigned, small
+
+def report_groups(unassigned, small, keep_val):
+    # Prints one summary line for populations smaller than -k and one for
+    # samples without a population, instead of a warning per population.
+
+    if small:
+        listed = ", ".join("{} ({})".format(pop, size) for pop, size in small[:MAX_REPORTED])
+        if len(small) > MAX_REPORTED:
+            listed += ", ... " + str(len(small) - MAX_REPORTED) + " more"
+        print("Warning: " + str(len(small)) + " population(s) contain fewer than " +
+            str(keep_val) + " individuals (-k option); all were kept: " + listed)
+    if unassigned:
+        listed = ", ".join(unassigned[:MAX_REPORTED])
+        if len(unassigned) > MAX_REPORTED:
+            listed += ", ... " + str(len(unassigned) - MAX_REPORTED) + " more"
+        print("Warning: " + str(len(unassigned)) + " sample(s) could not be assigned " +
+            "to a population and were excluded: " + listed)
 
         
 if __name__ == "__main__":
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+### Pluggable alignment writers used by snps2phylip.py. Every writer takes one
+### sample row at a time, so several formats can be written from one read of
+### the input. Headers that need the sample count are reserved at a fixed
+### width and rewritten in place once the count is known. Outputs ending in
+### .gz, .bgz or .zst are compressed (see compressio.py).
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import compressio
+import genomatrix
+
+# Output buffer size; rows are flushed to disk in blocks of this many bytes
+WRITE_BUFFER = 8 * 1024 * 1024
+
+# Width reserved for headers whose counts are only known after the last row
+HEADER_WIDTH = 40
+
+# Default number of sites per block in interleaved PHYLIP
+BLOCK_WIDTH = 100
+
+# 2-bit codes for unambiguous bases; everything else is flagged as missing
+BASE2_LUT = np.zeros(256, dtype=np.uint8)
+for code, value in zip(b"ACGTU", (0, 1, 2, 3, 3)):
+    BASE2_LUT[code] = value
+    BASE2_LUT[code + 32] = value
+
+
+class AlignmentWriter(object):
+    """
+    Base class for writers. Subclasses set EXTENSION and implement
+    write_header(), write_row() and write_footer().
+    """
+
+    EXTENSION = ""
+    HAS_HEADER = True
+    # (prefix, separator) for formats whose rows are written as
+    # prefix + name + separator + sequence + newline, or None; such rows can
+    # be written independently at precomputed offsets (see parallelrows.py)
+    ROW_LAYOUT = None
+
+    def __init__(self, filename, nsamples=None, nsites=None, **options):
+        self.filename = filename
+        self.nsamples = nsamples
+        self.nsites = nsites
+        self.count = 0
+        self.options = options
+        self.body = None
+        codec = compressio.output_codec(filename)
+
+        if codec is None:
+            self.fout = compressio.open_file(filename, "wb", buffering=WRITE_BUFFER)
+        elif nsamples is None and self.HAS_HEADER:
+            # A compressed stream cannot be rewritten in place, so rows go to a
+            # separate body file; close() writes the header as its own
+            # compressed member and appends the body (gzip members and zstd
+            # frames concatenate into one stream). The body gets a hidden
+            # temporary name, so an interrupted run leaves no FILE.body.
+            self.body = compressio.temp_name(filename)
+            self.fout = compressio.open_writer(self.body, codec, compressio.get_threads())
+        else:
+            self.fout = compressio.open_file(filename, "wb")
+
+        if self.body is None:
+            self.write_header()
+
+    def add(self, name, seq):
+        """
+        Function to write one sample row.
+        Input:
+            name: sample name (bytes)
+            seq: sequence without locus separators (bytes)
+        Returns:
+            None
+        """
+        if self.nsites is None:
+            self.nsites = len(seq)
+        elif len(seq) != self.nsites:
+            raise ValueError("Sample {} has {} sites; expected {}".format(
+                            name.decode(), len(seq), self.nsites))
+        self.write_row(name, seq)
+        self.count += 1
+
+    def close(self):
+        """
+        Function to finish the file, rewriting the header if the sample
+        count was not known when it was written. The output is renamed into
+        place only now (see compressio.AtomicWriter).
+        Returns:
+            None
+        """
+        self.write_footer()
+        if self.nsamples is None:
+            self.nsamples = self.count
+            if self.body is None:
+                self.fout.seek(0)
+                self.write_header()
+            else:
+                self.fout.close()
+                temp = compressio.temp_name(self.filename)
+                self.fout = compressio.open_writer(temp, compressio.output_codec(self.filename),
+                                                compressio.get_threads(), self.filename)
+                self.write_header()
+                self.fout.close()
+                self.fout = compressio.AtomicWriter(open(temp, "ab"), temp, self.filename)
+                with open(self.body, "rb") as fin:
+                    shutil.copyfileobj(fin, self.fout, WRITE_BUFFER)
+                compressio.remove_temp(self.body)
+        # Rows, not lines, are the records of an alignment
+        self.fout.records = self.count
+        self.fout.close()
+
+    def discard(self):
+        """
+        Function to close the file without creating the output, e.g. after
+        an error part way through.
+        Returns:
+            None
+        """
+        if hasattr(self.fout, "discard"):
+            self.fout.discard()
+        else:
+            self.fout.close()
+        if self.body is not None:
+            compressio.remove_temp(self.body)
+
+    def write_header(self):
+        pass
+
+    def write_row(self, name, seq):
+        raise NotImplementedError
+
+    def write_footer(self):
+        pass
+
+    def counts(self, template):
+        """
+        Function to format a header line; blank and HEADER_WIDTH wide until
+        the counts are known. A header rewritten in place keeps that width
+        by right-aligning the sample count with leading spaces (as in
+        classic PHYLIP headers), so the line has no trailing spaces.
+        """
+        if self.nsamples is None:
+            return b" " * HEADER_WIDTH
+        line = template.format(self.nsamples, self.nsites)
+        if self.count and self.body is None:
+            width = len(str(self.nsamples)) + HEADER_WIDTH - len(line)
+            line = template.format(str(self.nsamples).rjust(width), self.nsites)
+        return line.encode()
+
+
+class PhylipWriter(AlignmentWriter):
+    """Sequential PHYLIP: name, tab, sequence."""
+
+    EXTENSION = ".phy"
+    ROW_LAYOUT = (b"", b"\t")
+
+    def write_header(self):
+        self.fout.write(self.counts("{} {}") + b"\n")
+
+    def write_row(self, name, seq):
+        self.fout.write(name)
+        self.fout.write(b"\t")
+        self.fout.write(seq)
+        self.fout.write(b"\n")
+
+    def write_footer(self):
+        self.fout.write(b"\n")
+
+
+class InterleavedPhylipWriter(PhylipWriter):
+    """
+    Interleaved PHYLIP with options["block_width"] sites per block. Rows are
+    spooled to a temporary memory-mapped file until close().
+    """
+
+    EXTENSION = ".interleaved.phy"
+    ROW_LAYOUT = None
+
+    def __init__(self, filename, nsamples=None, nsites=None, **options):
+        self.names = list()
+        self.spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)))
+        AlignmentWriter.__init__(self, filename, nsamples, nsites, **options)
+
+    def write_row(self, name, seq):
+        self.names.append(name)
+        self.spool.write(seq)
+
+    def write_footer(self):
+        width = self.options.get("block_width") or BLOCK_WIDTH
+        pad = max(len(name) for name in self.names) + 2 if self.names else 0
+        self.spool.flush()
+        if self.count and self.nsites:
+            rows = np.memmap(self.spool, dtype=np.uint8, mode="r",
+                            shape=(self.count, self.nsites))
+            for start in range(0, self.nsites, width):
+                if start:
+                    self.fout.write(b"\n")
+                for name, row in zip(self.names, rows):
+                    self.fout.write(name.ljust(pad) if start == 0 else b" " * pad)
+                    self.fout.write(row[start:start + width].tobytes())
+                    self.fout.write(b"\n")
+            del rows
+        self.spool.close()
+
+    def discard(self):
+        self.spool.close()
+        AlignmentWriter.discard(self)
+
+
+class NexusWriter(AlignmentWriter):
+    """NEXUS data block in sequential format."""
+
+    EXTENSION = ".nex"
+    ROW_LAYOUT = (b"\t", b"\t")
+
+    def write_header(self):
+        self.fout.write(b"#NEXUS\nbegin data;\n")
+        self.fout.write(self.counts("\tdimensions ntax={} nchar={};") + b"\n")
+        self.fout.write(b"\tformat datatype=dna missing=N gap=-;\n\tmatrix\n")
+
+    def write_row(self, name, seq):
+        self.fout.write(b"\t")
+        self.fout.write(name)
+        self.fout.write(b"\t")
+        self.fout.write(seq)
+        self.fout.write(b"\n")
+
+    def write_footer(self):
+        self.fout.write(b"\t;\nend;\n")
+
+
+class FastaWriter(AlignmentWriter):
+    """Unwrapped FASTA."""
+
+    EXTENSION = ".fasta"
+    HAS_HEADER = False
+    ROW_LAYOUT = (b">", b"\n")
+
+    def write_row(self, name, seq):
+        self.fout.write(b">")
+        self.fout.write(name)
+        self.fout.write(b"\n")
+        self.fout.write(seq)
+        self.fout.write(b"\n")
+
+
+class PackedWriter(AlignmentWriter):
+    """
+    Packed binary genotypes with a JSON sidecar (FILE.json) holding sample
+    names, dimensions and the encoding. Each row is a fixed number of bytes,
+    so the file can be opened with np.memmap.
+    4-bit: one IUPAC bitmask per site (A=1, C=2, G=4, T=8; N and gaps = 15),
+           two sites per byte, first site in the high nibble.
+    2-bit: A=0, C=1, G=2, T=3, four sites per byte, first site in the high
+           bits, followed by a bitmask (np.packbits order) flagging sites that
+           are not an unambiguous base.
+    """
+
+    BITS = 4
+    HAS_HEADER = False
+
+    def __init__(self, filename, nsamples=None, nsites=None, **options):
+        self.names = list()
+        AlignmentWriter.__init__(self, filename, nsamples, nsites, **options)
+
+    def write_row(self, name, seq):
+        row = np.frombuffer(seq, dtype=np.uint8)
+        self.names.append(name.decode())
+        if self.BITS == 4:
+            self.fout.write(pack_4bit(row).tobytes())
+        else:
+            codes, missing = pack_2bit(row)
+            self.fout.write(codes.tobytes())
+            self.fout.write(missing.tobytes())
+
+    def close(self):
+        self.fout.records = self.count
+        self.fout.close()
+        index = {"encoding": "{}bit".format(self.BITS),
+                "nsamples": self.count,
+                "nsites": self.nsites,
+                "samples": self.names}
+        with compressio.open_file(self.filename + ".json", "wt") as fout:
+            json.dump(index, fout)
+
+
+class Packed4Writer(PackedWriter):
+    EXTENSION = ".4bit"
+    BITS = 4
+
+
+class Packed2Writer(PackedWriter):
+    EXTENSION = ".2bit"
+    BITS = 2
+
+
+# Format name -> writer class; add new formats here
+WRITERS = {"phylip": PhylipWriter,
+        "phylip-interleaved": InterleavedPhylipWriter,
+        "nexus": NexusWriter,
+        "fasta": FastaWriter,
+        "bin4": Packed4Writer,
+        "bin2": Packed2Writer}
+
+
+def pack_4bit(row):
+    """
+    Function to pack a row into 4-bit IUPAC bitmasks.
+    Input:
+        row: 1D uint8 array of characters
+    Returns:
+        1D uint8 array of ceil(len(row) / 2) bytes
+    """
+    masks = genomatrix.IUPAC_LUT[row]
+    if len(masks) % 2:
+        masks = np.append(masks, np.uint8(0))
+    return (masks[0::2] << 4) | masks[1::2]
+
+
+def pack_2bit(row):
+    """
+    Function to pack a row into 2-bit base codes plus a missing-site bitmask.
+    Input:
+        row: 1D uint8 array of characters
+    Returns:
+        tuple: (1D uint8 array of ceil(len(row) / 4) bytes,
+                1D uint8 array of ceil(len(row) / 8) bytes)
+    """
+    masks = genomatrix.IUPAC_LUT[row]
+    missing = ~np.isin(masks, (1, 2, 4, 8))
+    codes = BASE2_LUT[row]
+    pad = -len(codes) % 4
+    if pad:
+        codes = np.append(codes, np.zeros(pad, dtype=np.uint8))
+    packed = (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4]
+    return packed, np.packbits(missing)
+
+
+def output_names(outfile, formats):
+    """
+    Function to name one output per format. A single format writes to
+    outfile; several formats replace its extension with each format's,
+    keeping any compression extension (out.phy.gz -> out.nex.gz).
+    Input:
+        outfile (string)
+        formats: list of format names in WRITERS (list)
+    Returns:
+        list of (format, filename) tuples
+    """
+    if len(formats) == 1:
+        return [(formats[0], outfile)]
+    root, compression = compressio.split_extension(outfile)
+    root = os.path.splitext(root)[0]
+    return [(fmt, root + WRITERS[fmt].EXTENSION + compression) for fmt in formats]
+
+
+def write_alignment(rows, outputs, nsamples=None, nsites=None, **options):
+    """
+    Function to write every row to every requested format in one pass.
+    Input:
+        rows: iterable of (name (bytes), sequence (bytes))
+        outputs: list of (format, filename) tuples, see output_names()
+        nsamples, nsites: dimensions if known in advance (int or None)
+        options: writer options, e.g. block_width
+    Returns:
+        tuple: (number of samples, number of sites)
+    """
+    writers = [WRITERS[fmt](filename, nsamples, nsites, **options)
+                for fmt, filename in outputs]
+    try:
+        for name, seq in rows:
+            for writer in writers:
+                writer.add(name, seq)
+        if not writers[0].count:
+            raise ValueError("No samples were found")
+    except BaseException:
+        # Partial or empty outputs are never renamed into place
+        for writer in writers:
+            writer.discard()
+        raise
+
+    for writer in writers:
+        writer.close()
+
+    return writers[0].count, writers[0].nsites
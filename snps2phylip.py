@@ -1,16 +1,61 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import re
 import argparse
+import os
 import sys
+import tempfile
+
+import numpy as np
+
+import batchrun
+import compressio
+import genomatrix
+import parallelrows
+import profiling
+import resultcache
+import seqwriters
 
 def Get_Arguments():
 
     parser = argparse.ArgumentParser(description="Converts pyRAD .snps file to phylip format")
     
-    parser.add_argument("-f", "--file", type=str, required=True, help="Input filename (.snps)")
+    parser.add_argument("-f", "--file", type=str, required=True, nargs="+",
+                        help="Input filename(s) or glob(s) (.snps, or a matrix prefix built with genomatrix.py)")
     parser.add_argument("-o", "--outfile", type=str, required=False, 
-                        help="Output filename; Default = out.phy", nargs="?", default="out.phy")
+                        help="Output filename; .gz, .bgz or .zst names are compressed; Default = out.phy; " + batchrun.TEMPLATE_HELP, nargs="?", default="out.phy")
+    parser.add_argument("-m", "--stream", action="store_true", default=False,
+                        help="Boolean; Stream one sample row at a time to keep memory bounded; default=False")
+    parser.add_argument("-F", "--formats", type=str, required=False, default="phylip",
+                        help="Comma-separated output formats: phylip, phylip-interleaved, nexus, "
+                        "fasta, bin2, bin4; several formats are written from one read of the input, "
+                        "named after OUTFILE with each format's extension; default=phylip")
+    parser.add_argument("-w", "--block_width", type=int, required=False, default=seqwriters.BLOCK_WIDTH,
+                        help="Sites per block for phylip-interleaved; default=" + str(seqwriters.BLOCK_WIDTH))
+    parser.add_argument("-u", "--unlinked", type=str, required=False, default=None,
+                        choices=["random", "complete"],
+                        help="Keep unlinked SNPs using the ' _ ' locus boundaries: random picks sites at "
+                        "random, complete picks the sites with the least missing data (ties broken at random)")
+    parser.add_argument("-n", "--per_locus", type=int, required=False, default=1,
+                        help="Sites kept per locus with --unlinked; default=1")
+    parser.add_argument("-s", "--seed", type=int, required=False, default=None,
+                        help="Random seed for --unlinked, for reproducible subsets; default=None")
+    parser.add_argument("--max-site-missing", "--max_site_missing", dest="max_site_missing",
+                        type=float, required=False, default=None,
+                        help="Drop sites missing in more than this proportion of the retained samples; "
+                        "dropped sites and samples are listed in OUTFILE_ROOT.dropped.tsv; default=None")
+    parser.add_argument("--max-sample-missing", "--max_sample_missing", dest="max_sample_missing",
+                        type=float, required=False, default=None,
+                        help="Drop samples missing more than this proportion of sites; default=None")
+    parser.add_argument("-p", "--processes", type=int, required=False, default=1,
+                        help="Convert one .snps file on this many processes, writing rows in parallel "
+                        "at precomputed offsets; needs an uncompressed .snps input and uncompressed "
+                        "phylip, nexus or fasta outputs without --unlinked or missing-data filters; default=1")
+    batchrun.add_jobs_argument(parser)
+    compressio.add_threads_argument(parser)
+    compressio.add_checksum_argument(parser)
+    profiling.add_profile_arguments(parser)
+    resultcache.add_cache_arguments(parser)
                            
     args = parser.parse_args()
     
@@ -20,12 +65,204 @@ def read_snpsfile(infile):
 
     check_if_exists(infile)
             
-    with open(infile, "r") as fin:
+    with compressio.open_file(infile, "rt") as fin:
         fin.readline()
         samples = dict(line.rstrip().split(None, 1) for line in fin if not line.isspace())
         
     return samples
         
+def stream_snpsfile(infile):
+    # Yields .snps rows one at a time, so peak memory is bounded by a single row.
+    # Writers reserve their headers and rewrite them once the sample count is known.
+    # Yields:
+    #       tuple: (sample name (bytes), sequence (bytes))
+
+    for name, seq, raw in genomatrix.iter_rows(infile, "snps"):
+        yield name, seq
+
+def rows_from_matrix(gmx, samples=None, columns=None):
+    # Yields rows sliced from a genotype matrix (see genomatrix.py), so no text is parsed.
+    # samples and columns are optional arrays of row and site indices to keep.
+
+    if samples is None:
+        samples = range(gmx.nsamples)
+
+    for i in samples:
+        row = gmx.data[i]
+        if columns is not None:
+            row = row[columns]
+        yield gmx.samples[i].encode(), row.tobytes()
+
+def load_matrix(args, spool):
+    # Opens the input as a GenotypeMatrix: a genomatrix.py matrix, a temporary matrix
+    # spooled from the stream (when every row is needed before writing), or the
+    # .snps file read into memory.
+    # Returns None when rows can be streamed straight from the .snps file.
+
+    if genomatrix.is_matrix(args.file):
+        return genomatrix.open_matrix(args.file)
+
+    check_if_exists(args.file)
+
+    if args.stream:
+        if spool is None:
+            return None
+        return genomatrix.build_matrix(args.file, os.path.join(spool.name, "spool"), "snps", sync=False)
+
+    data = read_snpsfile(args.file)
+    if not data:
+        raise ValueError("No samples were found")
+
+    loci = genomatrix.locus_offsets(next(iter(data.values())).encode())
+    seqs = ["".join(seq.split(" _ ")).encode() for seq in data.values()]
+
+    for id, seq in zip(data, seqs):
+        if len(seq) != len(seqs[0]):
+            raise ValueError("Sample {} has {} sites; expected {}".format(id, len(seq), len(seqs[0])))
+
+    block = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), len(seqs[0]))
+    return genomatrix.GenotypeMatrix(block, list(data), loci, args.file)
+
+def needs_all_rows(args):
+    # Missing-data filters and --unlinked complete need per-site counts before any row is written.
+
+    return (args.unlinked == "complete" or args.max_site_missing is not None
+            or args.max_sample_missing is not None)
+
+def filter_missing(args, gmx):
+    # Drops samples, then sites, above the missing-data thresholds. Site missingness is
+    # counted over the retained samples only.
+    # Returns:
+    #       tuple: (row indices kept, site indices kept, per-site missing counts over kept rows,
+    #               write_missing_report arguments after the input name, or None without filters)
+
+    per_sample, per_site = genomatrix.missing_counts(gmx.data)
+    samples = np.arange(gmx.nsamples)
+    sites = np.arange(gmx.nsites)
+
+    if args.max_sample_missing is not None and gmx.nsites:
+        keep = per_sample / gmx.nsites <= args.max_sample_missing
+        for i in samples[~keep]:
+            per_site -= genomatrix.MISSING_LUT[gmx.data[i]]
+        samples = samples[keep]
+
+    if args.max_site_missing is not None and len(samples):
+        sites = sites[per_site / len(samples) <= args.max_site_missing]
+
+    report = None
+    if args.max_site_missing is not None or args.max_sample_missing is not None:
+        report = (gmx, per_sample, per_site, samples, sites)
+        print("Kept {} of {} samples and {} of {} sites in {}".format(
+                len(samples), gmx.nsamples, len(sites), gmx.nsites, args.file))
+
+    return samples, sites, per_site, report
+
+def missing_report_name(outfile):
+
+    return os.path.splitext(compressio.split_extension(outfile)[0])[0] + ".dropped.tsv"
+
+def write_missing_report(report, gmx, per_sample, per_site, samples, sites):
+    # Writes every dropped sample and site as: type, id, locus, missing count, proportion.
+    # Sites are numbered from 1 in the unfiltered alignment.
+
+    dropped_samples = np.setdiff1d(np.arange(gmx.nsamples), samples)
+    dropped_sites = np.setdiff1d(np.arange(gmx.nsites), sites)
+    site_loci = np.searchsorted(gmx.loci, dropped_sites, side="right")
+    nkept = max(len(samples), 1)
+
+    with compressio.open_file(report, "wt") as fout:
+        fout.write("type\tid\tlocus\tmissing\tproportion\n")
+        for i in dropped_samples:
+            fout.write("sample\t{}\tNA\t{}\t{:.4f}\n".format(
+                        gmx.samples[i], per_sample[i], per_sample[i] / max(gmx.nsites, 1)))
+        for site, locus in zip(dropped_sites, site_loci):
+            fout.write("site\t{}\t{}\t{}\t{:.4f}\n".format(
+                        site + 1, locus, per_site[site], per_site[site] / nkept))
+
+def select_sites(args, gmx):
+    # Applies the missing-data filters and --unlinked to a matrix.
+    # Returns:
+    #       tuple: (row indices kept, site indices kept or None for all sites,
+    #               missing-data report to write once the alignment is in place, or None)
+
+    if args.max_site_missing is None and args.max_sample_missing is None and args.unlinked != "complete":
+        samples, sites, per_site, report = np.arange(gmx.nsamples), None, None, None
+    else:
+        samples, sites, per_site, report = filter_missing(args, gmx)
+
+    if args.unlinked is not None:
+        if sites is None:
+            sites = np.arange(gmx.nsites)
+        # Locus boundaries re-expressed as offsets into the retained sites
+        loci = np.searchsorted(sites, gmx.loci)
+        missing = per_site[sites] if args.unlinked == "complete" else None
+        chosen = genomatrix.select_unlinked(loci, args.per_locus, missing, args.seed)
+        print("Kept {} of {} sites from {} loci in {}".format(
+                len(chosen), len(sites), gmx.nloci, args.file))
+        sites = sites[chosen]
+
+    elif sites is not None and len(sites) == gmx.nsites:
+        sites = None
+
+    return samples, sites, report
+
+def parallel_blocker(args, outputs):
+    # Returns why --processes cannot be used for this input, or None if it can.
+
+    if genomatrix.is_matrix(args.file):
+        return "matrix input"
+    check_if_exists(args.file)
+    if compressio.is_compressed(args.file):
+        return "compressed input"
+    if args.unlinked is not None or needs_all_rows(args):
+        return "--unlinked or missing-data filters"
+    if any(compressio.output_codec(filename) for fmt, filename in outputs):
+        return "compressed output"
+    if not parallelrows.supported([fmt for fmt, filename in outputs]):
+        return "format other than phylip, nexus or fasta"
+    return None
+
+def convert_parallel(args, outputs, cache):
+    # Converts one uncompressed .snps file on args.processes processes (see parallelrows.py).
+
+    try:
+        with profiling.stage("write"):
+            nsamples, nsites = parallelrows.convert(args.file, outputs, args.processes,
+                                                    block_width=args.block_width)
+    except ValueError as e:
+        print("\nError: " + str(e) + " in " + args.file + "\n")
+        return 1
+    profiling.count_files("read", [args.file], nsamples)
+    profiling.count_files("write", [filename for fmt, filename in outputs], nsamples)
+    cache.store()
+    return 0
+
+def open_cache(args, outputs):
+    # Returns the result cache for one conversion (see resultcache.py). Every file
+    # this run can write is cached: the alignments, the bin2/bin4 JSON sidecars and
+    # the missing-data report. Runs that pick sites at random without --seed are
+    # never cached.
+
+    filenames = list()
+    for fmt, filename in outputs:
+        filenames.append(filename)
+        if issubclass(seqwriters.WRITERS[fmt], seqwriters.PackedWriter):
+            filenames.append(filename + ".json")
+    if args.max_site_missing is not None or args.max_sample_missing is not None:
+        filenames.append(missing_report_name(args.outfile))
+
+    if genomatrix.is_matrix(args.file):
+        prefix = genomatrix.matrix_prefix(args.file)
+        inputs = [prefix + ext for ext in (genomatrix.MATRIX_EXT, genomatrix.INDEX_EXT, genomatrix.LOCI_EXT)]
+    else:
+        inputs = [args.file]
+
+    options = dict((name, getattr(args, name)) for name in
+                ("formats", "block_width", "stream", "unlinked", "per_locus", "seed",
+                "max_site_missing", "max_sample_missing"))
+    return resultcache.open_cache(args, inputs, filenames, options,
+                                cacheable=args.unlinked is None or args.seed is not None)
+
 def check_if_exists(filename):
 
     try:
@@ -34,34 +271,122 @@ def check_if_exists(filename):
         print("\nError: The file " + filename + " does not exist.\n")
         sys.exit(1)
 
-def write_to_file(dictionary, file, val_length):
-         
-    with open(file, "w") as fout:
-        fout.write(str(len(dictionary.keys())) + " " + str(val_length) + "\n")
-        for key, val in dictionary.iteritems():
-            fout.write(key + "\t" + val + "\n")
-            
-        fout.write("\n")
+def parse_formats(formats):
+    # Splits a comma-separated list of output formats and checks each one.
 
-################################################################################################################################
-#####################################################MAIN#######################################################################
-################################################################################################################################
+    formats = [fmt.strip() for fmt in formats.split(",") if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in seqwriters.WRITERS]
+    if unknown or not formats:
+        raise ValueError("Unknown output format(s): " + ",".join(unknown) + 
+                        "; choose from " + ",".join(sorted(seqwriters.WRITERS)))
+    return formats
 
+def first_row_loci(infile):
+    # Reads locus boundaries from the ' _ ' separators of the first .snps row only.
 
-args = Get_Arguments()
+    for name, seq, raw in genomatrix.iter_rows(infile, "snps"):
+        return genomatrix.locus_offsets(raw)
+    raise ValueError("No samples were found")
 
-data = read_snpsfile(args.file)
+def subsample_rows(rows, columns, nsites):
+    # Keeps only the selected sites of each row.
+    # Yields:
+    #       tuple: (sample name (bytes), sequence (bytes))
 
-for id, seq in data.iteritems():
-    data[id] = "".join(seq.split(" _ "))
+    for name, seq in rows:
+        if len(seq) != nsites:
+            raise ValueError("Sample {} has {} sites; expected {}".format(
+                            name.decode(), len(seq), nsites))
+        yield name, np.frombuffer(seq, dtype=np.uint8)[columns].tobytes()
 
-seq_length = len(data[id])
-    
-write_to_file(data, args.outfile, seq_length)
+def convert(args):
+    # Converts one input file; args holds a single input and output name.
+    # Every requested format is written from the same pass over the input.
+
+    outputs = seqwriters.output_names(args.outfile, parse_formats(args.formats))
+    spool = None
+    report = None
 
+    cache = open_cache(args, outputs)
+    if cache.restore():
+        return 0
 
+    if args.processes > 1:
+        reason = parallel_blocker(args, outputs)
+        if reason is None:
+            return convert_parallel(args, outputs, cache)
+        print("Note: converting {} on one process ({})".format(args.file, reason))
+
+    try:
+        if args.stream and needs_all_rows(args) and not genomatrix.is_matrix(args.file):
+            # Per-site counts are needed before the first row is written, so the
+            # stream is spooled once into a temporary genotype matrix.
+            spool = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(args.outfile)))
 
+        with profiling.stage("read"):
+            gmx = load_matrix(args, spool)
+        profiling.count_files("read", [args.file], gmx.nsamples if gmx is not None else 0)
 
+        if gmx is None:
+            rows = stream_snpsfile(args.file)
+            nsamples, nsites = None, None
+            if args.unlinked is not None:
+                loci = first_row_loci(args.file)
+                columns = genomatrix.select_unlinked(loci, args.per_locus, None, args.seed)
+                rows = subsample_rows(rows, columns, int(loci[-1]))
+                nsites = len(columns)
+                print("Kept {} of {} sites from {} loci in {}".format(
+                        nsites, loci[-1], len(loci) - 1, args.file))
+        else:
+            with profiling.stage("select"):
+                samples, sites, report = select_sites(args, gmx)
+            rows = rows_from_matrix(gmx, samples, sites)
+            nsamples = len(samples)
+            nsites = gmx.nsites if sites is None else len(sites)
 
+        # With --stream, reading happens here as rows are pulled through the writers
+        with profiling.stage("write"):
+            written, nsites = seqwriters.write_alignment(rows, outputs, nsamples, nsites,
+                                                        block_width=args.block_width)
+            # The report is only written once the alignments are in place
+            if report is not None:
+                write_missing_report(missing_report_name(args.outfile), *report)
+        profiling.count_files("write", [filename for fmt, filename in outputs], written)
+        cache.store()
 
+    except ValueError as e:
+        print("\nError: " + str(e) + " in " + args.file + "\n")
+        return 1
+
+    finally:
+        if spool is not None:
+            spool.cleanup()
+
+    return 0
+
+################################################################################################################################
+#####################################################MAIN#######################################################################
+################################################################################################################################
+
+
+if __name__ == "__main__":
+
+    args = Get_Arguments()
+    compressio.set_threads(args.io_threads)
+    compressio.set_checksum(args.checksum)
+
+    try:
+        parse_formats(args.formats)
+    except ValueError as e:
+        print("\nError: " + str(e) + "\n")
+        sys.exit(1)
+
+    infiles = batchrun.expand_inputs(args.file)
+
+    try:
+        namespaces = batchrun.per_input_arguments(args, "file", infiles, ["outfile"])
+    except ValueError as e:
+        print("\nError: " + str(e) + "\n")
+        sys.exit(1)
 
+    sys.exit(batchrun.run_batch(convert, namespaces, infiles, args.jobs))
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+import batchrun
+import compressio
+import genomatrix
+import profiling
+
+# Loci rendered before their NEXUS files are written out together
+WRITE_BATCH_SIZE = 256
+
+# Locus number written by pyRAD/ipyrad on the "//" line, e.g. "|12|"
+LOCUS_ID_RE = re.compile(rb"\|(\d+)\|")
+
+
+def main():
+
+	arguments = Get_Arguments()
+	compressio.set_threads(arguments.io_threads)
+	compressio.set_checksum(arguments.checksum)
+
+	infiles = batchrun.expand_inputs(arguments.file)
+
+	try:
+		namespaces = batchrun.per_input_arguments(arguments, "file", infiles, ["out"])
+	except ValueError as e:
+		print("\nError: " + str(e) + "\n")
+		return 1
+
+	return batchrun.run_batch(split_loci, namespaces, infiles, arguments.jobs)
+
+################################################################################
+
+def split_loci(arguments):
+# Filters the loci in one .loci file and writes them as NEXUS files or as a
+# concatenated PHYLIP file with a partition file.
+# Arguments:
+#       argparse namespace holding a single input file
+# Returns:
+#       int: 0 if no errors, 1 if error occurred.
+
+	if not os.path.isfile(arguments.file):
+		print("\nError: The file " + arguments.file + " does not exist or cannot be "
+				"read.\n")
+		return 1
+
+	include = read_sample_list(arguments.include)
+	exclude = read_sample_list(arguments.exclude)
+
+	if arguments.format == "nexus":
+		if os.path.exists(arguments.out):
+			print("Error: Output directory '%s' already exists." % arguments.out)
+			return 1
+		os.makedirs(arguments.out)
+		writer = NexusWriter(arguments.out, arguments.threads)
+	else:
+		writer = PhylipWriter(arguments.out)
+
+	total = 0
+	too_few = 0
+	uninformative = 0
+	kept = 0
+
+	# A malformed locus or a failed write leaves no partial output behind.
+	try:
+		with profiling.stage("split"):
+			for locus_id, names, block in iter_loci(arguments.file):
+				total += 1
+				names, block = subset_samples(names, block, include, exclude)
+
+				if len(names) < arguments.min_samples:
+					too_few += 1
+					continue
+
+				variable, informative = genomatrix.count_informative_sites(block)
+				if informative < arguments.min_pis:
+					uninformative += 1
+					continue
+
+				writer.add(locus_id, names, block)
+				kept += 1
+		profiling.count_files("split", [arguments.file], total)
+
+		with profiling.stage("write"):
+			writer.close()
+		profiling.count("write", kept)
+	except ValueError as e:
+		writer.discard()
+		print("\nError: " + str(e) + "\n")
+		return 1
+	except BaseException:
+		writer.discard()
+		raise
+
+	print("\nRead {} loci from {}".format(total, arguments.file))
+	print("{} loci had fewer than {} samples".format(too_few, arguments.min_samples))
+	print("{} loci had fewer than {} parsimony-informative sites".format(
+			uninformative, arguments.min_pis))
+	print("Wrote {} loci to {}\n".format(kept, writer.destination))
+
+	return 0
+
+def iter_loci(file):
+# Reads a pyRAD .loci file sequentially, one locus at a time.
+# Arguments:
+#       .loci filename
+# Yields:
+#       tuple: (locus name (str), list of sample names (str),
+#               2D uint8 array (sample x site))
+	names = list()
+	seqs = list()
+	count = 0
+	with compressio.open_file(file, "rb") as fin:
+		for line in fin:
+			if line.startswith(b">"):
+				name, seq = line[1:].split(None, 1)
+				names.append(name.decode())
+				seqs.append(seq.rstrip())
+			elif line.startswith(b"//"):
+				match = LOCUS_ID_RE.search(line)
+				locus_id = match.group(1).decode() if match else str(count)
+				count += 1
+				if names:
+					yield "locus" + locus_id, names, to_block(seqs, locus_id)
+				names = list()
+				seqs = list()
+
+def to_block(seqs, locus_id):
+# Arguments:
+#       list of aligned sequences (bytes)
+#       locus name, for error messages
+# Returns:
+#       2D uint8 array (sample x site)
+	length = len(seqs[0])
+	if any(len(seq) != length for seq in seqs):
+		raise ValueError("Sequences in locus {} are not aligned".format(locus_id))
+	return np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), length)
+
+def subset_samples(names, block, include, exclude):
+# Applies the sample include/exclude lists to one locus.
+# Arguments:
+#       list of sample names
+#       2D uint8 array (sample x site)
+#       set of samples to keep, or None for all
+#       set of samples to drop, or None
+# Returns:
+#       tuple: (list of sample names, 2D uint8 array)
+	if include is None and exclude is None:
+		return names, block
+	keep = [i for i, name in enumerate(names)
+			if (include is None or name in include)
+			and (exclude is None or name not in exclude)]
+	if len(keep) == len(names):
+		return names, block
+	return [names[i] for i in keep], block[keep]
+
+def read_sample_list(file):
+# Reads sample names, one per line (the first column is used).
+# Arguments:
+#       filename or None
+# Returns:
+#       set of sample names, or None
+	if file is None:
+		return None
+	with compressio.open_file(file, "rt") as fin:
+		return set(line.split()[0] for line in fin if line.strip())
+
+class NexusWriter(object):
+# Writes one NEXUS file per locus. Each file is rendered to a single string
+# and written with one call; batches of files are written on a thread pool.
+
+	def __init__(self, outdir, threads):
+		self.outdir = outdir
+		self.destination = outdir
+		self.pending = list()
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+		self.futures = list()
+
+	def add(self, locus_id, names, block):
+		self.pending.append((os.path.join(self.outdir, locus_id + ".nex"),
+							render_nexus(names, block)))
+		if len(self.pending) >= WRITE_BATCH_SIZE:
+			self.flush()
+
+	def flush(self):
+		if self.pending:
+			self.futures.append(self.pool.submit(write_files, self.pending))
+			self.pending = list()
+
+	def close(self):
+		self.flush()
+		self.pool.shutdown(wait=True)
+		for future in self.futures:
+			future.result()
+		# The renames are made durable with one fsync of the directory
+		compressio.fsync_path(self.outdir)
+
+	def discard(self):
+		# Waits for queued writes, then removes the output directory.
+		self.pending = list()
+		self.pool.shutdown(wait=True)
+		shutil.rmtree(self.outdir, ignore_errors=True)
+
+class PhylipWriter(object):
+# Concatenates loci into one PHYLIP file plus a RAxML/IQ-TREE partition file.
+# Retained locus blocks are appended to a temporary spool file as they arrive,
+# so only their sample rows and offsets stay in memory. close() fills a
+# temporary memory-mapped sample x site matrix (N where a sample lacks a
+# locus) with one vectorized assignment per locus, reading each block back
+# from the memory-mapped spool, and writes it row by row.
+
+	def __init__(self, prefix):
+		self.phylip = prefix + ".phy"
+		self.partitions = prefix + ".partitions.txt"
+		self.destination = self.phylip
+		self.samples = dict()
+		self.loci = list()
+		self.length = 0
+		self.spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.phylip)))
+		self.spooled = 0
+
+	def add(self, locus_id, names, block):
+		rows = np.array([self.samples.setdefault(name, len(self.samples))
+						for name in names], dtype=np.int64)
+		self.spool.write(block.tobytes())
+		self.loci.append((locus_id, self.length, block.shape[1], rows, self.spooled))
+		self.length += block.shape[1]
+		self.spooled += block.size
+
+	def close(self):
+		# The matrix gets a hidden temporary name, removed however close() ends
+		tmp = compressio.temp_name(self.phylip)
+		shape = (len(self.samples), self.length)
+		matrix = None
+		try:
+			if self.length and self.samples:
+				self.spool.flush()
+				blocks = np.memmap(self.spool, dtype=np.uint8, mode="r", shape=(self.spooled,))
+				matrix = np.memmap(tmp, dtype=np.uint8, mode="w+", shape=shape)
+				matrix[:] = ord("N")
+				for locus_id, start, width, rows, offset in self.loci:
+					block = blocks[offset:offset + len(rows) * width].reshape(len(rows), width)
+					matrix[rows, start:start + width] = block
+				del blocks
+			self.spool.close()
+
+			with compressio.open_file(self.phylip, "wb") as fout:
+				fout.write("{} {}\n".format(shape[0], shape[1]).encode())
+				for name, i in self.samples.items():
+					fout.write(name.encode())
+					fout.write(b"\t")
+					fout.write(matrix[i].tobytes())
+					fout.write(b"\n")
+		finally:
+			self.spool.close()
+			del matrix
+			compressio.remove_temp(tmp)
+
+		with compressio.open_file(self.partitions, "wt") as fout:
+			for locus_id, start, width, rows, offset in self.loci:
+				fout.write("DNA, {} = {}-{}\n".format(locus_id, start + 1, start + width))
+
+	def discard(self):
+		# Nothing is written under the output names before close().
+		self.spool.close()
+
+def render_nexus(names, block):
+# Arguments:
+#       list of sample names
+#       2D uint8 array (sample x site)
+# Returns:
+#       bytes: NEXUS file content
+	width = max(len(name) for name in names) + 2
+	lines = [b"#NEXUS\n",
+			b"begin data;\n",
+			"\tdimensions ntax={} nchar={};\n".format(len(names), block.shape[1]).encode(),
+			b"\tformat datatype=dna missing=N gap=-;\n",
+			b"\tmatrix\n"]
+	for name, row in zip(names, block):
+		lines.append(b"\t" + name.ljust(width).encode() + row.tobytes() + b"\n")
+	lines.append(b"\t;\nend;\n")
+	return b"".join(lines)
+
+def write_files(files):
+# Each file is fsync'ed and renamed into place on the writer thread; the
+# directory is fsync'ed once by NexusWriter.close().
+# Arguments:
+#       list of (filename, bytes) tuples
+	for filename, content in files:
+		with compressio.open_file(filename, "wb", sync_dir=False) as fout:
+			fout.write(content)
+
+def Get_Arguments():
+	# Parse command-line arguments using argparse.
+	# Returns:
+	#       Object containing command-line arguments.
+	parser = argparse.ArgumentParser(description="Splits and filters a pyRAD "
+									".loci file into per-locus NEXUS files or a "
+									"concatenated PHYLIP file",
+									add_help=False)
+
+	required_args = parser.add_argument_group("Required Arguments")
+	optional_args = parser.add_argument_group("Optional Arguments")
+
+	required_args.add_argument("-f", "--file",
+								type=str,
+								required=True,
+								nargs="+",
+								help="Input pyRAD .loci file(s) or glob(s)")
+
+	optional_args.add_argument("-o", "--out",
+								type=str,
+								required=False,
+								default="loci",
+								help="Output directory (nexus) or prefix (phylip); "
+									"default = 'loci'; " + batchrun.TEMPLATE_HELP)
+
+	optional_args.add_argument("-F", "--format",
+								type=str,
+								required=False,
+								choices=["nexus", "phylip"],
+								default="nexus",
+								help="nexus: one NEXUS file per locus; phylip: "
+									"concatenated PREFIX.phy plus "
+									"PREFIX.partitions.txt; default = 'nexus'")
+
+	optional_args.add_argument("-m", "--min_samples",
+								type=int,
+								required=False,
+								default=4,
+								help="Minimum samples in a locus; default = 4")
+
+	optional_args.add_argument("-p", "--min_pis",
+								type=int,
+								required=False,
+								default=1,
+								help="Minimum parsimony-informative sites in a "
+									"locus; default = 1")
+
+	optional_args.add_argument("-i", "--include",
+								type=str,
+								required=False,
+								default=None,
+								help="File of sample names to keep, one per line")
+
+	optional_args.add_argument("-x", "--exclude",
+								type=str,
+								required=False,
+								default=None,
+								help="File of sample names to drop, one per line")
+
+	optional_args.add_argument("-t", "--threads",
+								type=int,
+								required=False,
+								default=4,
+								help="Threads writing NEXUS files; default = 4")
+
+	batchrun.add_jobs_argument(optional_args)
+	compressio.add_threads_argument(optional_args)
+	compressio.add_checksum_argument(optional_args)
+	profiling.add_profile_arguments(optional_args)
+
+	optional_args.add_argument("-h", "--help", action="help",
+						help="Displays this help menu")
+
+	args = parser.parse_args()
+
+	return args
+
+################################################################################
+
+if __name__ == '__main__':
+	rtrn_code = main()
+	print("Program finished with exit status " + str(rtrn_code) + "\n")
+	sys.exit(rtrn_code)